@@ -0,0 +1,302 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+End-to-end latency benchmark of device control.  Measures the round trip from an MQTT command on the command topic
+to the state publication reflecting it, and from a web ``POST /device/control`` to the returned json state.  Reports
+p50/p99 latency, throughput and device free heap as json, and optionally compares against a baseline to catch
+regressions between releases.
+
+The device is either a running device on the network or an application started in the host simulator with its
+local MQTT broker stand-in.
+
+Examples:
+    python benchmarks/latency.py --sim examples/pico_switch/main.py -n 200 -o latency.json
+    python benchmarks/latency.py --host 192.168.1.20 --mqtt-server 192.168.1.10 --baseline latency.json
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from rockwren.sim.mqtt import MQTTClient
+from rockwren.version import __version__
+
+MEM_FREE = re.compile(rb"^rockwren_mem_free_bytes (\d+)$", re.MULTILINE)
+""" Latency statistics compared against a baseline """
+COMPARED = ("p50", "p99")
+
+
+def percentile(values, fraction):
+    """ :return: the value at the fraction (0 - 1) of the sorted values """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summary(latency: list, errors: int, elapsed: float) -> dict:
+    """ :return: json serialisable latency percentiles and throughput of a benchmark """
+    return {"count": len(latency),
+            "errors": errors,
+            "latency_ms": {"p50": round(percentile(latency, 0.5), 2),
+                           "p90": round(percentile(latency, 0.9), 2),
+                           "p99": round(percentile(latency, 0.99), 2),
+                           "max": round(max(latency, default=0), 2),
+                           "mean": round(sum(latency) / len(latency), 2) if latency else 0},
+            "throughput_per_s": round(len(latency) / elapsed, 1) if elapsed else 0}
+
+
+class Device:
+    """ Web and MQTT access to the device under test. """
+
+    def __init__(self, host: str, port: int, mqtt_server: str, mqtt_port: int, device_topic: str, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.mqtt = None
+        self.state = None
+        self.state_topic = None
+        self.online = []  # device topics announced online
+        if mqtt_server:
+            self.mqtt = MQTTClient(b"rockwren-latency-benchmark", mqtt_server, mqtt_port, keepalive=60)
+            self.mqtt.set_callback(self._message)
+            self.mqtt.connect()
+            if self.mqtt.is_conn_issue():
+                raise OSError(f"Could not connect to MQTT server {mqtt_server}:{mqtt_port}")
+            device_topic = device_topic.encode() if device_topic else self._find_device_topic()
+            self.state_topic = device_topic + b"/state"
+            self.command_topic = device_topic + b"/command"
+            self.mqtt.subscribe(self.state_topic)
+
+    def _find_device_topic(self) -> bytes:
+        """ :return: the device topic of the only device online """
+        self.mqtt.subscribe(b"rockwren/+/LWT")
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline and not self.online:
+            self.mqtt.poller.poll(100)
+            self.drain()
+        if len(self.online) != 1:
+            raise ValueError(f"{len(self.online)} devices online, set the device topic with --device-topic")
+        return self.online[0]
+
+    def request(self, method: str, path: str, body=None, headers=None) -> tuple:
+        """ :return: tuple (HTTP status code, response body) """
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body, headers if headers else {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def mem_free(self):
+        """ :return: the device free heap in bytes, or None if it is not available """
+        try:
+            match = MEM_FREE.search(self.request("GET", "/metrics")[1])
+        except (OSError, http.client.HTTPException):
+            return None
+        return int(match.group(1)) if match else None
+
+    def _message(self, topic, msg, retained, duplicate) -> None:
+        if topic.endswith(b"/LWT"):
+            if msg == b"online":
+                self.online.append(topic[:-len(b"/LWT")])
+        elif topic == self.state_topic:
+            self.state = json.loads(msg).get("state")
+
+    def drain(self) -> None:
+        """ Handle the MQTT messages received so far. """
+        if self.mqtt:
+            while self.mqtt.check_msg() is not None:
+                pass
+
+    def mqtt_command(self, state: str) -> bool:
+        """ Send a command and wait for the state publication that reflects it.
+            :return: True if the state was published before the timeout """
+        self.drain()
+        self.state = None
+        self.mqtt.publish(self.command_topic, json.dumps({"state": state}))
+        deadline = time.monotonic() + self.timeout
+        while self.state != state:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.mqtt.is_conn_issue():
+                return False
+            if self.mqtt.poller.poll(remaining * 1000):
+                self.mqtt.check_msg()
+        return True
+
+    def web_control(self, state: str) -> bool:
+        """ :return: True if the returned json state reflects the control request """
+        status, body = self.request("POST", "/device/control", urllib.parse.urlencode({"state": state}),
+                                    {"Content-Type": "application/x-www-form-urlencoded"})
+        return status == 200 and json.loads(body).get("state") == state
+
+
+def bench(name: str, control, iterations: int, warmup: int, heap_interval: int, device: Device,
+          heap: list) -> dict:
+    """ Time ``iterations`` round trips, alternating the device between ON and OFF.
+        :return: the benchmark summary """
+    for i in range(warmup):
+        control("ON" if i % 2 else "OFF")
+    latency = []
+    errors = 0
+    elapsed = 0
+    for i in range(iterations):
+        start = time.monotonic()
+        try:
+            ok = control("ON" if i % 2 else "OFF")
+        except (OSError, http.client.HTTPException, ValueError):
+            ok = False
+        end = time.monotonic()
+        elapsed += end - start
+        if ok:
+            latency.append((end - start) * 1000)
+        else:
+            errors += 1
+        if heap_interval and i % heap_interval == 0:
+            heap.append(device.mem_free())
+        device.drain()
+    print(f"{name}: {len(latency)} round trips, {errors} errors", file=sys.stderr)
+    return summary(latency, errors, elapsed)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """ :return: descriptions of latencies that regressed by more than ``tolerance`` (a fraction) over the baseline """
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base:
+            continue
+        for stat in COMPARED:
+            was, now = base["latency_ms"][stat], result["latency_ms"][stat]
+            if was and now > was * (1 + tolerance):
+                regressions.append(f"{name} {stat} {was}ms -> {now}ms")
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_sim(main: str, root: str, timeout: float) -> tuple:
+    """
+    Start an application in the host simulator and wait for its web server.
+    :return: tuple (simulator process, http port, mqtt port)
+    """
+    http_port, mqtt_port = free_port(), free_port()
+    process = subprocess.Popen([sys.executable, "-m", "rockwren.sim", os.path.abspath(main), "-r", root,
+                                "-p", str(http_port), "--mqtt-port", str(mqtt_port)],
+                               cwd=PACKAGE_DIR, env=dict(os.environ, PYTHONPATH=PACKAGE_DIR),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", http_port), 1).close()
+            return process, http_port, mqtt_port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise OSError(f"Simulator did not start {main}")
+
+
+def run(args) -> dict:
+    device = Device(args.host, args.port, args.mqtt_server, args.mqtt_port, args.device_topic, args.timeout)
+    heap = [device.mem_free()]
+    benchmarks = {}
+    if device.mqtt:
+        benchmarks["mqtt_command"] = bench("mqtt_command", device.mqtt_command, args.iterations, args.warmup,
+                                           args.heap_interval, device, heap)
+    benchmarks["web_control"] = bench("web_control", device.web_control, args.iterations, args.warmup,
+                                      args.heap_interval, device, heap)
+    heap.append(device.mem_free())
+    heap = [h for h in heap if h is not None]
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "rockwren_version": __version__,
+            "target": "sim" if args.sim else args.host,
+            "iterations": args.iterations,
+            "benchmarks": benchmarks,
+            "heap": {"mem_free_start": heap[0] if heap else None,
+                     "mem_free_min": min(heap, default=None),
+                     "mem_free_end": heap[-1] if heap else None}}
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='latency.py')
+    parser.add_argument('--sim', type=str, default=None,
+                        help='application main.py to run in the host simulator as the device under test')
+    parser.add_argument('--host', type=str, default=None,
+                        help='device host name or ip address')
+    parser.add_argument('-p', '--port', type=int, default=80,
+                        help='device web server port')
+    parser.add_argument('-m', '--mqtt-server', type=str, default=None,
+                        help='MQTT broker the device is connected to, MQTT is not benchmarked if not set')
+    parser.add_argument('--mqtt-port', type=int, default=1883,
+                        help='MQTT broker port')
+    parser.add_argument('--device-topic', type=str, default=None,
+                        help='device topic e.g. rockwren/e6614104032b6b2c, found from the devices online if not set')
+    parser.add_argument('-n', '--iterations', type=int, default=100,
+                        help='round trips measured for each benchmark')
+    parser.add_argument('-w', '--warmup', type=int, default=5,
+                        help='round trips before measuring')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='seconds to wait for a round trip')
+    parser.add_argument('--heap-interval', type=int, default=10,
+                        help='round trips between free heap samples from /metrics, 0 for start and end only')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='file to write the json results to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional increase in p50 or p99 latency over the baseline reported as a regression')
+
+    args = parser.parse_args()
+    if not args.sim and not args.host:
+        parser.error("one of --sim or --host is required")
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    sim = None
+    if args.sim:
+        root = tempfile.mkdtemp(prefix="rockwren-latency-")
+        sim, args.port, args.mqtt_port = start_sim(args.sim, root, args.timeout)
+        args.host = args.mqtt_server = "127.0.0.1"
+    try:
+        results = run(args)
+    finally:
+        if sim is not None:
+            sim.terminate()
+            sim.wait()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
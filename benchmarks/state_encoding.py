@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Microbenchmark of MQTT state encoding.  Compares the bytes per message and the time to encode the device state with
+``ujson.dumps``, as ``rockwren.Device.device_state`` does, against ``rockwren.mqtt_client.StateSchema`` for a one
+value temperature sensor and a multi value telemetry device.  Reports bytes and nanoseconds per message as json.
+
+Examples:
+    python benchmarks/state_encoding.py
+    python benchmarks/state_encoding.py -n 100000 -o state_encoding.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from rockwren.sim import install
+
+# The stand-ins must be installed before the rockwren modules are imported
+install()
+
+import ujson
+from rockwren.mqtt_client import StateSchema
+
+""" name -> (schema, state values) """
+DEVICES = {
+    "temperature": (StateSchema((("temperature", "h", 100),)),
+                    {"temperature": 21.4712}),
+    "telemetry": (StateSchema((("temperature", "h", 100), ("humidity", "H", 100), ("pressure", "I", 10),
+                               ("battery", "B"), ("motion", "?"), ("rssi", "b"))),
+                  {"temperature": 21.4712, "humidity": 48.25, "pressure": 101325.4, "battery": 87, "motion": True,
+                   "rssi": -61}),
+}
+
+
+def timed(encode, values: dict, iterations: int) -> float:
+    """ :return: nanoseconds per encode of the values """
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        encode(values)
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def bench(name: str, iterations: int) -> dict:
+    """ :return: bytes and ns per message of the device's state encoded as json and with its schema """
+    schema, values = DEVICES[name]
+    decoded = schema.decode(schema.encode(values))
+    assert all(abs(decoded[key] - values[key]) < 0.1 for key in values)
+    return {"device": name,
+            "json_bytes": len(ujson.dumps(values)),
+            "json_ns": round(timed(ujson.dumps, values, iterations)),
+            "schema_bytes": len(schema.encode(values)),
+            "schema_ns": round(timed(schema.encode, values, iterations))}
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='state_encoding.py')
+    parser.add_argument('-d', '--devices', type=str, nargs='+', default=list(DEVICES), choices=list(DEVICES),
+                        help='devices to benchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=100000,
+                        help='encodes per measurement')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='write the json results to a file')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # Warm up before measuring
+    bench(args.devices[0], args.iterations // 10)
+    results = [bench(name, args.iterations) for name in args.devices]
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
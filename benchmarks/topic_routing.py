@@ -0,0 +1,98 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Microbenchmark of MQTT topic routing.  Compares the time to find the handlers of a topic with a dictionary of exact
+topics, as used before wildcard topic filters were supported, against ``rockwren.mqtt_client.TopicTrie`` with exact
+topic filters and with wildcard topic filters, for 1 to 200 handlers.  Reports nanoseconds per lookup as json.
+
+Examples:
+    python benchmarks/topic_routing.py
+    python benchmarks/topic_routing.py -c 1 10 50 100 200 -n 100000 -o topic_routing.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from rockwren.sim import install
+
+# The stand-ins must be installed before the rockwren modules are imported
+install()
+
+from rockwren.mqtt_client import TopicTrie
+
+DEVICE_TOPIC = b"rockwren/e6614103e7328b23"
+
+
+def handler(topic, message):
+    pass
+
+
+def timed(lookup, topics: list, iterations: int) -> float:
+    """ :return: nanoseconds per lookup of the topics """
+    rounds = max(1, iterations // len(topics))
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        for topic in topics:
+            lookup(topic)
+    return (time.perf_counter_ns() - start) / (rounds * len(topics))
+
+
+def bench(count: int, iterations: int) -> dict:
+    """ :return: ns per lookup of matching and non matching topics for each routing table with count handlers """
+    topics = [DEVICE_TOPIC + b"/handler%d" % index for index in range(count)]
+    # Wildcard filters matching one level under a group topic, e.g. rockwren/group/<name>/+
+    groups = [b"rockwren/group/zone%d" % index for index in range(count)]
+    misses = [DEVICE_TOPIC + b"/unknown", b"rockwren/group/unknown/command", b"other/topic"]
+
+    table = {topic: handler for topic in topics}
+    exact = TopicTrie()
+    for topic in topics:
+        exact.add(topic, handler)
+    wildcard = TopicTrie()
+    for group in groups:
+        wildcard.add(group + b"/+", handler)
+
+    assert all(table.get(topic) for topic in topics)
+    assert all(exact.match(topic) for topic in topics)
+    assert all(wildcard.match(group + b"/command") for group in groups)
+    assert not any(wildcard.match(topic) for topic in misses)
+    return {"handlers": count,
+            "dict_ns": round(timed(table.get, topics, iterations)),
+            "dict_miss_ns": round(timed(table.get, misses, iterations)),
+            "trie_exact_ns": round(timed(exact.match, topics, iterations)),
+            "trie_exact_miss_ns": round(timed(exact.match, misses, iterations)),
+            "trie_wildcard_ns": round(timed(wildcard.match, [group + b"/command" for group in groups], iterations)),
+            "trie_wildcard_miss_ns": round(timed(wildcard.match, misses, iterations))}
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='topic_routing.py')
+    parser.add_argument('-c', '--counts', type=int, nargs='+', default=[1, 10, 50, 100, 200],
+                        help='numbers of handlers to benchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=200000,
+                        help='lookups per measurement')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='write the json results to a file')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # Warm up before measuring
+    bench(args.counts[0], args.iterations // 10)
+    results = [bench(count, args.iterations) for count in args.counts]
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
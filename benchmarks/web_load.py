@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Web server load test.  Runs concurrent HTTP clients against a rockwren device and reports the responses by route and
+status, latency percentiles, connection errors and device restarts.  A device that degrades gracefully under load
+answers with 503 responses rather than resetting.
+
+Example:
+    python benchmarks/web_load.py --host 192.168.1.20 -c 4 -d 60 -r /device/state -r /device/state -r /log
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from collections import Counter
+from collections import defaultdict
+
+UPTIME = re.compile(rb"^rockwren_uptime_seconds (\d+)$", re.MULTILINE)
+MEM_FREE = re.compile(rb"^rockwren_mem_free_bytes (\d+)$", re.MULTILINE)
+
+
+def percentile(values, fraction):
+    """ :return: the value at the fraction (0 - 1) of the sorted values """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def get(host, port, path, timeout):
+    """
+    Send a GET request.
+    :return: tuple (HTTP status code, response body)
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), body
+
+
+async def client(host, port, routes, deadline, timeout, results):
+    """ Request the routes in turn until the deadline. """
+    index = 0
+    while time.monotonic() < deadline:
+        path = routes[index % len(routes)]
+        index += 1
+        start = time.monotonic()
+        try:
+            status, _ = await get(host, port, path, timeout)
+            results["status"][path][status] += 1
+            results["latency"][path].append((time.monotonic() - start) * 1000)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError) as ex:
+            results["errors"][path][type(ex).__name__] += 1
+            await asyncio.sleep(0.5)
+
+
+async def monitor(host, port, deadline, timeout, interval, results):
+    """ Poll /metrics to detect device restarts and track the lowest free heap. """
+    last_uptime = None
+    while time.monotonic() < deadline:
+        try:
+            status, body = await get(host, port, "/metrics", timeout)
+            uptime = UPTIME.search(body)
+            mem_free = MEM_FREE.search(body)
+            if uptime:
+                uptime = int(uptime.group(1))
+                if last_uptime is not None and uptime < last_uptime:
+                    results["restarts"] += 1
+                last_uptime = uptime
+            if mem_free:
+                results["mem_free"].append(int(mem_free.group(1)))
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            pass
+        await asyncio.sleep(interval)
+
+
+async def load_test(args):
+    results = {"status": defaultdict(Counter), "latency": defaultdict(list), "errors": defaultdict(Counter),
+               "restarts": 0, "mem_free": []}
+    deadline = time.monotonic() + args.duration
+    tasks = [client(args.host, args.port, args.route[i:] + args.route[:i], deadline, args.timeout, results)
+             for i in range(args.concurrency)]
+    tasks.append(monitor(args.host, args.port, deadline, args.timeout, args.monitor_interval, results))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def report(results):
+    """ :return: json serialisable summary of the results """
+    routes = {}
+    for path in set(results["status"]) | set(results["errors"]):
+        latency = results["latency"][path]
+        routes[path] = {"status": {str(k): v for k, v in results["status"][path].items()},
+                        "errors": dict(results["errors"][path]),
+                        "latency_ms": {"p50": round(percentile(latency, 0.5), 1),
+                                       "p99": round(percentile(latency, 0.99), 1),
+                                       "max": round(max(latency, default=0), 1)}}
+    return {"routes": routes,
+            "restarts": results["restarts"],
+            "min_mem_free": min(results["mem_free"], default=None)}
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='web_load.py')
+    parser.add_argument('--host', type=str, required=True,
+                        help='device host name or ip address')
+    parser.add_argument('-p', '--port', type=int, default=80,
+                        help='device web server port')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='test duration in seconds')
+    parser.add_argument('-r', '--route', type=str, action='append',
+                        help='route to request, repeat for a mix of routes')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='connection and response timeout in seconds')
+    parser.add_argument('-m', '--monitor-interval', type=float, default=5,
+                        help='seconds between /metrics polls')
+
+    args = parser.parse_args()
+    if not args.route:
+        args.route = ["/device/state", "/device/state", "/log"]
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    print(json.dumps(report(asyncio.run(load_test(args))), indent=2))
@@ -8,5 +8,4 @@ cp -r rockwren deploy/lib
 rm -r deploy/lib/rockwren/__pycache__
 # Libraries
 cp -r phew/phew deploy/lib
-cd deploy
-../venv/Scripts/mpremote.exe cp -r lib :
+python deploy.py -s deploy/lib -d lib --mpremote venv/Scripts/mpremote.exe
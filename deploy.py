@@ -0,0 +1,241 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Deploy a staged library tree to a device, copying only the files that have changed since the last deploy.
+
+A manifest of file hashes is kept on the device in <destination>/.deploy-manifest.json.  The manifest is compared with
+the staged files, then the changed files are copied, and files removed from the staging tree are deleted, in a single
+mpremote session.  Copies are batched by destination directory.  The manifest is updated last so an interrupted deploy
+is completed by the next one.
+
+Examples:
+    python deploy.py -s build/lib -d lib
+    python deploy.py -s build/lib -d lib -p "rockwren/*.html" -p "rockwren/*.css" -p "rockwren/*.svg"
+    python deploy.py -s build/lib -d lib --directory /tmp/device
+
+--directory deploys to a local directory standing in for the device filesystem.  Use --force to copy every file when
+the files on the device have been changed by other means.
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+MANIFEST = ".deploy-manifest.json"
+SKIP_DIRS = ("__pycache__",)
+""" Maximum number of files copied by one mpremote cp command """
+BATCH_FILES = 16
+
+
+def file_hash(filename):
+    """ :return: the first 16 hex digits of the sha256 hash of the file """
+
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def matches(path, patterns):
+    return not patterns or any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def local_manifest(source, patterns=None):
+    """ :return: dict of path, relative to source with / separators, to hash for the files matching the patterns """
+
+    manifest = {}
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for f in sorted(files):
+            path = os.path.relpath(os.path.join(root, f), source).replace(os.sep, "/")
+            if matches(path, patterns):
+                manifest[path] = file_hash(os.path.join(root, f))
+    return manifest
+
+
+def plan(local, remote, patterns=None):
+    """
+    Compare the staged files with the device manifest.
+    :return: tuple (paths to copy, paths unchanged, paths to remove)
+    """
+    copy = [path for path, h in local.items() if remote.get(path) != h]
+    skip = [path for path, h in local.items() if remote.get(path) == h]
+    remove = [path for path in remote if path not in local and matches(path, patterns)]
+    return copy, skip, remove
+
+
+def directories(dest, paths):
+    """ :return: the directories, parents first, needed on the device for the paths """
+
+    dirs = set()
+    for path in paths:
+        parent = posixpath.dirname(posixpath.join(dest, path))
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = posixpath.dirname(parent)
+    return sorted(dirs, key=lambda d: (d.count("/"), d))
+
+
+class DirectoryTarget:
+    """ A local directory standing in for the device filesystem. """
+
+    def __init__(self, root):
+        self.root = root
+
+    def read_manifest(self, dest):
+        try:
+            with open(os.path.join(self.root, dest, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def apply(self, source, dest, copy, remove, manifest):
+        for d in directories(dest, list(copy) + [MANIFEST]):
+            os.makedirs(os.path.join(self.root, d), exist_ok=True)
+        for path in remove:
+            try:
+                os.remove(os.path.join(self.root, dest, path))
+            except FileNotFoundError:
+                pass
+        for path in copy:
+            shutil.copyfile(os.path.join(source, path), os.path.join(self.root, dest, path))
+        with open(os.path.join(self.root, dest, MANIFEST), "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+
+
+class MpremoteTarget:
+    """ A device connected over serial (or the network) and accessed with mpremote. """
+
+    def __init__(self, mpremote="mpremote", device=None):
+        self.mpremote = mpremote
+        self.device = device
+
+    def command(self, *args):
+        """ :return: the mpremote command line for the args, connecting to the device if one is set """
+
+        command = [self.mpremote]
+        if self.device:
+            command += ["connect", self.device]
+        return command + list(args)
+
+    def run(self, *args):
+        """ Run an mpremote session.  :return: stdout """
+
+        completed = subprocess.run(self.command(*args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if completed.returncode != 0:
+            raise SystemExit(f"mpremote failed: {completed.stderr.decode(errors='replace').strip()}")
+        return completed.stdout.decode(errors="replace")
+
+    def read_manifest(self, dest):
+        output = self.run("exec", "try:\n"
+                                  f" print(open({posixpath.join(dest, MANIFEST)!r}).read())\n"
+                                  "except OSError:\n"
+                                  " print('{}')")
+        return json.loads(output.strip() or "{}")
+
+    def session(self, source, dest, copy, remove, manifest_file):
+        """ :return: the arguments for one mpremote session applying the changes, commands separated by + """
+
+        script = ("import os\n"
+                  f"for d in {directories(dest, list(copy) + [MANIFEST])!r}:\n"
+                  " try:\n"
+                  "  os.mkdir(d)\n"
+                  " except OSError:\n"
+                  "  pass\n"
+                  f"for f in {[posixpath.join(dest, path) for path in remove]!r}:\n"
+                  " try:\n"
+                  "  os.remove(f)\n"
+                  " except OSError:\n"
+                  "  pass\n")
+        args = ["exec", script]
+        batches = {}
+        for path in copy:
+            batches.setdefault(posixpath.dirname(posixpath.join(dest, path)), []).append(os.path.join(source, path))
+        for directory, files in batches.items():
+            for i in range(0, len(files), BATCH_FILES):
+                args += ["+", "cp"] + files[i:i + BATCH_FILES] + [":" + directory + "/"]
+        return args + ["+", "cp", manifest_file, ":" + posixpath.join(dest, MANIFEST)]
+
+    def apply(self, source, dest, copy, remove, manifest):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest_file = os.path.join(tmp, MANIFEST)
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f, separators=(",", ":"))
+            self.run(*self.session(source, dest, copy, remove, manifest_file))
+
+
+def deploy(source, dest, target, patterns=None, force=False, dry_run=False):
+    """
+    Copy the changed files in the source directory to dest on the target.
+    :return: dict report of files and bytes copied, skipped and removed, and the time taken
+    """
+    start = time.monotonic()
+    local = local_manifest(source, patterns)
+    remote = {} if force else target.read_manifest(dest)
+    copy, skip, remove = plan(local, remote, patterns)
+    # Files outside the patterns stay in the manifest
+    manifest = {path: h for path, h in remote.items() if path not in remove}
+    manifest.update(local)
+    if (copy or remove or force) and not dry_run:
+        target.apply(source, dest, copy, remove, manifest)
+
+    def size(paths):
+        return sum(os.stat(os.path.join(source, path)).st_size for path in paths)
+
+    return {"copied": len(copy), "copied_bytes": size(copy), "skipped": len(skip), "skipped_bytes": size(skip),
+            "removed": len(remove), "files": copy, "removed_files": remove, "dry_run": dry_run,
+            "seconds": round(time.monotonic() - start, 3)}
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='deploy.py')
+    parser.add_argument('-s', '--source', type=str, default='build/lib',
+                        help='Staged directory to deploy')
+    parser.add_argument('-d', '--dest', type=str, default='lib',
+                        help='Destination directory on the device')
+    parser.add_argument('-p', '--pattern', action='append', default=None,
+                        help='Only deploy files matching the pattern, relative to the source e.g. "rockwren/*.html".  '
+                             'May be repeated.')
+    parser.add_argument('-c', '--connect', type=str, default=None,
+                        help='mpremote device e.g. /dev/ttyUSB0, default is the first available device')
+    parser.add_argument('--mpremote', type=str, default='mpremote',
+                        help='mpremote command')
+    parser.add_argument('--directory', type=str, default=None,
+                        help='Deploy to a local directory standing in for the device filesystem')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Ignore the device manifest and copy every file')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Report the files that would be copied and removed')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='List the files copied and removed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    if not os.path.isdir(args.source):
+        sys.exit(f"{args.source} is not a directory")
+    target = DirectoryTarget(args.directory) if args.directory else MpremoteTarget(args.mpremote, args.connect)
+    report = deploy(args.source, args.dest.strip("/"), target, args.pattern, args.force, args.dry_run)
+    if args.verbose or args.dry_run:
+        for path in report["files"]:
+            print(f"copy {path}")
+        for path in report["removed_files"]:
+            print(f"remove {path}")
+    print(f"{'Would copy' if args.dry_run else 'Copied'} {report['copied']} files ({report['copied_bytes']} bytes), "
+          f"skipped {report['skipped']} unchanged files ({report['skipped_bytes']} bytes), "
+          f"{'would remove' if args.dry_run else 'removed'} {report['removed']} files in {report['seconds']:.1f}s")
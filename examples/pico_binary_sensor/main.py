@@ -22,7 +22,7 @@ class PicoWBinarySensor(rockwren.Device):
     def __init__(self):
         self.pin = Pin(22, Pin.IN, Pin.PULL_UP)
         self.pin.irq(trigger=Pin.IRQ_FALLING, handler=switch_callback)
-        uasyncio.create_task(self.switch_interrupt_handler())
+        self.create_task(self.switch_interrupt_handler(), "switch_interrupt_handler")
 
         self.led = Pin("LED", Pin.OUT)
         super().__init__(name="PicoWSwitch")  # Always call last
@@ -1,19 +1,22 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
-import ujson
 from machine import ADC
 from machine import Timer
 
+from rockwren import mqtt_client
 from rockwren import rockwren
 
 
 class PicoWTemperature(rockwren.Device):
     """
     Rockwren temperature sensor example.  In this case the the onboard temperature
-    measurement is used.
+    measurement is used.  The temperature is published as a 2 byte fixed point value, in hundredths of a degree,
+    instead of json.
     """
 
+    state_schema = mqtt_client.StateSchema((("temperature", "h", 100),))
+
     def __init__(self):
         self.timer = Timer(period=5000, mode=Timer.PERIODIC, callback=self.timer_callback)
         self.adc = ADC(4)
@@ -30,29 +33,30 @@ class PicoWTemperature(rockwren.Device):
         self.temperature = 27 - (volts - 0.706) / 0.001721
         self.apply_state()
 
-    def device_state(self):
-
-        return ujson.dumps({'temperature': self.temperature})
+    def state_values(self):
+        return {'temperature': self.temperature}
 
     def discovery_function(self):
-        return [("sensor", {"unique_id": f"{self.mqtt_client.device_id}_sensor",
-                            "name": "Pico W Temperature",
-                            "platform": "mqtt",
-                            "state_topic": self.mqtt_client.state_topic,
-                            "unit_of_measurement": "C",
-                            "value_template": "{{ value_json.temperature }}",
-                            "availability": {
-                                "topic": self.mqtt_client.availability_topic
-                            },
-                            "device": {
-                                "identifiers": [self.mqtt_client.device_id],
-                                "name": f"Pico W Temperature",
-                                "sw_version": "1.0",
-                                "model": "",
-                                "manufacturer": "Rockwren",
-                                "configuration_url": f"http://{self.mqtt_client.connection_params['ip_address']}/"
-                            }
-                            })]
+        sensor = {"unique_id": f"{self.mqtt_client.device_id}_sensor",
+                  "name": "Pico W Temperature",
+                  "platform": "mqtt",
+                  "state_topic": self.mqtt_client.state_topic,
+                  "unit_of_measurement": "C",
+                  "availability": {
+                      "topic": self.mqtt_client.availability_topic
+                  },
+                  "device": {
+                      "identifiers": [self.mqtt_client.device_id],
+                      "name": f"Pico W Temperature",
+                      "sw_version": "1.0",
+                      "model": "",
+                      "manufacturer": "Rockwren",
+                      "configuration_url": f"http://{self.mqtt_client.connection_params['ip_address']}/"
+                  }
+                  }
+        # Decode the binary state with the schema's value_template
+        sensor.update(self.state_schema.discovery_options("temperature"))
+        return [("sensor", sensor)]
 
 
 rockwren.fly(PicoWTemperature())
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Push a json configuration document to many rockwren devices concurrently using the ``PUT /config`` API.
+
+Example:
+    python fleet-config.py -c mqtt.json -d devices.txt -n 20
+
+devices.txt contains one device host name or ip address per line.  mqtt.json contains the configuration document e.g.
+    {"mqtt_server": "broker.example.com", "mqtt_port": 1883}
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+
+async def put_config(host, port, document, timeout):
+    """
+    Send the configuration document to a device.
+    :return: tuple (HTTP status code, decoded json response body)
+    :raises ValueError: if the response is not an HTTP response
+    """
+    body = json.dumps(document).encode()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(f"PUT /config HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    try:
+        status = int(head.split(b" ", 2)[1])
+    except (IndexError, ValueError):
+        raise ValueError(f"invalid response {head[:40]!r}")
+    try:
+        return status, json.loads(payload)
+    except ValueError:
+        return status, payload.decode(errors="replace")
+
+
+async def configure_device(pool, host, port, document, timeout, retries):
+    """ Configure a device, retrying on connection failures.  Concurrency is limited by the pool semaphore. """
+    async with pool:
+        start = time.monotonic()
+        for attempt in range(retries + 1):
+            try:
+                status, result = await put_config(host, port, document, timeout)
+                return host, status, result, time.monotonic() - start
+            except ValueError as ex:
+                # Not retried, the device responded
+                return host, None, str(ex), time.monotonic() - start
+            except (OSError, asyncio.TimeoutError) as ex:
+                error = ex
+                await asyncio.sleep(attempt + 1)
+        return host, None, str(error), time.monotonic() - start
+
+
+async def configure_fleet(hosts, port, document, concurrency, timeout, retries):
+    """ Configure all devices with at most ``concurrency`` connections open at once. """
+    pool = asyncio.Semaphore(concurrency)
+    tasks = [configure_device(pool, host, port, document, timeout, retries) for host in hosts]
+    failures = 0
+    for task in asyncio.as_completed(tasks):
+        host, status, result, elapsed = await task
+        if status == 200 and isinstance(result, dict):
+            print(f"{host}: {result['action']} {json.dumps(result['changed'])} [{elapsed:.1f}s]")
+        else:
+            failures += 1
+            print(f"{host}: FAILED {status} {result} [{elapsed:.1f}s]")
+    print(f"Configured {len(hosts) - failures} of {len(hosts)} devices")
+    return failures
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='fleet-config.py')
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help='json configuration document')
+    parser.add_argument('-d', '--devices', type=str, required=True,
+                        help='file of device host names or ip addresses, one per line')
+    parser.add_argument('-p', '--port', type=int, default=80,
+                        help='device web server port')
+    parser.add_argument('-n', '--concurrency', type=int, default=10,
+                        help='maximum number of devices configured at once')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='connection and response timeout in seconds')
+    parser.add_argument('-r', '--retries', type=int, default=2,
+                        help='retries per device on connection failure')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.devices) as f:
+        devices = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    sys.exit(1 if asyncio.run(configure_fleet(devices, args.port, config, args.concurrency, args.timeout,
+                                              args.retries)) else 0)
@@ -1,74 +1,75 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
-import argparse
-import os
-import tarfile
-from pathlib import Path
-from pprint import pprint
-from urllib.request import urlretrieve
-
-from pypi_json import PyPIJSON
-
-
-def tar_members_stripped(tar, levels_stripped=1):
-    members = []
-    for member in tar.getmembers():
-        p = Path(member.path)
-        member.path = p.relative_to(*p.parts[:levels_stripped])
-        members.append(member)
-    return members
-
-
-def download_and_extract(package_name, outdir):
-
-    print(f"download_and_extract({package_name})")
-    filename = None
-    url = None
+"""
+Stage library packages from their sdists, pinned in libs.lock.json, into the output directory.
 
-    with PyPIJSON() as client:
-        requests_metadata = client.get_metadata(package_name)
-        pkg = ''
-        for i in range(len(requests_metadata.urls)):
-            if requests_metadata.urls[i]['packagetype'] == 'sdist':
-                pkg = requests_metadata.urls[i]
-                break
+Examples:
+    python get-libs.py -o build/lib -m micropython-ccrighton-phew -m micropython_umqtt.simple2
+    python get-libs.py --update-lock -m micropython-ccrighton-phew
+    python get-libs.py --offline --index /srv/sdists -o build/lib -m micropython-ccrighton-phew
+    python get-libs.py --export /srv/sdists
 
-        pprint(pkg)
-        filename = pkg['filename']
-        url = pkg['url']
-
-    package_filename = 'deploy/' + filename
-
-    urlretrieve(url, package_filename)
+Packages are fetched through the local package cache, see packagecache.py, and extracted in parallel.
+"""
+import argparse
+import os
+import shutil
+import sys
 
-    # open file
-    with tarfile.open(package_filename) as f:
-        print(f.getmembers())
-        f.extractall(path=outdir, members=tar_members_stripped(f, 1))
+import packagecache
 
 
 def parse_args():
     """Parse the args."""
     parser = argparse.ArgumentParser(
         description='get-libs.py')
-    parser.add_argument('-o', '--outdir', type=str, required=True,
+    parser.add_argument('-o', '--outdir', type=str,
                         default='build/lib',
                         help='Output directory for module')
-    parser.add_argument('-m', '--module', type=str, required=True,
-                        help='Module name')
+    parser.add_argument('-m', '--module', type=str, action='append', default=[],
+                        help='Module name.  May be repeated.')
+    parser.add_argument('--lock', type=str, default=packagecache.LOCK_FILE,
+                        help='Lock file of pinned sdist hashes')
+    parser.add_argument('--update-lock', action='store_true',
+                        help='Pin the latest sdist on PyPI of each module, or every locked module if none are given')
+    parser.add_argument('--cache', type=str, default=packagecache.CACHE_DIR,
+                        help='Package cache directory')
+    parser.add_argument('--index', type=str, default=packagecache.INDEX_DIR,
+                        help='Local directory index of sdist files')
+    parser.add_argument('--offline', action='store_true', default=packagecache.OFFLINE,
+                        help='Resolve packages from the cache and local directory index only')
+    parser.add_argument('--export', type=str, default=None,
+                        help='Copy the locked sdists from the cache to a directory for use as an offline index')
 
     return parser.parse_args()
 
 
+def normalise(name):
+    return name.lower().replace('_', '-')
+
+
 if __name__ == '__main__':
 
     args = parse_args()
 
+    lock = packagecache.load_lock(args.lock)
+    # Lock file keys are normalised package names, e.g. micropython_umqtt.simple2 is micropython-umqtt.simple2
+    modules = [normalise(m) for m in args.module]
     try:
-        os.makedirs(args.outdir)
-    except Exception as e:
-        pprint(e)
-        pass
-
-    download_and_extract(args.module, args.outdir)
+        if args.update_lock:
+            for name in modules or list(lock):
+                lock[name] = packagecache.pypi_sdist(name)
+                print(f"{name} {lock[name]['version']}: {lock[name]['sha256']}")
+            packagecache.save_lock(lock, args.lock)
+        elif args.export:
+            os.makedirs(args.export, exist_ok=True)
+            for name in modules or list(lock):
+                archive, source = packagecache.resolve(name, lock[name], args.cache, args.index, args.offline)
+                shutil.copyfile(archive, os.path.join(args.export, lock[name]['filename']))
+                print(f"{name} {lock[name]['version']}: {source}, exported {lock[name]['filename']}")
+        else:
+            for line in packagecache.stage_packages(modules, args.outdir, lock, args.cache, args.index, args.offline):
+                print(line)
+    except (packagecache.PackageError, OSError) as ex:
+        sys.exit(str(ex))
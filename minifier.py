@@ -1,34 +1,147 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Minify the python, html, css and javascript files of a module directory in place.  Used by the build (setup.py) and
+from the command line:
+
+    python minifier.py -d rockwren
+
+Files are minified in parallel by a process pool.  Minified output is cached in a local directory keyed by a hash of
+the file content, minifier and minifier version, so unchanged files are not minified again.  The cache directory is
+.minify-cache next to this file unless set with ROCKWREN_MINIFY_CACHE.  Set ROCKWREN_MINIFY_CACHE= (empty) to disable
+the cache.
+"""
 import argparse
+import hashlib
 import os
-from pprint import pprint
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
 
+import minify_html
 import python_minifier
 
+CACHE_DIR = os.environ.get("ROCKWREN_MINIFY_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                   ".minify-cache"))
+PY_SUFFIXES = ('py',)
+HTML_CSS_JS_SUFFIXES = ('html', 'css', 'js')
+""" Minifier and its distribution name, for the version, by kind of file """
+MINIFIERS = {"py": "python-minifier", "html": "minify-html"}
+MINIFY_HTML_OPTIONS = {"minify_js": True, "remove_processing_instructions": True}
 
-def minify(directory):
 
-    files = [directory + '/' + f for f in os.listdir(directory)
-             if os.path.isfile(directory + '/' + f) and f.endswith('py')]
+def minify_source(kind, source):
+    """ :return: tuple (minified source, seconds taken) """
 
-    total_size = 0
-    total_minified_size = 0
+    start = time.perf_counter()
+    if kind == "py":
+        minified = python_minifier.minify(source)
+    else:
+        minified = minify_html.minify(source, **MINIFY_HTML_OPTIONS)
+    return minified, time.perf_counter() - start
+
+
+def cache_key(kind, source):
+    """ :return: hash of the source, minifier, minifier version and options """
+
+    tool = MINIFIERS[kind]
+    options = repr(sorted(MINIFY_HTML_OPTIONS.items())) if kind == "html" else ""
+    h = hashlib.sha256(f"{tool}\0{metadata.version(tool)}\0{options}\0".encode())
+    h.update(source.encode())
+    return h.hexdigest()
+
+
+def cache_get(cache_dir, key):
+    """ :return: the cached minified source or None if not cached """
+
+    if not cache_dir:
+        return None
+    try:
+        with open(os.path.join(cache_dir, key), encoding="utf-8", newline="") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cache_put(cache_dir, key, minified):
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, key)
+    with open(filename + ".tmp", "w", encoding="utf-8", newline="") as f:
+        f.write(minified)
+    os.replace(filename + ".tmp", filename)
+
+
+def minify_files(files, kind, cache_dir=CACHE_DIR, workers=None):
+    """ Minify the files in place.  Cache misses are minified by a pool of worker processes, by default one per cpu.
+        :return: dict of file name to minified size
+    """
 
+    start = time.perf_counter()
+    sizes = {}
+    results = {}
+    misses = []
     for filename in files:
-        size = os.stat(filename).st_size
-        minified_size = 0
-        minified = None
         with open(filename) as f:
-            minified = python_minifier.minify(f.read())
-            minified_size = len(minified)
-            total_size += size
+            source = f.read()
+        sizes[filename] = os.stat(filename).st_size
+        key = cache_key(kind, source)
+        minified = cache_get(cache_dir, key)
+        if minified is None:
+            misses.append((filename, source, key))
+        else:
+            results[filename] = (minified, None)
+
+    sources = [source for _, source, _ in misses]
+    if len(misses) > 1 and workers != 1:
+        with ProcessPoolExecutor(workers) as pool:
+            minified = list(pool.map(minify_source, [kind] * len(sources), sources))
+    else:
+        minified = [minify_source(kind, source) for source in sources]
+    for (filename, _, key), result in zip(misses, minified):
+        cache_put(cache_dir, key, result[0])
+        results[filename] = result
+
+    total_size = 0
+    total_minified_size = 0
+    minified_sizes = {}
+    for filename in files:
+        minified, seconds = results[filename]
         with open(filename, 'w') as f:
             f.write(minified)
+        size = sizes[filename]
+        minified_size = len(minified)
+        minified_sizes[filename] = minified_size
+        total_size += size
         total_minified_size += minified_size
-        print(f"{filename}: Size: {total_size}, minified size: {total_minified_size}, "
-              f"%{total_minified_size / total_size * 100:.0f}")
+        timing = "cached" if seconds is None else f"{seconds * 1000:.0f} ms"
+        print(f"{filename}: Size: {size}, minified size: {minified_size}, "
+              f"%{minified_size / size * 100 if size else 100:.0f}, {timing}")
+    if files:
+        print(f"{os.path.dirname(files[0])}/*.{','.join(PY_SUFFIXES if kind == 'py' else HTML_CSS_JS_SUFFIXES)}: "
+              f"Size: {total_size}, minified size: {total_minified_size}, "
+              f"%{total_minified_size / total_size * 100 if total_size else 100:.0f}, "
+              f"{len(files) - len(misses)} of {len(files)} cached, {(time.perf_counter() - start) * 1000:.0f} ms")
+    return minified_sizes
+
+
+def files_with_suffix(directory, suffixes):
+    return [directory + '/' + f for f in sorted(os.listdir(directory))
+            if os.path.isfile(directory + '/' + f) and f.endswith(suffixes)]
+
+
+def minify_py_dir(directory, cache_dir=CACHE_DIR, workers=None):
+    """ Minify all the python files in directory. """
+
+    return minify_files(files_with_suffix(directory, PY_SUFFIXES), "py", cache_dir, workers)
+
+
+def minify_html_css_js_dir(directory, cache_dir=CACHE_DIR, workers=None):
+    """ Minify all html, css, and javascript files in the directory. """
+
+    return minify_files(files_with_suffix(directory, HTML_CSS_JS_SUFFIXES), "html", cache_dir, workers)
 
 
 def parse_args():
@@ -37,6 +150,14 @@ def parse_args():
         description='minifier.py')
     parser.add_argument('-d', '--directory', type=str, required=True,
                         help='Directory of module to minify')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes, default one per cpu')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Minify every file without reading or writing the cache')
+    parser.add_argument('--html', action='store_true',
+                        help='Only minify the html, css and javascript files')
+    parser.add_argument('--py', action='store_true',
+                        help='Only minify the python files')
 
     return parser.parse_args()
 
@@ -45,4 +166,8 @@ if __name__ == '__main__':
 
     args = parse_args()
 
-    minify(args.directory)
+    cache = None if args.no_cache else CACHE_DIR
+    if not args.py:
+        minify_html_css_js_dir(args.directory, cache, args.jobs)
+    if not args.html:
+        minify_py_dir(args.directory, cache, args.jobs)
@@ -1,37 +1,12 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Minify the html, css and javascript files of a module directory in place.  Equivalent to ``minifier.py --html``.
+"""
 import argparse
-import os
 
-import minify_html
-
-
-def minify_file(filename):
-    with open(filename, 'r') as f:
-        minified = minify_html.minify(f.read(), minify_js=True, remove_processing_instructions=True)
-        minified_size = len(minified)
-    with open(filename, 'w') as f:
-        f.seek(0)
-        f.write(minified)
-    return minified_size
-
-
-def minify(directory):
-
-    files = [directory + '/' + f for f in os.listdir(directory) if os.path.isfile(directory + '/' + f)
-             and (f.endswith('html') or f.endswith('css') or f.endswith('js'))]
-
-    total_size = 0
-    total_minified_size = 0
-
-    for filename in files:
-        size = os.stat(filename).st_size
-        minified_size = minify_file(filename)
-        total_size += size
-        total_minified_size += minified_size
-        print(f"{filename}: Size: {total_size}, minified size: {total_minified_size}, "
-              f"%{total_minified_size / total_size * 100:.0f}")
+import minifier
 
 
 def parse_args():
@@ -48,4 +23,4 @@ if __name__ == '__main__':
 
     args = parse_args()
 
-    minify(args.directory)
+    minifier.minify_html_css_js_dir(args.directory)
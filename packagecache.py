@@ -0,0 +1,187 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Content addressed package cache used by get-libs.py and unpack.py to stage libraries in build/lib.
+
+Package sdists are pinned by sha256 in libs.lock.json.  A locked sdist is found, in order, in the local cache, in a
+local directory index (a directory of sdist files) or downloaded from PyPI, then verified and stored in the cache as
+<cache>/sha256/<hash>.  In offline mode PyPI is never used.  The cache directory is ~/.cache/rockwren/packages unless set
+with ROCKWREN_PACKAGE_CACHE.  ROCKWREN_PACKAGE_INDEX sets the local directory index and ROCKWREN_OFFLINE=1 sets offline
+mode.
+
+Staging extracts an sdist in a single pass over the tar and records a stamp in <outdir>/../.staged so an unchanged
+package is not extracted again.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+CACHE_DIR = os.environ.get("ROCKWREN_PACKAGE_CACHE", os.path.expanduser("~/.cache/rockwren/packages"))
+INDEX_DIR = os.environ.get("ROCKWREN_PACKAGE_INDEX")
+OFFLINE = os.environ.get("ROCKWREN_OFFLINE", "0") not in ("", "0")
+PYPI_URL = "https://pypi.org/pypi"
+LOCK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libs.lock.json")
+
+
+class PackageError(Exception):
+    pass
+
+
+def sha256_file(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_lock(lock_file=LOCK_FILE):
+    """ :return: dict of package name to dict of version, filename, url and sha256 """
+
+    try:
+        with open(lock_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_lock(lock, lock_file=LOCK_FILE):
+    with open(lock_file, "w") as f:
+        json.dump(dict(sorted(lock.items())), f, indent=2)
+        f.write("\n")
+
+
+def pypi_sdist(name, index_url=PYPI_URL):
+    """ :return: lock entry for the latest sdist of the package on PyPI """
+
+    with urlopen(f"{index_url}/{name}/json") as response:
+        metadata = json.load(response)
+    for url in metadata["urls"]:
+        if url["packagetype"] == "sdist":
+            return {"version": metadata["info"]["version"], "filename": url["filename"], "url": url["url"],
+                    "sha256": url["digests"]["sha256"]}
+    raise PackageError(f"{name} has no sdist on PyPI")
+
+
+def cache_path(cache_dir, sha256):
+    return os.path.join(cache_dir, "sha256", sha256)
+
+
+def cache_add(cache_dir, filename, sha256, move=False):
+    """ Verify the file has the sha256 hash and add it to the cache.  :return: the cache path """
+
+    actual = sha256_file(filename)
+    if actual != sha256:
+        raise PackageError(f"{filename} sha256 {actual} does not match the lock file {sha256}")
+    path = cache_path(cache_dir, sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if move:
+        shutil.move(filename, tmp)
+    else:
+        shutil.copyfile(filename, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def resolve(name, entry, cache_dir=CACHE_DIR, index_dir=INDEX_DIR, offline=OFFLINE):
+    """
+    Find the locked sdist for the package.
+    :return: tuple (path of the sdist in the cache, where it was found: cache, index or download)
+    """
+    path = cache_path(cache_dir, entry["sha256"])
+    if os.path.isfile(path):
+        return path, "cache"
+    if index_dir and os.path.isfile(os.path.join(index_dir, entry["filename"])):
+        return cache_add(cache_dir, os.path.join(index_dir, entry["filename"]), entry["sha256"]), "index"
+    if offline:
+        raise PackageError(f"{name} {entry['filename']} is not in the cache {cache_dir} or the index {index_dir}")
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+        with urlopen(entry["url"]) as response:
+            shutil.copyfileobj(response, f)
+    try:
+        return cache_add(cache_dir, f.name, entry["sha256"], move=True), "download"
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+
+def extract(archive, outdir, prefix=None):
+    """
+    Extract the sdist in one pass over the tar, stripping the top level directory.  Only members under prefix, e.g.
+    "rockwren/", are extracted if set.
+    :return: list of extracted file paths relative to outdir
+    """
+    files = []
+    with tarfile.open(archive, "r|*") as tar:
+        for member in tar:
+            _, _, path = member.name.partition("/")
+            if not path or (prefix and not path.startswith(prefix)):
+                continue
+            member.name = path
+            tar.extract(member, outdir, filter='data')
+            if member.isfile():
+                files.append(path)
+    return files
+
+
+def stamp_file(outdir, name):
+    return os.path.join(os.path.dirname(os.path.abspath(outdir)), ".staged", name + ".json")
+
+
+def stage(name, archive, outdir, prefix=None, sha256=None):
+    """
+    Extract the sdist into outdir unless the same sdist was already extracted and its files are still there.
+    :return: number of files extracted, 0 if already staged
+    """
+    sha256 = sha256 or sha256_file(archive)
+    stamp = stamp_file(outdir, name)
+    try:
+        with open(stamp) as f:
+            staged = json.load(f)
+        if staged["sha256"] == sha256 and staged["prefix"] == prefix and \
+                all(os.path.isfile(os.path.join(outdir, path)) for path in staged["files"]):
+            return 0
+    except (OSError, ValueError, KeyError):
+        pass
+    os.makedirs(outdir, exist_ok=True)
+    # Packages staged in parallel may share files e.g. umqtt/__init__.py.  Extract to a temporary directory then
+    # replace each file in outdir atomically.
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outdir))) as tmp:
+        files = extract(archive, tmp, prefix)
+        for path in files:
+            os.makedirs(os.path.dirname(os.path.join(outdir, path)), exist_ok=True)
+            os.replace(os.path.join(tmp, path), os.path.join(outdir, path))
+    os.makedirs(os.path.dirname(stamp), exist_ok=True)
+    with open(stamp, "w") as f:
+        json.dump({"sha256": sha256, "prefix": prefix, "files": files}, f)
+    return len(files)
+
+
+def fetch_and_stage(name, entry, outdir, cache_dir=CACHE_DIR, index_dir=INDEX_DIR, offline=OFFLINE):
+    """ :return: report line for the package """
+
+    start = time.monotonic()
+    archive, source = resolve(name, entry, cache_dir, index_dir, offline)
+    extracted = stage(name, archive, outdir, sha256=entry["sha256"])
+    result = f"extracted {extracted} files" if extracted else "up to date"
+    return f"{name} {entry['version']}: {source}, {result}, {(time.monotonic() - start) * 1000:.0f} ms"
+
+
+def stage_packages(names, outdir, lock, cache_dir=CACHE_DIR, index_dir=INDEX_DIR, offline=OFFLINE):
+    """ Fetch and extract the locked packages in parallel.  :return: list of report lines """
+
+    missing = [name for name in names if name not in lock]
+    if missing:
+        raise PackageError(f"{', '.join(missing)} not in the lock file, run get-libs.py --update-lock")
+    with ThreadPoolExecutor(max(1, len(names))) as pool:
+        return list(pool.map(lambda name: fetch_and_stage(name, lock[name], outdir, cache_dir, index_dir, offline),
+                             names))
@@ -14,6 +14,7 @@ from micropython import const
 from phew import logging
 from phew import server
 from phew import template
+from . import logsink
 from . import networking
 from . import utils
 
@@ -51,19 +52,21 @@ def wifi_setup(request):
     network_list = []
     try:
         if sys.platform != 'esp8266':
-            network_list = networking.scan_networks(ap)
+            network_list = networking.cached_networks(ap, "refresh" in request.query)
     except:
         pass
 
     return template.render_template(dir_path + "/wifi_setup.html",
                                     web_path=dir_path,
                                     networks=network_list,
+                                    scanning=networking.scan_in_progress(),
                                     error=message)
 
 
 async def delayed_restart(delay_secs):
     """ Co-routine for delayed restart """
     await uasyncio.sleep(delay_secs)
+    logsink.flush()
     machine.reset()
 
 
@@ -110,6 +113,9 @@ def start_ap():
     logging.info('Access point active')
     logging.info(ap.ifconfig())
 
+    if sys.platform != 'esp8266':
+        networking.request_scan(ap)
+
     try:
         accesspointapp.run()
     except Exception as ex:
@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+MQTT client certificate and private key stored on flash in DER format.
+
+The PEM certificate and key saved with the MQTT configuration are converted to DER once, when saved, and written to
+binary files.  Only the DER is kept, the PEM text is not saved with the configuration.  The files are read only while
+connecting to the MQTT server, so neither the PEM text nor the DER credentials are kept in RAM between connections.
+"""
+import os
+
+from . import utils
+
+CERT_FILE = "mqtt_client_cert.der"
+KEY_FILE = "mqtt_client_key.der"
+""" Configuration key -> DER file """
+FILES = {"mqtt_client_cert": CERT_FILE, "mqtt_client_key": KEY_FILE}
+
+
+def _exists(filename: str) -> bool:
+    try:
+        os.stat(filename)
+        return True
+    except OSError:
+        return False
+
+
+def save(key: str, pem: str) -> bool:
+    """
+    Convert a PEM certificate or key to DER and write it to its file.  The file is removed if pem is empty.
+    :param key: configuration key, ``mqtt_client_cert`` or ``mqtt_client_key``
+    :param pem: PEM formatted certificate or key
+    :return: True if the stored certificate or key changed
+    :raises ValueError: if the PEM is not valid base64, nothing is written
+    """
+    filename = FILES[key]
+    if not pem:
+        if _exists(filename):
+            os.remove(filename)
+            return True
+        return False
+    der = utils.pem_to_der(pem)
+    if _exists(filename):
+        with open(filename, "rb") as f:
+            if f.read() == der:
+                return False
+    with open(filename + ".tmp", "wb") as f:
+        f.write(der)
+    os.rename(filename + ".tmp", filename)
+    return True
+
+
+def stored(key: str) -> bool:
+    """ :return: True if the certificate or key for the configuration key is stored """
+    return _exists(FILES[key])
+
+
+def migrate(database) -> None:
+    """ Convert PEM credentials saved by an earlier version to DER files, once.  The PEM text is then removed from
+        the configuration so only the DER is kept.
+        :param database: the loaded configuration ``JsonDB`` """
+    converted = False
+    for key in FILES:
+        if key in database:
+            if database[key] and not stored(key):
+                save(key, database[key])
+            del database[key]
+            converted = True
+    if converted:
+        database.save()
+
+
+def ssl_params():
+    """ :return: ssl parameters with the DER certificate and key read from flash, or None if they are not stored """
+    if not (stored("mqtt_client_cert") and stored("mqtt_client_key")):
+        return None
+    with open(KEY_FILE, "rb") as f:
+        key = f.read()
+    with open(CERT_FILE, "rb") as f:
+        cert = f.read()
+    return {"key": key, "cert": cert, "server_side": False}
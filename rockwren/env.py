@@ -7,9 +7,20 @@ SSID = ''
 FIRST_BOOT = False
 MQTT_SERVER = ''
 MQTT_PORT = 0
-MQTT_CLIENT_CERT = None
-MQTT_CLIENT_KEY = None
 PUBLISH_INTERVAL = const(10)
 MQTT_KEEPALIVE = const(15)
 CONNECTION_PARAMS = []
 LIGHT_STATE = ""
+LOG_LEVEL = "debug"
+PROFILE = False
+HEAP_TRACKING = False
+DIAGNOSTICS_INTERVAL = const(60)
+WEB_MAX_CLIENTS = 2
+WEB_QUEUE_LENGTH = 4
+WEB_MIN_FREE = {}
+DISCOVERY_MODE = "entity"
+DISCOVERY_RETAIN = True
+DISCOVERY_JITTER = const(10)
+GROUPS = []
+GROUP_JITTER_MS = const(2000)
+DNS_TTL = const(300)
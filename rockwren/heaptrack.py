@@ -0,0 +1,60 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Opt-in heap usage tracking for web routes and MQTT topic handlers.
+
+``gc.mem_alloc()`` is sampled before and after each web route and MQTT topic handler.  The largest increase is
+recorded as the maximum net allocation for the endpoint.  This is not a high water mark: memory allocated and released
+within the handler is not seen.  A decrease means a garbage collection ran while the endpoint was being handled and is
+counted, the net allocation of those calls is not known.  Endpoints with the largest net allocation are the likely
+cause of a ``MemoryError``.
+
+Heap tracking is enabled by setting ``"heap_tracking": true`` in env.json.
+"""
+import gc
+
+from micropython import const
+
+enabled = False
+
+""" Per endpoint statistics indices """
+_CALLS = const(0)
+_NET_MAX = const(1)
+_GCS = const(2)
+_endpoints = {}  # endpoint name -> [calls, maximum net allocation bytes, gc count]
+
+
+def begin() -> int:
+    """ :return: heap allocation at the start of handling an endpoint, or 0 if heap tracking is disabled """
+    return gc.mem_alloc() if enabled else 0
+
+
+def end(name, start: int) -> None:
+    """
+    Record the heap allocation of an endpoint.
+    :param name: endpoint name e.g. route path or mqtt topic
+    :param start: value returned by ``begin()``
+    """
+    if not enabled:
+        return
+    alloc = gc.mem_alloc()
+    stats = _endpoints.get(name)
+    if stats is None:
+        stats = _endpoints[name] = [0, 0, 0]
+    stats[_CALLS] += 1
+    if alloc < start:
+        stats[_GCS] += 1
+    elif alloc - start > stats[_NET_MAX]:
+        stats[_NET_MAX] = alloc - start
+
+
+def top(count=5) -> list:
+    """
+    :param count: number of endpoints to return
+    :return: list of (name, calls, maximum net allocation bytes, gc count) tuples, largest net allocation first
+    """
+    result = [(name if isinstance(name, str) else name.decode(), stats[_CALLS], stats[_NET_MAX], stats[_GCS])
+              for name, stats in _endpoints.items()]
+    result.sort(key=lambda endpoint: endpoint[2], reverse=True)
+    return result[:count]
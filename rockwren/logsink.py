@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Buffered, size capped log sink.
+
+Log lines are held in a fixed size in-RAM ring buffer and written to flash in a single batch by a periodic
+co-routine, or when the buffer fills.  The log file is rotated across ``FILE_COUNT`` files once it exceeds
+``MAX_FILE_SIZE`` bytes so that logs can never fill the filesystem.  Installing the sink routes phew's logging
+through it so the web server and the rockwren modules all benefit without changing their logging calls.
+"""
+import gc
+import os
+
+import machine
+import uasyncio
+from micropython import const
+
+from phew import logging
+from . import profiler
+
+LOG_FILE = "/log.txt"
+MAX_FILE_SIZE = const(8 * 1024)
+FILE_COUNT = const(3)
+BUFFER_LINES = const(32)
+FLUSH_INTERVAL = const(5)
+
+""" Log levels in increasing order of severity, named as used by phew.logging """
+LEVELS = ("debug", "info", "warning", "error", "exception")
+
+_buffer = [None] * BUFFER_LINES
+_head = 0  # index of the oldest buffered line
+_count = 0  # number of buffered lines
+_threshold = 0  # index into LEVELS of the lowest level recorded
+
+
+def install() -> None:
+    """ Route phew's logging through the log sink. phew.logging.log is looked up on every call so replacing it
+        redirects all phew and rockwren logging. """
+    logging.log = log
+
+
+def set_level(level: str) -> bool:
+    """
+    Set the minimum level of log messages that are recorded.
+    :param level: one of ``LEVELS``
+    :return: True if the level was valid and applied, otherwise False
+    """
+    global _threshold
+    if level not in LEVELS:
+        return False
+    _threshold = LEVELS.index(level)
+    return True
+
+
+def get_level() -> str:
+    """ :return: the current minimum log level """
+    return LEVELS[_threshold]
+
+
+def _datetime_string() -> str:
+    dt = machine.RTC().datetime()
+    return "{0:04d}-{1:02d}-{2:02d} {4:02d}:{5:02d}:{6:02d}".format(*dt)
+
+
+def log(level: str, text: str) -> None:
+    """
+    Record a log line in the ring buffer. Compatible with ``phew.logging.log``.
+    The buffer is flushed to flash when it becomes full.  If the flush fails the oldest line is dropped.
+    :param level: log level name
+    :param text: log message
+    """
+    global _head, _count
+    if level in LEVELS and LEVELS.index(level) < _threshold:
+        return
+    entry = "{0} [{1:8} /{2:>4}kB] {3}".format(_datetime_string(), level, round(gc.mem_free() / 1024), text)
+    print(entry)
+    _buffer[(_head + _count) % BUFFER_LINES] = entry
+    _count += 1
+    if _count == BUFFER_LINES:
+        try:
+            flush()
+        except OSError as ex:
+            print(f"logsink: flush failed {ex}")
+        if _count == BUFFER_LINES:
+            # Not written, drop the oldest line to make room for the next
+            _buffer[_head] = None
+            _head = (_head + 1) % BUFFER_LINES
+            _count -= 1
+
+
+def _file_size(filename: str) -> int:
+    try:
+        return os.stat(filename)[6]
+    except OSError:
+        return 0
+
+
+def rotate() -> None:
+    """ Rotate the log files: log.txt -> log.txt.1 -> ... -> log.txt.<FILE_COUNT - 1>, discarding the oldest. """
+    for index in range(FILE_COUNT - 1, 0, -1):
+        older = f"{LOG_FILE}.{index}"
+        newer = LOG_FILE if index == 1 else f"{LOG_FILE}.{index - 1}"
+        try:
+            os.remove(older)
+        except OSError:
+            pass
+        try:
+            os.rename(newer, older)
+        except OSError:
+            pass
+    if FILE_COUNT <= 1:
+        try:
+            os.remove(LOG_FILE)
+        except OSError:
+            pass
+
+
+def flush() -> None:
+    """ Write all buffered log lines to the log file in one write and rotate if the size cap is exceeded. """
+    global _head, _count
+    if _count == 0:
+        return
+    if _file_size(LOG_FILE) >= MAX_FILE_SIZE:
+        rotate()
+    with open(LOG_FILE, "a") as log_file:
+        while _count:
+            log_file.write(_buffer[_head])
+            log_file.write("\n")
+            _buffer[_head] = None
+            _head = (_head + 1) % BUFFER_LINES
+            _count -= 1
+
+
+async def flush_task(interval=FLUSH_INTERVAL) -> None:
+    """ Co-routine to periodically flush buffered log lines to flash. """
+    while True:
+        await uasyncio.sleep(interval)
+        try:
+            flush()
+        except OSError as ex:
+            print(f"logsink: flush failed {ex}")
+
+
+def run(loop) -> None:
+    """ Run the periodic flush as a task in the asyncio loop """
+    loop.create_task(profiler.task("log_flush", flush_task()))
@@ -0,0 +1,167 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Runtime counters and gauges exposed in the Prometheus text format on the ``/metrics`` route.
+
+Counters are preallocated and indexed by constant so recording a value does not allocate on the heap.  Per route
+web statistics are allocated once when the route is registered.
+"""
+import gc
+import os
+import time
+
+import uasyncio
+from micropython import const
+
+MQTT_PUBLISHES = const(0)
+MQTT_COMMANDS = const(1)
+MQTT_DROPPED_COMMANDS = const(2)
+MQTT_RECONNECTS = const(3)
+WEB_REJECTED = const(4)
+WEB_CACHE_HITS = const(5)
+WEB_CACHE_MISSES = const(6)
+MQTT_TLS_RESUMED = const(7)
+DNS_HITS = const(8)
+DNS_MISSES = const(9)
+DNS_FALLBACKS = const(10)
+DNS_FAILURES = const(11)
+_COUNTER_NAMES = ("rockwren_mqtt_publishes_total",
+                  "rockwren_mqtt_commands_total",
+                  "rockwren_mqtt_dropped_commands_total",
+                  "rockwren_mqtt_reconnects_total",
+                  "rockwren_web_rejected_total",
+                  "rockwren_web_cache_hits_total",
+                  "rockwren_web_cache_misses_total",
+                  "rockwren_mqtt_tls_resumed_total",
+                  "rockwren_dns_cache_hits_total",
+                  "rockwren_dns_cache_misses_total",
+                  "rockwren_dns_fallbacks_total",
+                  "rockwren_dns_refresh_failures_total")
+_counters = [0] * len(_COUNTER_NAMES)
+
+""" Per route statistics indices """
+_REQUESTS = const(0)
+_LATENCY_SUM = const(1)
+_LATENCY_MAX = const(2)
+_routes = {}  # route path -> [requests, latency sum ms, latency max ms]
+_route_status = {}  # route path -> {status code: count}
+
+LAG_INTERVAL_MS = const(100)
+_loop_lag = [0, 0]  # last lag ms, max lag ms
+_uptime_ms = 0
+_mqtt_connect = [0, 0]  # last connect ms, max connect ms
+
+
+def inc(counter: int, value=1) -> None:
+    """
+    Increment a counter.
+    :param counter: counter index e.g. ``metrics.MQTT_PUBLISHES``
+    :param value: amount to increment by
+    """
+    _counters[counter] += value
+
+
+def get(counter: int) -> int:
+    """ :return: the current value of the counter """
+    return _counters[counter]
+
+
+def register_route(path: str) -> None:
+    """ Allocate the statistics for a web route.  Called once when the route is registered. """
+    if path not in _routes:
+        _routes[path] = [0, 0, 0]
+        _route_status[path] = {}
+
+
+def web_request(path: str, status: int, elapsed_ms: int) -> None:
+    """
+    Record a completed web request.
+    :param path: route path as registered
+    :param status: HTTP status code of the response
+    :param elapsed_ms: time taken to handle the request
+    """
+    stats = _routes.get(path)
+    if stats is None:
+        return
+    stats[_REQUESTS] += 1
+    stats[_LATENCY_SUM] += elapsed_ms
+    if elapsed_ms > stats[_LATENCY_MAX]:
+        stats[_LATENCY_MAX] = elapsed_ms
+    statuses = _route_status[path]
+    statuses[status] = statuses.get(status, 0) + 1
+
+
+def mqtt_connect(elapsed_ms: int) -> None:
+    """ Record the time taken to connect to the MQTT server, including the TLS handshake. """
+    _mqtt_connect[0] = elapsed_ms
+    if elapsed_ms > _mqtt_connect[1]:
+        _mqtt_connect[1] = elapsed_ms
+
+
+def loop_lag() -> tuple:
+    """ :return: (last, max) event loop scheduling lag in ms """
+    return _loop_lag[0], _loop_lag[1]
+
+
+def uptime() -> int:
+    """ :return: uptime in seconds as measured by the loop lag monitor """
+    return _uptime_ms // 1000
+
+
+async def lag_monitor() -> None:
+    """ Co-routine measuring how late the event loop wakes a sleeping task.  Also accumulates uptime. """
+    global _uptime_ms
+    while True:
+        start = time.ticks_ms()
+        await uasyncio.sleep_ms(LAG_INTERVAL_MS)
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        _uptime_ms += elapsed
+        lag = max(0, elapsed - LAG_INTERVAL_MS)
+        _loop_lag[0] = lag
+        if lag > _loop_lag[1]:
+            _loop_lag[1] = lag
+
+
+def run(loop) -> None:
+    """ Run the loop lag monitor as a task in the asyncio loop """
+    loop.create_task(lag_monitor())
+
+
+def _flash_free() -> int:
+    stats = os.statvfs('/')
+    return stats[0] * stats[3]
+
+
+def render():
+    """ Generator yielding the metrics in the Prometheus text exposition format. """
+    yield "# TYPE rockwren_uptime_seconds gauge\n"
+    yield f"rockwren_uptime_seconds {uptime()}\n"
+    yield "# TYPE rockwren_mem_free_bytes gauge\n"
+    yield f"rockwren_mem_free_bytes {gc.mem_free()}\n"
+    yield "# TYPE rockwren_mem_alloc_bytes gauge\n"
+    yield f"rockwren_mem_alloc_bytes {gc.mem_alloc()}\n"
+    yield "# TYPE rockwren_flash_free_bytes gauge\n"
+    yield f"rockwren_flash_free_bytes {_flash_free()}\n"
+    yield "# TYPE rockwren_loop_lag_ms gauge\n"
+    yield f"rockwren_loop_lag_ms {_loop_lag[0]}\n"
+    yield "# TYPE rockwren_loop_lag_max_ms gauge\n"
+    yield f"rockwren_loop_lag_max_ms {_loop_lag[1]}\n"
+    yield "# TYPE rockwren_mqtt_connect_ms gauge\n"
+    yield f"rockwren_mqtt_connect_ms {_mqtt_connect[0]}\n"
+    yield "# TYPE rockwren_mqtt_connect_max_ms gauge\n"
+    yield f"rockwren_mqtt_connect_max_ms {_mqtt_connect[1]}\n"
+    for index, name in enumerate(_COUNTER_NAMES):
+        yield f"# TYPE {name} counter\n"
+        yield f"{name} {_counters[index]}\n"
+    yield "# TYPE rockwren_web_requests_total counter\n"
+    for path, statuses in _route_status.items():
+        for status, count in statuses.items():
+            yield f'rockwren_web_requests_total{{route="{path}",status="{status}"}} {count}\n'
+    yield "# TYPE rockwren_web_latency_ms summary\n"
+    for path, stats in _routes.items():
+        yield f'rockwren_web_latency_ms_sum{{route="{path}"}} {stats[_LATENCY_SUM]}\n'
+        yield f'rockwren_web_latency_ms_count{{route="{path}"}} {stats[_REQUESTS]}\n'
+    yield "# TYPE rockwren_web_latency_ms_max gauge\n"
+    for path, stats in _routes.items():
+        yield f'rockwren_web_latency_ms_max{{route="{path}"}} {stats[_LATENCY_MAX]}\n'
@@ -6,6 +6,7 @@ MQTT device integration for Home Assistant discovery, connection, reconnection,
 and command handling for a device.
 """
 import io
+import struct
 import sys
 import time
 
@@ -16,9 +17,186 @@ import ujson
 from umqtt.robust2 import MQTTClient
 
 from phew import logging
+from . import credentials
 from . import env
+from . import heaptrack
+from . import metrics
+from . import networking
+from . import profiler
 from . import rockwren
 from . import utils
+from .version import __version__
+
+""" Home Assistant discovery message formats: one message per device listing its components, or one per entity """
+DISCOVERY_DEVICE = "device"
+DISCOVERY_ENTITY = "entity"
+DISCOVERY_MODES = (DISCOVERY_DEVICE, DISCOVERY_ENTITY)
+""" Options that are sent once at the root of a device discovery message when all components have the same value """
+SHARED_DISCOVERY_OPTIONS = ("availability", "availability_topic", "availability_mode", "state_topic",
+                            "command_topic", "qos", "encoding")
+DISCOVERY_ORIGIN = {"name": "rockwren", "sw": __version__}
+""" Home Assistant publishes online to its status (birth) topic when it starts """
+HA_STATUS_TOPIC = b"homeassistant/status"
+
+
+class TopicTrie:
+    """
+    MQTT topic filters mapped to topic handlers.  Filters may contain ``+`` (one level) and ``#`` (remaining levels)
+    wildcards.  Filters without wildcards are found with one dictionary lookup.  Wildcard filters are kept in a trie
+    with a node per level, so matching a topic visits each topic level once per matching branch however many
+    filters there are.  As for MQTT subscriptions, wildcards in the first level do not match topics beginning with
+    ``$``.
+    """
+
+    def __init__(self):
+        self._exact = {}  # topic -> [handler]
+        self._root = ({}, [])  # trie node (children by level, [handler])
+        self._filters = {}  # topic filter -> qos
+
+    def add(self, topic_filter: bytes, handler, qos=0) -> None:
+        """
+        :param topic_filter: topic, which may contain ``+`` and ``#`` wildcards
+        :param handler: topic handler function
+        :param qos: subscription QoS for the topic filter, the highest of its handlers is used
+        """
+        if b"+" in topic_filter or b"#" in topic_filter:
+            node = self._root
+            for level in topic_filter.split(b"/"):
+                child = node[0].get(level)
+                if child is None:
+                    child = node[0][level] = ({}, [])
+                node = child
+            node[1].append(handler)
+        else:
+            self._exact.setdefault(topic_filter, []).append(handler)
+        self._filters[topic_filter] = max(qos, self._filters.get(topic_filter, 0))
+
+    def remove(self, topic_filter: bytes, handler=None) -> None:
+        """ Remove the handler, or all handlers if None, of the topic filter. """
+        if topic_filter in self._exact:
+            handlers = self._exact[topic_filter]
+        else:
+            path = [self._root]
+            for level in topic_filter.split(b"/"):
+                child = path[-1][0].get(level)
+                if child is None:
+                    return
+                path.append(child)
+            handlers = path[-1][1]
+        if handler is None:
+            handlers.clear()
+        elif handler in handlers:
+            handlers.remove(handler)
+        if handlers:
+            return
+        self._filters.pop(topic_filter, None)
+        if topic_filter in self._exact:
+            del self._exact[topic_filter]
+            return
+        # Prune the nodes left without handlers or children
+        levels = topic_filter.split(b"/")
+        for index in range(len(levels), 0, -1):
+            node = path[index]
+            if node[0] or node[1]:
+                break
+            del path[index - 1][0][levels[index - 1]]
+
+    def match(self, topic: bytes) -> list:
+        """ :return: handlers of all the topic filters matching the topic """
+        handlers = self._exact.get(topic, [])
+        if not self._root[0]:
+            return handlers
+        handlers = list(handlers)
+        nodes = [self._root]
+        levels = topic.split(b"/")
+        wildcards = not topic.startswith(b"$")
+        for level in levels:
+            matched = []
+            for children, _ in nodes:
+                child = children.get(level)
+                if child is not None:
+                    matched.append(child)
+                if wildcards:
+                    child = children.get(b"+")
+                    if child is not None:
+                        matched.append(child)
+                    child = children.get(b"#")
+                    if child is not None:
+                        handlers.extend(child[1])
+            if not matched:
+                return handlers
+            nodes = matched
+            wildcards = True
+        for children, node_handlers in nodes:
+            handlers.extend(node_handlers)
+            # a/# also matches a
+            child = children.get(b"#")
+            if child is not None:
+                handlers.extend(child[1])
+        return handlers
+
+    def filters(self) -> dict:
+        """ :return: dict of topic filter to subscription QoS """
+        return self._filters
+
+
+class StateSchema:
+    """
+    Fixed layout binary encoding of the device state, an opt-in alternative to json for devices publishing state at
+    a high rate.  The schema declares each state value's struct format character and, for fixed point values, a
+    scale, e.g. ``StateSchema((("temperature", "h", 100), ("humidity", "B")))`` encodes a temperature of 21.47 as the
+    integer 2147.  The values are packed in order, without keys, little endian by default.  Home Assistant decodes
+    a value with the ``unpack`` template filter, see ``discovery_options``.
+    """
+
+    def __init__(self, fields, byte_order="<"):
+        """
+        :param fields: sequence of (key, struct format character) or (key, struct format character, scale)
+        :param byte_order: struct byte order character
+        """
+        self.format = byte_order
+        self._fields = []  # (key, format, offset, scale)
+        for field in fields:
+            offset = struct.calcsize(self.format)
+            self.format += field[1]
+            self._fields.append((field[0], byte_order + field[1], offset, field[2] if len(field) > 2 else 1))
+        self.size = struct.calcsize(self.format)
+        self._buffer = bytearray(self.size)
+
+    def encode(self, values: dict) -> bytearray:
+        """
+        Pack the state values into the schema's buffer.  The buffer is preallocated and reused by the next encode, so
+        publish it before encoding again.
+        :param values: dict of state values with a value for each key of the schema
+        :return: the encoded state
+        """
+        for key, fmt, offset, scale in self._fields:
+            value = values[key]
+            if fmt[1] not in "efd":
+                value = int(round(value * scale)) if scale != 1 else int(value)
+            struct.pack_into(fmt, self._buffer, offset, value)
+        return self._buffer
+
+    def decode(self, payload) -> dict:
+        """ :return: dict of the state values in an encoded state """
+        values = {}
+        for key, fmt, offset, scale in self._fields:
+            value = struct.unpack_from(fmt, payload, offset)[0]
+            values[key] = value / scale if scale != 1 else value
+        return values
+
+    def value_template(self, key: str) -> str:
+        """ :return: Home Assistant template decoding the state value from a raw state payload """
+        for field_key, fmt, offset, scale in self._fields:
+            if field_key == key:
+                template = f"value | unpack('{fmt}', offset={offset})"
+                return f"{{{{ ({template}) / {scale} }}}}" if scale != 1 else f"{{{{ {template} }}}}"
+        raise KeyError(key)
+
+    def discovery_options(self, key: str) -> dict:
+        """ :return: discovery message options for a Home Assistant entity showing the state value.  The empty
+            ``encoding`` passes the payload to the template as bytes. """
+        return {"encoding": "", "value_template": self.value_template(key)}
 
 
 def noop_topic_handler(topic, message):
@@ -39,9 +217,9 @@ class MqttDevice:
     - https://www.home-assistant.io/integrations/switch.mqtt/
     """
 
-    def __init__(self, device: rockwren.Device, mqtt_server, connection_params, state_topic=b"/state",
+    def __init__(self, device: "rockwren.Device", mqtt_server, connection_params, state_topic=b"/state",
                  command_topic=b"/command", availability_topic=b"/LWT", command_handler=noop_topic_handler,
-                 mqtt_port=0, client_id=b"rockwren"):
+                 mqtt_port=0, client_id=b"rockwren", diagnostics_topic=b"/diagnostics"):
         self.device = device  # Switch, light etc.
         # Register this client with the device
         self.device.register_mqtt_client(self)
@@ -56,11 +234,20 @@ class MqttDevice:
         self.device_id = self.client_id + b"_" + self.unique_id
 
         self.device_topic = self.client_id + b'/' + self.unique_id
-        self._topic_handlers = {}
+        self._topic_handlers = TopicTrie()
+        self._mqtt_client = None
+        self._tls_session = None
+        self._tls_resume = True
         self.state_topic = self.device_topic + state_topic
         self.command_topic = self.device_topic + command_topic
         self.availability_topic = self.device_topic + availability_topic
+        self.diagnostics_topic = self.device_topic + diagnostics_topic
+        self._command_handler = command_handler
         self.register_topic_handler(command_topic, command_handler)
+        self._groups = []
+        # ticks_ms when the state is published after a group command, None if not due
+        self._state_due = None
+        self.set_groups(env.GROUPS)
 
         # populate discovery functions from the device
         # List of (device_type, discovery_json) tuples
@@ -68,19 +255,33 @@ class MqttDevice:
 
         self._publish_interval = env.PUBLISH_INTERVAL
         self._last_publish = 0
-        self._mqtt_client = None
+        self._last_diagnostics = 0
         self.status = {}
         self._status_reported = True
         self._commands = []
         self._max_commands = 10
+        self._rediscover = False
+        # Reconnect, e.g. to a new server, without a connection issue reported by the client
+        self._reconnect = False
+        # Serialized discovery messages, list of (topic, payload), for the discovery mode
+        self._discovery_payloads = None
+        self._discovery_payloads_mode = None
+        # ticks_ms when the discovery messages are resent after a Home Assistant restart, None if not due
+        self._discovery_due = None
 
     def subscription_callback(self, topic, msg, retained, duplicate):
         """ Received messages from subscribed topics will be delivered to this callback """
-        topic = topic
-        if topic not in self._topic_handlers.keys():
+        if topic == HA_STATUS_TOPIC:
+            # A retained birth message predates this connection, the discovery messages were sent on connecting
+            if msg == b"online" and not retained:
+                self.schedule_discovery()
+            return
+        if not self._topic_handlers.match(topic):
             # Not a registered command topic
             return
+        metrics.inc(metrics.MQTT_COMMANDS)
         if len(self._commands) > self._max_commands:
+            metrics.inc(metrics.MQTT_DROPPED_COMMANDS)
             logging.error(f"subscription_callback: Command queue full, discarding. {topic} {msg.decode()}")
             return
         decoded_msg = ""
@@ -93,12 +294,63 @@ class MqttDevice:
         # Push the (topic, message) tuple
         self._commands.append((topic, decoded_msg))
 
-    def register_topic_handler(self, topic_suffix: bytes, topic_handler) -> None:
+    def register_topic_handler(self, topic_suffix: bytes, topic_handler, qos=0) -> None:
         """
-        :param topic_suffix: Suffix to associate with the topic_handler function
+        :param topic_suffix: Suffix of the device topic to associate with the topic_handler function, may contain
+                             ``+`` and ``#`` wildcards e.g. ``b"/sensor/+/set"``
         :param topic_handler:  Topic handler function
+        :param qos: subscription QoS, 0 or 1
+        """
+        self.subscribe(self.device_topic + topic_suffix, topic_handler, qos)
+
+    def subscribe(self, topic_filter: bytes, topic_handler, qos=0) -> None:
+        """
+        Handle messages on any topic.  Topics outside the device topic are subscribed separately and resubscribed on
+        reconnection.  A topic matching several topic filters is handled by each of their handlers.
+        :param topic_filter: topic, may contain ``+`` and ``#`` wildcards e.g. ``b"rockwren/group/+/command"``
+        :param topic_handler: Topic handler function
+        :param qos: subscription QoS, 0 or 1
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS {qos}")
+        self._topic_handlers.add(topic_filter, topic_handler, qos)
+        if self._mqtt_client is not None:
+            subscription = self.subscription(topic_filter)
+            self._mqtt_client.subscribe(subscription, self.subscriptions()[subscription])
+
+    def unsubscribe(self, topic_filter: bytes, topic_handler=None) -> None:
+        """
+        Stop handling messages on the topic filter.  The broker subscription is kept until the device restarts,
+        messages that no longer have a handler are discarded.
+        :param topic_filter: topic filter passed to ``subscribe``
+        :param topic_handler: handler to remove, or all handlers of the topic filter if None
         """
-        self._topic_handlers[self.device_topic + topic_suffix] = topic_handler
+        self._topic_handlers.remove(topic_filter, topic_handler)
+
+    def subscription(self, topic_filter: bytes) -> bytes:
+        """ :return: the broker subscription receiving the topic filter, the device topic wildcard for topics under
+            the device topic """
+        if topic_filter.startswith(self.device_topic + b"/"):
+            return self.device_topic + b"/#"
+        return topic_filter
+
+    def subscriptions(self) -> dict:
+        """ :return: dict of broker subscription to QoS for the registered topic handlers """
+        subscriptions = {self.device_topic + b"/#": 0}
+        for topic_filter, qos in self._topic_handlers.filters().items():
+            subscription = self.subscription(topic_filter)
+            subscriptions[subscription] = max(qos, subscriptions.get(subscription, 0))
+        return subscriptions
+
+    def publish(self, topic: bytes, msg, retain=False) -> None:
+        """
+        Publish a message to the mqtt server and count it in ``metrics``.
+        :param topic: mqtt topic
+        :param msg: message payload
+        :param retain: retain flag
+        """
+        self._mqtt_client.publish(topic, msg, retain=retain)
+        metrics.inc(metrics.MQTT_PUBLISHES)
 
     def pop_message(self):
         """ Pop the (topic, message) tuple """
@@ -113,69 +365,254 @@ class MqttDevice:
                               command handler are all run as co-routines for this loop.
         """
         logging.info(f"Begin connection with MQTT Broker :: {self.mqtt_server}:{self.mqtt_port}")
-        require_ssl = False
-        ssl_params = None
-
-        if env.MQTT_CLIENT_KEY and env.MQTT_CLIENT_CERT:
-            ssl_params = {"key": utils.pem_to_der(env.MQTT_CLIENT_KEY),
-                          "cert": utils.pem_to_der(env.MQTT_CLIENT_CERT),
-                          "server_side": False}
-            require_ssl = True
+        # TLS with a client certificate when one is stored, the credentials are read when connecting
+        require_ssl = credentials.stored("mqtt_client_cert") and credentials.stored("mqtt_client_key")
 
         self._mqtt_client = MQTTClient(self.device_id, self.mqtt_server,
                                        port=self.mqtt_port, keepalive=env.MQTT_KEEPALIVE,
-                                       ssl=require_ssl, ssl_params=ssl_params)
+                                       ssl=require_ssl, ssl_params={})
         self._mqtt_client.DEBUG = True
 
         self._mqtt_client.set_last_will(self.availability_topic, b'offline', retain=True)
-        self._mqtt_client.connect()
+        self._connect()
 
-        uasyncio.create_task(self.ensure_connection())
-        uasyncio.create_task(self._mqtt_command_handler())
+        uasyncio.create_task(profiler.task("mqtt_reconnect", self.ensure_connection()))
+        uasyncio.create_task(profiler.task("mqtt_handler", self._mqtt_command_handler()))
 
         self._mqtt_client.set_callback(self.subscription_callback)
 
-        self._mqtt_client.subscribe(self.device_topic + b'/#')
-        self._mqtt_client.publish(self.availability_topic, b'online', retain=True)
+        for subscription, qos in self.subscriptions().items():
+            self._mqtt_client.subscribe(subscription, qos)
+        self._mqtt_client.subscribe(HA_STATUS_TOPIC)
+        self.publish(self.availability_topic, b'online', retain=True)
         logging.info(
             f"Connected to MQTT  Broker :: {self.mqtt_server}, and waiting for callback function to be called.")
         self.send_discovery_msgs()
 
+    def _connect(self, reconnect=False) -> None:
+        """
+        Connect, or reconnect, to the MQTT server.  For TLS the DER credentials are read from flash for the handshake
+        and released afterwards.  Where the port's ssl module exposes the TLS session, the session of the last
+        connection is offered so the server can resume it instead of a full handshake.  The time taken is recorded in
+        ``metrics``.  A broker host name is resolved through the ``networking`` DNS cache, so a reconnect does not wait
+        for DNS and survives a DNS outage with the last good address.
+        """
+        client = self._mqtt_client
+        try:
+            client.server = networking.resolve(self.mqtt_server, client.port)
+        except OSError:
+            # Nothing cached yet, the client resolves the host name and reports the connection issue
+            client.server = self.mqtt_server
+        if client.ssl:
+            client.ssl_params = credentials.ssl_params() or {}
+            if client.server != self.mqtt_server:
+                # Server name indication and certificate verification are for the host name, not the address
+                client.ssl_params["server_hostname"] = self.mqtt_server
+            if self._tls_session is not None:
+                client.ssl_params["session"] = self._tls_session
+        start = time.ticks_ms()
+        try:
+            if reconnect:
+                client.reconnect()
+            else:
+                client.connect()
+        except TypeError:
+            # The port's ssl module does not accept a session, stop offering one
+            self._tls_resume = False
+            self._tls_session = None
+            raise
+        finally:
+            client.ssl_params = {}
+        if client.is_conn_issue():
+            # Fall back to a full handshake if the session could not be resumed
+            self._tls_session = None
+            return
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        metrics.mqtt_connect(elapsed)
+        resumed = False
+        if client.ssl:
+            sock = getattr(client, "sock", None)
+            resumed = getattr(sock, "session_reused", False)
+            self._tls_session = getattr(sock, "session", None) if self._tls_resume else None
+            if resumed:
+                metrics.inc(metrics.MQTT_TLS_RESUMED)
+        logging.info(f"MQTT connected in {elapsed} ms{', TLS session resumed' if resumed else ''}")
+
     async def ensure_connection(self):
         """ A asyncio co-routine for reconnecting to mqtt server """
         while True:
-            if self._mqtt_client.is_conn_issue():
-                while self._mqtt_client.is_conn_issue():
+            if self._reconnect or self._mqtt_client.is_conn_issue():
+                while self._reconnect or self._mqtt_client.is_conn_issue():
+                    self._reconnect = False
                     logging.info("mqtt trying to reconnect")
                     await uasyncio.sleep(5)
                     # If the connection is successful, the is_conn_issue
                     # method will not return a connection error.
                     try:
-                        self._mqtt_client.reconnect()
+                        self._connect(reconnect=True)
                     except Exception as ex:
                         trace = io.StringIO()
                         sys.print_exception(ex, trace)
                         utils.logstream(trace)
 
+                metrics.inc(metrics.MQTT_RECONNECTS)
                 # Publish availability status and resubscribe on reconnection
-                self._mqtt_client.publish(self.availability_topic, b'online', retain=True)
+                self.publish(self.availability_topic, b'online', retain=True)
                 self._mqtt_client.resubscribe()
+                if self._rediscover:
+                    self._rediscover = False
+                    self.send_discovery_msgs()
             await uasyncio.sleep(1)
 
+    def reconfigure(self, mqtt_server, mqtt_port=0) -> None:
+        """
+        Change the MQTT server without restarting.  The connection is dropped and re-established by the
+        ``ensure_connection`` co-routine, after which the discovery messages are resent.
+        :param mqtt_server: MQTT server ip address or fqdn
+        :param mqtt_port: MQTT server port, 0 for the default port
+        """
+        logging.info(f"Reconfiguring MQTT Broker :: {mqtt_server}:{mqtt_port}")
+        self.mqtt_server = mqtt_server
+        self.mqtt_port = mqtt_port
+        self._mqtt_client.server = mqtt_server
+        self._mqtt_client.port = mqtt_port if mqtt_port else (8883 if self._mqtt_client.ssl else 1883)
+        self._mqtt_client.disconnect()
+        # ensure_connection reconnects to the new server
+        self._reconnect = True
+        self._rediscover = True
+
+    def group_topic(self, group: str) -> bytes:
+        """ :return: the command topic of the group e.g. ``rockwren/group/kitchen/command`` """
+        return self.client_id + b"/group/" + group.encode() + b"/command"
+
+    def set_groups(self, groups: list) -> None:
+        """
+        Set the groups the device is a member of.  Commands published on a group's command topic are handled by the
+        device's command handler, so one message controls every device in the group.
+        :param groups: list of group names
+        """
+        for group in self._groups:
+            if group not in groups:
+                self.unsubscribe(self.group_topic(group), self._group_command_handler)
+        for group in groups:
+            if group not in self._groups:
+                self.subscribe(self.group_topic(group), self._group_command_handler)
+        self._groups = list(groups)
+
+    def _group_command_handler(self, topic, message) -> None:
+        """ Handle a group command with the device's command handler.  The state is published after the device's
+            delay of up to ``env.GROUP_JITTER_MS``, see ``jitter_ms``, so the group's devices do not all respond at
+            once. """
+        if self._state_due is None:
+            self._state_due = time.ticks_add(time.ticks_ms(), self.jitter_ms(env.GROUP_JITTER_MS))
+        self._command_handler(topic, message)
+
+    def _send_due_state(self) -> None:
+        """ Publish the state delayed by a group command once the jitter delay has passed """
+        if self._state_due is not None and time.ticks_diff(time.ticks_ms(), self._state_due) >= 0:
+            self._state_due = None
+            self.mqtt_publish_state()
+            self._last_publish = time.time()
+
+    def set_publish_interval(self, seconds: int) -> None:
+        """ Set the interval between periodic state publications. """
+        self._publish_interval = seconds
+
     def mqtt_publish_state(self) -> None:
-        """ Publish the current device state on the state topic to the mqtt server """
-        logging.info(f"mqtt: {self.state_topic} {self.device.device_state()}")
-        self._mqtt_client.publish(self.state_topic, self.device.device_state())
+        """ Publish the current device state on the state topic to the mqtt server, encoded with the device's
+            ``state_schema`` if it has one.  Not published while the state is delayed after a group command. """
+        if self._state_due is not None:
+            return
+        schema = self.device.state_schema
+        if schema:
+            payload = schema.encode(self.device.state_values())
+            logging.info(f"mqtt: {self.state_topic} {ubinascii.hexlify(payload).decode()}")
+        else:
+            payload = self.device.device_state()
+            logging.info(f"mqtt: {self.state_topic} {payload}")
+        self.publish(self.state_topic, payload)
         self._status_reported = True
 
+    def device_discovery(self) -> dict:
+        """
+        Consolidate the entity discovery messages from the device's ``discovery_function`` into a single Home
+        Assistant device discovery message.  Each entity becomes a component, the ``device`` blocks are merged into
+        one and options shared by every component are sent once.
+        See https://www.home-assistant.io/integrations/mqtt/#device-discovery-payload
+        :return: device discovery message
+        """
+        device = {}
+        components = {}
+        for device_type, discovery_json in self._discovery_functions:
+            if type(device_type) == bytes:
+                device_type = device_type.decode()
+            component = {}
+            for key, value in discovery_json.items():
+                if key == "device":
+                    for device_key, device_value in value.items():
+                        if device_key not in device:
+                            device[device_key] = device_value
+                elif key != "platform":
+                    component[key] = value
+            component["p"] = device_type
+            components[component.get("unique_id", f"{device_type}_{len(components)}")] = component
+        discovery = {"dev": device, "o": DISCOVERY_ORIGIN, "cmps": components}
+        for option in SHARED_DISCOVERY_OPTIONS if components else ():
+            values = [component.get(option) for component in components.values()]
+            if values[0] is not None and values.count(values[0]) == len(values):
+                discovery[option] = values[0]
+                for component in components.values():
+                    del component[option]
+        return discovery
+
+    def discovery_topics(self, mode=None) -> list:
+        """
+        :param mode: ``DISCOVERY_DEVICE`` or ``DISCOVERY_ENTITY``, default ``env.DISCOVERY_MODE``
+        :return: list of discovery message topics for the device
+        """
+        if (mode or env.DISCOVERY_MODE) == DISCOVERY_DEVICE:
+            return [b"homeassistant/device/" + self.device_id + b"/config"]
+        topics = []
+        for device_type, _ in self._discovery_functions:
+            if type(device_type) != bytes:
+                device_type = device_type.encode()
+            topics.append(b"homeassistant/" + device_type + b"/" + self.device_id + b"/config")
+        return topics
+
+    def discovery_payloads(self) -> list:
+        """
+        The discovery messages are serialized once for the discovery mode and kept for resending.  Call
+        ``refresh_discovery`` when the device's discovery definition changes.
+        :return: list of (topic, payload) discovery messages for ``env.DISCOVERY_MODE``
+        """
+        if self._discovery_payloads is None or self._discovery_payloads_mode != env.DISCOVERY_MODE:
+            # Release the payloads for the previous mode before serializing
+            self._discovery_payloads = None
+            if not self._discovery_functions:
+                # The device has no entities
+                messages = []
+            elif env.DISCOVERY_MODE == DISCOVERY_DEVICE:
+                messages = [self.device_discovery()]
+            else:
+                messages = [discovery_json for _, discovery_json in self._discovery_functions]
+            self._discovery_payloads = [(topic, ujson.dumps(discovery_json))
+                                        for topic, discovery_json in zip(self.discovery_topics(), messages)]
+            self._discovery_payloads_mode = env.DISCOVERY_MODE
+        return self._discovery_payloads
+
+    def refresh_discovery(self) -> None:
+        """ Reload the discovery definition from the device's ``discovery_function``, e.g. after the device name has
+            changed.  The discovery messages are serialized again when next sent. """
+        self._discovery_functions = self.device.discovery_function()
+        self._discovery_payloads = None
+
     def send_discovery_msgs(self):
-        """ Send all registered discovery messages for the device. """
+        """ Send the discovery messages for the device, one per entity unless ``env.DISCOVERY_MODE`` is
+            ``DISCOVERY_DEVICE`` for a single device discovery message.  Retained unless ``env.DISCOVERY_RETAIN`` is False so Home
+            Assistant rediscovers the device when it restarts. """
         try:
-            for device_type, discovery_json in self._discovery_functions:
-                if type(device_type) != bytes:
-                    device_type = device_type.encode()
-                discovery_topic = b"homeassistant/" + device_type + b"/" + self.device_id + b"/config"
-                self._mqtt_client.publish(discovery_topic, ujson.dumps(discovery_json))
+            for discovery_topic, payload in self.discovery_payloads():
+                self.publish(discovery_topic, payload, retain=env.DISCOVERY_RETAIN)
                 logging.info(f"Sending discovery message with topic {discovery_topic}")
         except Exception as ex:
             logging.error(f"Failed to send discovery messages.")
@@ -183,6 +620,38 @@ class MqttDevice:
             sys.print_exception(ex, trace)
             utils.logstream(trace)
 
+    def jitter_ms(self, interval_ms: int) -> int:
+        """ :return: this device's delay, from 0 to interval_ms, before responding to a message received by a fleet
+            of devices, such as the Home Assistant birth message or a group command.  Derived from the ``unique_id``
+            so the fleet is spread across the interval rather than all publishing at once.  The id is hashed as
+            boards from one batch often have consecutive ids. """
+        spread = (int(self.unique_id[-4:].decode(), 16) * 40503) & 0xFFFF  # Fibonacci hash of the low 16 bits
+        return spread * interval_ms >> 16
+
+    def schedule_discovery(self) -> None:
+        """ Resend the discovery messages after the device's delay of up to ``env.DISCOVERY_JITTER`` seconds, see
+            ``jitter_ms`` """
+        if self._discovery_due is None:
+            delay = self.jitter_ms(env.DISCOVERY_JITTER * 1000)
+            self._discovery_due = time.ticks_add(time.ticks_ms(), delay)
+            logging.info(f"Home Assistant online, sending discovery messages in {delay} ms")
+
+    def _send_due_discovery(self) -> None:
+        """ Send the scheduled discovery messages once the jitter delay has passed """
+        if self._discovery_due is not None and time.ticks_diff(time.ticks_ms(), self._discovery_due) >= 0:
+            self._discovery_due = None
+            self.send_discovery_msgs()
+
+    def remove_discovery_msgs(self, mode=None) -> None:
+        """
+        Remove the device from Home Assistant by clearing its discovery messages.  Used when the discovery mode is
+        changed to remove the retained messages in the previous format.
+        :param mode: ``DISCOVERY_DEVICE`` or ``DISCOVERY_ENTITY``, default ``env.DISCOVERY_MODE``
+        """
+        for discovery_topic in self.discovery_topics(mode):
+            self.publish(discovery_topic, b"", retain=True)
+            logging.info(f"Removing discovery message with topic {discovery_topic}")
+
     async def _mqtt_command_handler(self) -> None:
         """ MQTT command handler
             Asyncio co-routine """
@@ -192,30 +661,41 @@ class MqttDevice:
             # Non-blocking wait for message
             self._mqtt_client.check_msg()
 
+            self._send_due_discovery()
+            self._send_due_state()
+
             # Publish state if publish interval has been reached
             current_time = time.time()
             if not self._status_reported or (current_time - self._last_publish) >= self._publish_interval:
                 self.mqtt_publish_state()
                 self._last_publish = current_time
 
+            # Publish profiler diagnostics if enabled and the diagnostics interval has been reached
+            if profiler.enabled and (current_time - self._last_diagnostics) >= env.DIAGNOSTICS_INTERVAL:
+                self.publish(self.diagnostics_topic, ujson.dumps(profiler.report()))
+                self._last_diagnostics = current_time
+
             topic, message = self.pop_message()
             if message is None:
                 continue
 
             logging.debug(f"_mqtt_command_handler: {topic}: {message}")
 
-            handler = self._topic_handlers.get(topic)
+            handlers = self._topic_handlers.match(topic)
 
-            if handler is None:
+            if not handlers:
                 continue
 
-            try:
-                handler(topic, message)
-            except Exception as ex:
-                logging.error(f"Exception during execution of {handler.__name__} for topic {topic})")
-                trace = io.StringIO()
-                sys.print_exception(ex, trace)
-                utils.logstream(trace)
+            heap_start = heaptrack.begin()
+            for handler in handlers:
+                try:
+                    handler(topic, message)
+                except Exception as ex:
+                    logging.error(f"Exception during execution of {handler.__name__} for topic {topic})")
+                    trace = io.StringIO()
+                    sys.print_exception(ex, trace)
+                    utils.logstream(trace)
+            heaptrack.end(topic, heap_start)
 
             self.mqtt_publish_state()
 
@@ -246,8 +726,3 @@ def default_discovery(mqtt_client: MqttDevice):
                        }
                        })]
 
-
-#    def send_remove_discovery(self):
-#            self._mqtt_client.publish(discovery_topic, "")
-#            self._mqtt_client.publish(discovery_topic_button, "")
-#            self._mqtt_client.publish(discovery_topic_sensor, "")
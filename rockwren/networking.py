@@ -6,15 +6,21 @@ Network connectivity methods
 """
 import io
 import sys
+import time
+from socket import getaddrinfo
 from socket import socket
 from time import sleep
 
 import machine
 import network
+import uasyncio
 from micropython import const
 
+from . import credentials
 from . import env
 from . import jsondb
+from . import logsink
+from . import metrics
 from . import secrets
 from . import utils
 from phew import logging
@@ -23,6 +29,44 @@ FIRST_BOOT_KEY = "first_boot"
 SSID_KEY = "ssid"
 PASSWORD_KEY = "password"
 ENV_FILE = "env.json"
+""" Configuration keys accepted by apply_config: key -> (type, env attribute) """
+CONFIG_KEYS = {
+    SSID_KEY: (str, "SSID"),
+    PASSWORD_KEY: (str, None),
+    "mqtt_server": (str, "MQTT_SERVER"),
+    "mqtt_port": (int, "MQTT_PORT"),
+    "mqtt_client_cert": (str, None),
+    "mqtt_client_key": (str, None),
+    "publish_interval": (int, "PUBLISH_INTERVAL"),
+    "log_level": (str, "LOG_LEVEL"),
+    "profile": (bool, "PROFILE"),
+    "heap_tracking": (bool, "HEAP_TRACKING"),
+    "web_max_clients": (int, "WEB_MAX_CLIENTS"),
+    "web_queue_length": (int, "WEB_QUEUE_LENGTH"),
+    "web_min_free": (dict, "WEB_MIN_FREE"),
+    "discovery_mode": (str, "DISCOVERY_MODE"),
+    "discovery_retain": (bool, "DISCOVERY_RETAIN"),
+    "groups": (list, "GROUPS"),
+}
+SECRET_KEYS = (PASSWORD_KEY, "mqtt_client_key")
+""" Configuration keys that only take effect after a restart """
+RESTART_KEYS = (SSID_KEY, PASSWORD_KEY, "mqtt_client_cert", "mqtt_client_key", "profile")
+""" Configuration keys that take effect after reconnecting to the MQTT server """
+RECONNECT_KEYS = ("mqtt_server", "mqtt_port")
+MAX_GROUPS = const(8)
+MAX_GROUP_NAME = const(32)
+DNS_CACHE_FILE = "dns.json"
+""" Seconds between checks for cached addresses that are due to be resolved again """
+DNS_REFRESH_INTERVAL = const(30)
+SCAN_TTL_MS = const(60000)
+SCAN_DELAY_MS = const(500)
+
+_scan_results = []
+_scan_time = None  # ticks_ms of the last completed scan
+_scan_pending = False
+_config_listeners = []
+_dns_cache = None  # host -> [address, time.time() resolved], loaded from DNS_CACHE_FILE when first used
+_dns_refreshing = False  # dns_refresh_task started
 
 
 def connect(hostname='rockwren'):
@@ -109,13 +153,50 @@ def load_network_config():
         except Exception:
             logging.info("mqtt_port not set using default")
         try:
-            env.MQTT_CLIENT_CERT = database["mqtt_client_cert"]
+            # The client certificate and key are kept on flash in DER format, see credentials
+            credentials.migrate(database)
+        except Exception as ex:
+            logging.error(f"mqtt client certificate or key not converted to DER: {ex}")
+        try:
+            env.LOG_LEVEL = database["log_level"]
+        except Exception:
+            logging.info("log_level not set using default")
+        try:
+            env.PROFILE = database["profile"]
+        except Exception:
+            logging.info("profile not set using default")
+        try:
+            env.HEAP_TRACKING = database["heap_tracking"]
+        except Exception:
+            logging.info("heap_tracking not set using default")
+        try:
+            env.PUBLISH_INTERVAL = database["publish_interval"]
+        except Exception:
+            logging.info("publish_interval not set using default")
+        try:
+            env.WEB_MAX_CLIENTS = database["web_max_clients"]
         except Exception:
-            logging.info("mqtt_client_cert not set using default")
+            logging.info("web_max_clients not set using default")
         try:
-            env.MQTT_CLIENT_KEY = database["mqtt_client_key"]
+            env.WEB_QUEUE_LENGTH = database["web_queue_length"]
         except Exception:
-            logging.info("mqtt_client_key not set using default")
+            logging.info("web_queue_length not set using default")
+        try:
+            env.WEB_MIN_FREE = database["web_min_free"]
+        except Exception:
+            logging.info("web_min_free not set using default")
+        try:
+            env.DISCOVERY_MODE = database["discovery_mode"]
+        except Exception:
+            logging.info("discovery_mode not set using default")
+        try:
+            env.DISCOVERY_RETAIN = database["discovery_retain"]
+        except Exception:
+            logging.info("discovery_retain not set using default")
+        try:
+            env.GROUPS = database["groups"]
+        except Exception:
+            logging.info("groups not set using default")
     except Exception as ex:
         logging.error("Exception loading network config: ")
         trace = io.StringIO()
@@ -123,6 +204,20 @@ def load_network_config():
         utils.logstream(trace)
 
 
+def add_config_listener(callback) -> None:
+    """
+    Register a function to be called after configuration is saved to the json db file.
+    :param callback: function called with the list of saved configuration keys
+    """
+    _config_listeners.append(callback)
+
+
+def _config_saved(keys) -> None:
+    """ Notify the configuration listeners that configuration keys were saved. """
+    for callback in _config_listeners:
+        callback(keys)
+
+
 def save_network_config(ssid: str, password: str):
     """ Save network configuration to the json db file"""
     try:
@@ -131,6 +226,7 @@ def save_network_config(ssid: str, password: str):
         database[SSID_KEY] = ssid
         database[PASSWORD_KEY] = password
         database.save()
+        _config_saved([SSID_KEY, PASSWORD_KEY])
     except Exception as ex:
         logging.error("Exception saving network config: ")
         trace = io.StringIO()
@@ -149,6 +245,7 @@ def save_network_config_key(key: str, value) -> None:
         database.load()
         database[key] = value
         database.save()
+        _config_saved([key])
     except Exception as ex:
         logging.error("Exception saving network config: ")
         trace = io.StringIO()
@@ -156,6 +253,123 @@ def save_network_config_key(key: str, value) -> None:
         utils.logstream(trace)
 
 
+def is_ipv4(host: str) -> bool:
+    """ :returns True if host is an IPv4 address """
+    numbers = host.split(".")
+    return len(numbers) == 4 and all(number.isdigit() for number in numbers)
+
+
+def valid_mqtt_server(mqtt_server: str) -> bool:
+    """ :returns True if mqtt_server is an IPv4 address or a fully qualified domain name """
+    if is_ipv4(mqtt_server):
+        return True
+    return utils.is_fqdn(mqtt_server)
+
+
+def valid_group(group) -> bool:
+    """ :returns True if the group name can be used as a level of an MQTT topic """
+    return type(group) == str and 0 < len(group) <= MAX_GROUP_NAME and \
+        not any(c in group for c in "/+#")
+
+
+def _validate_config_value(key: str, value):
+    """ :returns an error message if the value is not valid for the configuration key, otherwise None """
+    expected = CONFIG_KEYS[key][0]
+    if type(value) != expected:
+        return f"expected {expected.__name__}"
+    if key == "mqtt_server" and value and not valid_mqtt_server(value):
+        return "not an IP address or fully qualified domain name"
+    if key == "mqtt_port" and not 0 <= value <= 65535:
+        return "out of range"
+    if key in ("publish_interval", "web_max_clients") and value < 1:
+        return "out of range"
+    if key == "web_queue_length" and value < 0:
+        return "out of range"
+    if key == "web_min_free" and not all(type(free) == int for free in value.values()):
+        return "expected route: int"
+    if key == "log_level" and value not in logsink.LEVELS:
+        return "unknown log level"
+    if key == "discovery_mode" and value not in ("device", "entity"):
+        return "expected device or entity"
+    if key == "groups":
+        if len(value) > MAX_GROUPS:
+            return f"more than {MAX_GROUPS} groups"
+        if not all(valid_group(group) for group in value):
+            return "expected names without /, + or #"
+    if key in credentials.FILES and value:
+        if "-----BEGIN" not in value:
+            return "expected PEM format"
+        try:
+            if not utils.pem_to_der(value):
+                return "empty PEM"
+        except ValueError:
+            return "invalid PEM base64"
+    if key == SSID_KEY and not value:
+        return "empty"
+    return None
+
+
+def validate_config(document: dict) -> dict:
+    """
+    Validate a configuration document.
+    :param document: dictionary of configuration keys and values
+    :return: dictionary of key: error message, empty if the document is valid
+    """
+    errors = {}
+    for key, value in document.items():
+        if key not in CONFIG_KEYS:
+            errors[key] = "unknown key"
+            continue
+        error = _validate_config_value(key, value)
+        if error:
+            errors[key] = error
+    return errors
+
+
+def apply_config(document: dict) -> tuple:
+    """
+    Validate and save a configuration document to the json db file in a single write.  The loaded ``env``
+    values are updated for the changed keys.  Nothing is saved if any value is invalid.
+    :param document: dictionary of configuration keys and values, see ``CONFIG_KEYS``
+    :return: tuple (changed, errors). changed is a dictionary of key: [old value, new value] with secrets
+             masked.  errors is a dictionary of key: error message.
+    """
+    errors = validate_config(document)
+    if errors:
+        return {}, errors
+    database = jsondb.JsonDB(ENV_FILE)
+    database.load()
+    changed = {}
+    for key, value in document.items():
+        if key in credentials.FILES:
+            # Only the DER is kept, the PEM text is not saved with the configuration
+            if credentials.save(key, value):
+                changed[key] = ["***", "***"]
+            continue
+        old = database.get(key)
+        if old == value:
+            continue
+        database[key] = value
+        changed[key] = ["***", "***"] if key in SECRET_KEYS else [old, value]
+        attribute = CONFIG_KEYS[key][1]
+        if key == PASSWORD_KEY:
+            secrets.SSID_PASSWORD = value
+        elif attribute:
+            setattr(env, attribute, value)
+    if SSID_KEY in changed or PASSWORD_KEY in changed:
+        # Fall back to access point mode if the new network can't be joined
+        database[FIRST_BOOT_KEY] = True
+    if changed:
+        database.save()
+        _config_saved(list(changed))
+    return changed, errors
+
+
+def restart_required(changed: dict) -> bool:
+    """ :returns True if any of the changed configuration keys only take effect after a restart """
+    return any(key in changed for key in RESTART_KEYS)
+
+
 def clear_first_boot() -> None:
     """ Clear first boot setting the save in json db """
     database = jsondb.JsonDB(ENV_FILE)
@@ -181,3 +395,134 @@ def scan_networks(net: network.WLAN):
     for w in networks:
         network_list.append((w[0].decode(), w[3]))
     return network_list
+
+
+def scan_in_progress() -> bool:
+    """ :returns True if a background WiFi scan is pending or running """
+    return _scan_pending
+
+
+def request_scan(net: network.WLAN) -> None:
+    """ Start a background WiFi scan unless one is already pending. """
+    global _scan_pending
+    if _scan_pending:
+        return
+    _scan_pending = True
+    uasyncio.create_task(_scan_task(net))
+
+
+async def _scan_task(net: network.WLAN) -> None:
+    """ Co-routine to scan for WiFi networks and cache the results. """
+    global _scan_results, _scan_time, _scan_pending
+    # Let the page that requested the scan be served before the radio blocks the loop
+    await uasyncio.sleep_ms(SCAN_DELAY_MS)
+    try:
+        _scan_results = scan_networks(net)
+        _scan_time = time.ticks_ms()
+    except Exception as ex:
+        logging.error(f"WiFi scan failed: {ex}")
+    finally:
+        _scan_pending = False
+
+
+def cached_networks(net: network.WLAN, refresh=False) -> list:
+    """
+    Return the cached WiFi scan results immediately.  A background scan is started if the results are older than
+    ``SCAN_TTL_MS`` or a refresh is requested.
+    :param net: WLAN interface to scan with
+    :param refresh: force a new scan
+    :return: list of (ssid, rssi) tuples from the last completed scan
+    """
+    if refresh or _scan_time is None or time.ticks_diff(time.ticks_ms(), _scan_time) > SCAN_TTL_MS:
+        request_scan(net)
+    return _scan_results
+
+
+def _load_dns_cache() -> dict:
+    global _dns_cache
+    if _dns_cache is None:
+        try:
+            database = jsondb.JsonDB(DNS_CACHE_FILE)
+            database.load()
+            _dns_cache = dict(database)
+        except Exception:
+            _dns_cache = {}
+    return _dns_cache
+
+
+def _dns_fresh(entry) -> bool:
+    """ :returns True if the cached address was resolved within ``env.DNS_TTL`` seconds """
+    age = time.time() - entry[1]
+    # A negative age is an address resolved before the clock was set by NTP, or on a previous boot
+    return 0 <= age < env.DNS_TTL
+
+
+def _dns_lookup(host: str, port: int):
+    """ Resolve the host and cache the address.  The cache file is only written when the address changes.
+        :return: the address """
+    cache = _load_dns_cache()
+    address = getaddrinfo(host, port)[0][-1][0]
+    previous = cache.get(host)
+    cache[host] = [address, time.time()]
+    if previous is None or previous[0] != address:
+        database = jsondb.JsonDB(DNS_CACHE_FILE)
+        database.update(cache)
+        database.save()
+    return address
+
+
+def resolve(host: str, port=0):
+    """
+    Resolve a host name to an address using the DNS cache.  An address resolved within ``env.DNS_TTL`` seconds is
+    returned without a DNS query.  An expired address is also returned without a query and is resolved again by
+    ``dns_refresh_task``, as ``getaddrinfo`` blocks the event loop for up to the DNS timeout.  The last good address of
+    each host is kept in ``DNS_CACHE_FILE`` so it is available after a restart, only a host that has never been
+    resolved waits for DNS, as the MQTT client would when connecting.  The first host name resolved starts
+    ``dns_refresh_task``.  Hits, misses and fallbacks to an expired address are counted in ``metrics``.
+    :param host: host name or IPv4 address, which is returned unchanged
+    :param port: port to resolve for
+    :return: the address
+    :raises OSError: if the host is not cached and DNS fails
+    """
+    global _dns_refreshing
+    if is_ipv4(host):
+        return host
+    if not _dns_refreshing:
+        # Started by the first host name resolved, which may be after a reconfiguration from an IP address
+        _dns_refreshing = True
+        uasyncio.create_task(dns_refresh_task())
+    entry = _load_dns_cache().get(host)
+    if entry is None:
+        metrics.inc(metrics.DNS_MISSES)
+        return _dns_lookup(host, port)
+    if _dns_fresh(entry):
+        metrics.inc(metrics.DNS_HITS)
+    else:
+        metrics.inc(metrics.DNS_FALLBACKS)
+    return entry[0]
+
+
+async def dns_refresh_task() -> None:
+    """ Co-routine resolving cached host names in the background before they expire, and those that have expired,
+        so that connecting does not wait for DNS.  Failures are counted in ``metrics`` and the cached address is
+        kept. """
+    while True:
+        await uasyncio.sleep(DNS_REFRESH_INTERVAL)
+        for host, entry in list(_load_dns_cache().items()):
+            # Refresh within the last two refresh intervals of the time to live, or once expired
+            if 0 <= time.time() - entry[1] < env.DNS_TTL - 2 * DNS_REFRESH_INTERVAL:
+                continue
+            try:
+                _dns_lookup(host, 0)
+            except OSError as ex:
+                metrics.inc(metrics.DNS_FAILURES)
+                logging.info(f"DNS refresh failed for {host}: {ex}")
+
+
+def dns_stats() -> dict:
+    """ :return: DNS cache statistics and cached addresses """
+    return {"hits": metrics.get(metrics.DNS_HITS),
+            "misses": metrics.get(metrics.DNS_MISSES),
+            "fallbacks": metrics.get(metrics.DNS_FALLBACKS),
+            "failures": metrics.get(metrics.DNS_FAILURES),
+            "cache": {host: entry[0] for host, entry in (_dns_cache or {}).items()}}
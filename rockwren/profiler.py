@@ -0,0 +1,102 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Opt-in event loop profiler.
+
+Tasks registered with ``profiler.task`` record how long they run between yields to the event loop.  A task that
+runs for a long time between yields blocks every other co-routine, including the web server and MQTT handler.
+Event loop scheduling lag is measured by the ``metrics.lag_monitor`` sentinel co-routine.
+
+Profiling is enabled by setting ``"profile": true`` in env.json.  When disabled, registered tasks delegate directly
+to the wrapped co-routine.
+"""
+import time
+
+from micropython import const
+
+from . import metrics
+
+enabled = False
+
+""" Per task statistics indices """
+_RUNS = const(0)
+_TOTAL_US = const(1)
+_MAX_US = const(2)
+_tasks = {}  # task name -> [runs, total us, max us]
+
+
+def _record(stats, start) -> None:
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    stats[_RUNS] += 1
+    stats[_TOTAL_US] += elapsed
+    if elapsed > stats[_MAX_US]:
+        stats[_MAX_US] = elapsed
+
+
+def task(name: str, coro):
+    """
+    Wrap a co-routine so the time it runs between yields is recorded when profiling is enabled.  Whether profiling
+    is enabled is checked when the task first runs, so tasks may be created before the configuration is loaded.
+    :param name: name the statistics are reported under
+    :param coro: co-routine to wrap
+    :return: co-routine to schedule in place of ``coro``
+    """
+    if not enabled:
+        return (yield from coro)
+    stats = _tasks.get(name)
+    if stats is None:
+        stats = _tasks[name] = [0, 0, 0]
+    value = None
+    exc = None
+    while True:
+        start = time.ticks_us()
+        try:
+            if exc is None:
+                value = coro.send(value)
+            else:
+                value = coro.throw(exc)
+        except StopIteration as stop:
+            _record(stats, start)
+            return stop.value
+        _record(stats, start)
+        try:
+            value = yield value
+            exc = None
+        except BaseException as ex:  # e.g. CancelledError thrown in by uasyncio
+            value = None
+            exc = ex
+
+
+def reset() -> None:
+    """ Clear all recorded task statistics. """
+    for stats in _tasks.values():
+        stats[_RUNS] = 0
+        stats[_TOTAL_US] = 0
+        stats[_MAX_US] = 0
+
+
+def report() -> dict:
+    """ :return: dictionary of the loop lag and per task run time statistics """
+    last_lag, max_lag = metrics.loop_lag()
+    tasks = {}
+    for name, stats in _tasks.items():
+        tasks[name] = {"runs": stats[_RUNS],
+                       "avg_us": stats[_TOTAL_US] // stats[_RUNS] if stats[_RUNS] else 0,
+                       "max_us": stats[_MAX_US]}
+    return {"loop_lag_ms": last_lag, "loop_lag_max_ms": max_lag, "tasks": tasks}
+
+
+def render():
+    """ Generator yielding the per task statistics in the Prometheus text exposition format. """
+    if not enabled:
+        return
+    yield "# TYPE rockwren_task_runs_total counter\n"
+    for name, stats in _tasks.items():
+        yield f'rockwren_task_runs_total{{task="{name}"}} {stats[_RUNS]}\n'
+    yield "# TYPE rockwren_task_run_us_sum counter\n"
+    for name, stats in _tasks.items():
+        yield f'rockwren_task_run_us_sum{{task="{name}"}} {stats[_TOTAL_US]}\n'
+    yield "# TYPE rockwren_task_run_us_max gauge\n"
+    for name, stats in _tasks.items():
+        yield f'rockwren_task_run_us_max{{task="{name}"}} {stats[_MAX_US]}\n'
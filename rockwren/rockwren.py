@@ -19,8 +19,12 @@ from phew import logging
 from phew import server
 from . import accesspoint
 from . import env as rockwren_env
+from . import heaptrack
+from . import logsink
+from . import metrics
 from . import mqtt_client
 from . import networking
+from . import profiler
 from . import utils
 from . import web
 from .version import __version__
@@ -34,12 +38,19 @@ class Device:
     device state, handle web ui state changes and so on.
     """
 
+    """ ``mqtt_client.StateSchema`` of ``state_values`` to publish the state in a compact binary encoding instead of
+        json, None for json """
+    state_schema = None
+    """ Number of nested ``web_batch_handler`` calls deferring ``apply_state`` """
+    apply_deferred = 0
+
     def __init__(self, name="RockwrenDevice"):
         self.name = name
         self.state = "OFF"
         self.web = None
         self.mqtt_client: mqtt_client.MqttDevice = None
         self.listeners = []
+        self._static_information = None
         self.apply_state()
         """ HTML template path for use for controlling the device from the web ui. """
         self.template = "/lib/rockwren/controls.html"
@@ -65,6 +76,27 @@ class Device:
         self.apply_state()
         return self.device_state(), 200
 
+    def web_batch_handler(self, commands: list):
+        """ Handle an ordered list of web ui device control changes as a single state change.  Each command is a
+            dictionary of the same fields as a ``web_post_handler`` form.  State is applied and listeners notified
+            once, after all commands have been handled.  Processing stops at the first command that fails.
+            :returns tuple (device state json, HTML response code)
+        """
+        if not commands:
+            return '{"error": "No commands provided."}', 400
+        # Defer applying state so commands only change the device attributes, batches may be nested
+        self.apply_deferred += 1
+        try:
+            for index, form in enumerate(commands):
+                resp, status = self.web_post_handler(form)
+                if status != 200:
+                    return ujson.dumps({"error": resp, "index": index}), status
+        finally:
+            self.apply_deferred -= 1
+            if not self.apply_deferred:
+                self.apply_state()
+        return self.device_state(), 200
+
     def command_handler(self, topic, message):
         """
         Apply the state of the device on change and notify listeners
@@ -78,7 +110,16 @@ class Device:
         frequent state updates to the MQTT server. Overridden for each device that has more capability than on or off.
         :return: device state as json
         """
-        return ujson.dumps({'state': self.state})
+        return ujson.dumps(self.state_values())
+
+    def state_values(self) -> dict:
+        """
+        Return the device state values.  Used by `mqtt_client` to publish the state encoded with ``state_schema``
+        when the device declares one.  Overridden with ``state_schema`` for each device that has more capability than
+        on or off.
+        :return: dict of device state values
+        """
+        return {'state': self.state}
 
     def information(self) -> str:
         """
@@ -87,14 +128,17 @@ class Device:
         from this function then add to it to provide addition information.
         :return: device state as json
         """
-        return ujson.dumps({'device': {
-            'name': self.name,
-            'rockwren_version': __version__,
-            'unique_id': ubinascii.hexlify(machine.unique_id()),
-            'platform': sys.platform,
-            'python_version': sys.version,
-            'implementation': str(sys.implementation),
-        },
+        if self._static_information is None:
+            # Fixed for the life of the device so only built once
+            self._static_information = {
+                'name': self.name,
+                'rockwren_version': __version__,
+                'unique_id': ubinascii.hexlify(machine.unique_id()),
+                'platform': sys.platform,
+                'python_version': sys.version,
+                'implementation': str(sys.implementation),
+            }
+        info = {'device': dict(self._static_information),
             'mqtt': {
             'server': rockwren_env.MQTT_SERVER,
             'port': rockwren_env.MQTT_PORT,
@@ -108,8 +152,12 @@ class Device:
             'subnet_mask': rockwren_env.CONNECTION_PARAMS.get("subnet_mask"),
             'gateway': rockwren_env.CONNECTION_PARAMS.get("gateway"),
             'dns_server': rockwren_env.CONNECTION_PARAMS["dns_server"],
+            'dns_cache': networking.dns_stats(),
         }
-        })
+        }
+        if profiler.enabled:
+            info['profile'] = profiler.report()
+        return ujson.dumps(info)
 
     def on(self):
         """ Update the device state to ON.  Override or extend when needed.
@@ -141,8 +189,12 @@ class Device:
     def apply_state(self):
         """
         Apply the state of the device on change and notify listeners
-        The implementation must call ``super.apply_state()`` last.
+        The implementation must call ``super.apply_state()`` last.  While ``apply_deferred`` is non-zero, during
+        ``web_batch_handler``, listeners are not notified and an implementation may skip applying the state, it is
+        applied once when the batch is complete.
         """
+        if self.apply_deferred:
+            return
         self.notify_listeners()
 
     def notify_listeners(self):
@@ -153,6 +205,15 @@ class Device:
         for listener in self.listeners:
             uasyncio.create_task(listener_task(listener))
 
+    def create_task(self, coro, name=None):
+        """
+        Create a device task in the asyncio loop.  The task is timed by the profiler when profiling is enabled.
+        :param coro: co-routine to run
+        :param name: name to report profiling statistics under, defaults to the device class name
+        :return: the created task
+        """
+        return uasyncio.create_task(profiler.task(name if name else type(self).__name__, coro))
+
     def register_listener(self, func):
         """
         Register state change listener functions.
@@ -167,7 +228,7 @@ class Device:
         """
         self.web = _web
 
-    def register_mqtt_client(self, _mqtt_client: mqtt_client.MqttDevice) -> None:
+    def register_mqtt_client(self, _mqtt_client: "mqtt_client.MqttDevice") -> None:
         """
         Register the ``mqtt_client``
         :param _mqtt_client:
@@ -188,6 +249,7 @@ def set_global_exception(loop):
         trace = io.StringIO()
         sys.print_exception(context["exception"], trace)
         utils.logstream(trace)
+        logsink.flush()
         raise context["exception"]
     loop.set_exception_handler(handle_exception)
 
@@ -218,29 +280,38 @@ def fly(the_device: Device):
 
         web.device = the_device
 
+        logsink.install()
+
         stats = os.statvfs('/')
         logging.info(f"Free storage: {stats[0]*stats[3]/1024} KB")
 
         networking.load_network_config()
+        logsink.set_level(rockwren_env.LOG_LEVEL)
+        profiler.enabled = rockwren_env.PROFILE
+        heaptrack.enabled = rockwren_env.HEAP_TRACKING
 
         # Initial wifi setup via access point
         if rockwren_env.SSID == '':
             try:
                 set_global_exception(uasyncio.get_event_loop())
+                logsink.run(uasyncio.get_event_loop())
                 accesspoint.start_ap()
             except Exception as ex:
                 trace = io.StringIO()
                 sys.print_exception(ex, trace)
                 utils.logstream(trace)
             finally:
+                logsink.flush()
                 sys.exit()
 
         # Normal operation with Wifi setup
         try:
             set_global_exception(uasyncio.get_event_loop())
+            logsink.run(uasyncio.get_event_loop())
+            metrics.run(uasyncio.get_event_loop())
             rockwren_env.CONNECTION_PARAMS = networking.connect()
 
-            uasyncio.create_task(ntptime_retries())
+            uasyncio.create_task(profiler.task("ntptime", ntptime_retries()))
 
             if rockwren_env.MQTT_SERVER:
                 logging.info("MQTT client starting.")
@@ -256,6 +327,7 @@ def fly(the_device: Device):
             uasyncio.get_event_loop().run_forever()
         except KeyboardInterrupt:
             logging.info('Keyboard interrupt at loop level.')
+            logsink.flush()
             break
         except Exception as ex:
             try:
@@ -264,6 +336,7 @@ def fly(the_device: Device):
                 utils.logstream(trace)
                 uasyncio.new_event_loop()  # Clear retained state
             finally:
+                logsink.flush()
                 machine.reset()
 
 
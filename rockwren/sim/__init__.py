@@ -0,0 +1,191 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host simulator for running rockwren devices on CPython.
+
+Stand-ins for the MicroPython modules used by rockwren and phew are installed in ``sys.modules`` so an application
+boots through ``rockwren.fly()`` on Linux.  The WiFi connection always succeeds, MQTT uses the ``umqtt.robust2``
+stand-in against a local broker, and the web UI is served on localhost.
+
+    python -m rockwren.sim examples/pico_switch/main.py --http-port 8080
+
+phew must be installed on the host: ``pip install micropython-ccrighton-phew``.  The simulator is not included in
+the distribution.
+"""
+import binascii
+import gc
+import io
+import json
+import os
+import runpy
+import select
+import socket
+import struct
+import sys
+import time
+import traceback
+import types
+
+from . import machine
+from . import micropython
+from . import mqtt
+from . import network
+from . import ntptime
+from . import uasyncio
+from . import ujson
+
+""" Nominal heap reported by gc.mem_free() and gc.mem_alloc() """
+HEAP_SIZE = 192 * 1024
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+""" Path of the rockwren package on the device filesystem """
+DEVICE_PACKAGE_DIR = "/lib/rockwren"
+
+_start = time.monotonic_ns()
+
+
+def _ticks_ms() -> int:
+    return (time.monotonic_ns() - _start) // 1000000
+
+
+def _ticks_us() -> int:
+    return (time.monotonic_ns() - _start) // 1000
+
+
+def _print_exception(exc, file=sys.stdout) -> None:
+    traceback.print_exception(type(exc), exc, exc.__traceback__, file=file)
+
+
+def _iterate(generator):
+    """ Iterate an async generator that never awaits, such as phew's ``render_template`` on CPython. """
+    while True:
+        try:
+            generator.asend(None).send(None)
+        except StopIteration as item:
+            yield item.value
+        except StopAsyncIteration:
+            return
+
+
+def _synchronous(render_template):
+    def render(*args, **kwargs):
+        return _iterate(render_template(*args, **kwargs))
+    return render
+
+
+def install() -> None:
+    """ Install the MicroPython stand-ins.  Must be called before rockwren or phew modules are imported. """
+    if sys.modules.get("machine") is machine:
+        return
+    umqtt = types.ModuleType("umqtt")
+    umqtt.robust2 = umqtt.simple2 = mqtt
+    sys.modules.update({"machine": machine,
+                        "micropython": micropython,
+                        "network": network,
+                        "ntptime": ntptime,
+                        "uasyncio": uasyncio,
+                        "umqtt": umqtt,
+                        "umqtt.robust2": mqtt,
+                        "umqtt.simple2": mqtt,
+                        "ubinascii": binascii,
+                        "uio": io,
+                        "ujson": ujson,
+                        "uos": os,
+                        "uselect": select,
+                        "usocket": socket,
+                        "ustruct": struct,
+                        "utime": time})
+
+    # MicroPython extensions to the time, gc and sys modules
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_diff = lambda end, start: end - start
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    gc.mem_alloc = lambda: HEAP_SIZE // 4
+    gc.mem_free = lambda: HEAP_SIZE - gc.mem_alloc()
+    gc.threshold = lambda amount=None: -1 if amount is None else None
+    sys.print_exception = _print_exception
+
+    # Profiled tasks are generators that delegate to co-routines, which CPython only allows in a generator based
+    # co-routine
+    from .. import profiler
+    profiler.task = types.coroutine(profiler.task)
+
+    try:
+        from phew import template
+    except ImportError:
+        pass
+    else:
+        template.render_template = _synchronous(template.render_template)
+
+
+def host_path(path: str, app_dir: str) -> str:
+    """ :return: the host path of a file on the device filesystem """
+    if path.startswith(DEVICE_PACKAGE_DIR + "/"):
+        return os.path.join(PACKAGE_DIR, path[len(DEVICE_PACKAGE_DIR) + 1:])
+    if path.startswith("/"):
+        return os.path.join(app_dir, path[1:])
+    return path
+
+
+def provision(mqtt_server: str, mqtt_port: int, ssid="rockwren-sim") -> None:
+    """ Write the network and MQTT configuration to env.json in the current directory so the device boots
+        straight into normal operation. """
+    config = {}
+    if os.path.exists("env.json"):
+        with open("env.json") as f:
+            config = json.load(f)
+    if not config.get("ssid"):
+        config["ssid"] = ssid
+        config["password"] = "simulated"
+    config["first_boot"] = False
+    config["mqtt_server"] = mqtt_server
+    config["mqtt_port"] = mqtt_port
+    with open("env.json", "w") as f:
+        json.dump(config, f)
+
+
+def run(main: str, root=".sim", http_port=8080, mqtt_server=None, mqtt_port=1883) -> None:
+    """
+    Boot an application on the host.
+    :param main: path of the application main.py, which calls ``rockwren.fly()``
+    :param root: directory standing in for the device filesystem root.  env.json and log.txt are kept here.
+    :param http_port: port the web UI is served on
+    :param mqtt_server: MQTT broker host.  If None, a broker stand-in is started on ``mqtt_port``.
+    :param mqtt_port: MQTT broker port
+    """
+    install()
+    main = os.path.abspath(main)
+    app_dir = os.path.dirname(main)
+    os.makedirs(root, exist_ok=True)
+    os.chdir(root)
+
+    if mqtt_server is None:
+        from .broker import Broker
+        mqtt_port = Broker(port=mqtt_port).start().port
+        mqtt_server = "127.0.0.1"
+    provision(mqtt_server, mqtt_port)
+
+    from .. import accesspoint
+    from .. import logsink
+    from .. import rockwren
+    from .. import web
+    logsink.LOG_FILE = "log.txt"
+    web.DIR_PATH = accesspoint.dir_path = PACKAGE_DIR
+
+    web_run = web.run
+    web.run = lambda loop, host="0.0.0.0", port=http_port: web_run(loop, host, port)
+
+    fly = rockwren.fly
+
+    def host_fly(the_device):
+        if the_device.template:
+            the_device.template = host_path(the_device.template, app_dir)
+        print(f"Web UI http://127.0.0.1:{http_port}/  MQTT {mqtt_server}:{mqtt_port}")
+        fly(the_device)
+    rockwren.fly = host_fly
+
+    sys.path.insert(0, app_dir)
+    runpy.run_path(main, run_name="__main__")
@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Run a rockwren application on the host.
+
+Example:
+    python -m rockwren.sim examples/pico_switch/main.py --http-port 8080
+"""
+import argparse
+
+from . import run
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='python -m rockwren.sim')
+    parser.add_argument('main', type=str,
+                        help='application main.py')
+    parser.add_argument('-r', '--root', type=str, default='.sim',
+                        help='directory standing in for the device filesystem')
+    parser.add_argument('-p', '--http-port', type=int, default=8080,
+                        help='web UI port')
+    parser.add_argument('-m', '--mqtt-server', type=str, default=None,
+                        help='MQTT broker host, a local broker stand-in is started if not set')
+    parser.add_argument('--mqtt-port', type=int, default=1883,
+                        help='MQTT broker port')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    run(args.main, args.root, args.http_port, args.mqtt_server, args.mqtt_port)
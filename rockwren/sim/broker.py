@@ -0,0 +1,205 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Minimal MQTT 3.1.1 broker stand-in for simulated devices.
+
+Supports QoS 0 and 1 publishing (delivered at QoS 0), retained messages, last will messages and ``+`` / ``#``
+subscription wildcards.  Sessions are not persisted.  Use a real broker such as mosquitto to test anything beyond
+rockwren's own traffic.
+
+The broker runs its own event loop on a background thread because simulated MQTT clients block like their
+MicroPython counterparts:
+
+    broker = Broker(port=1883).start()
+"""
+import asyncio
+import struct
+import threading
+
+from .mqtt import CONNACK
+from .mqtt import CONNECT
+from .mqtt import DISCONNECT
+from .mqtt import PINGREQ
+from .mqtt import PINGRESP
+from .mqtt import PUBACK
+from .mqtt import PUBLISH
+from .mqtt import SUBACK
+from .mqtt import SUBSCRIBE
+from .mqtt import UNSUBACK
+from .mqtt import UNSUBSCRIBE
+from .mqtt import packet
+from .mqtt import publish_packet
+
+
+def topic_matches(topic_filter: bytes, topic: bytes) -> bool:
+    """ :return: True if the topic matches the subscription filter, which may contain ``+`` and ``#`` wildcards """
+    filter_levels = topic_filter.split(b"/")
+    topic_levels = topic.split(b"/")
+    for index, level in enumerate(filter_levels):
+        if level == b"#":
+            return True
+        if index >= len(topic_levels) or (level != b"+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _string(body: bytes, offset: int) -> tuple:
+    """ :return: tuple (string, offset after the string) """
+    length = struct.unpack_from("!H", body, offset)[0]
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+class Session:
+
+    def __init__(self, client_id: bytes, writer: asyncio.StreamWriter):
+        self.client_id = client_id
+        self.writer = writer
+        self.subscriptions = {}  # topic filter -> qos
+        self.will = None  # (topic, msg, retain)
+
+
+class Broker:
+
+    def __init__(self, host="127.0.0.1", port=1883):
+        self.host = host
+        self.port = port
+        self.sessions = {}  # client id -> Session
+        self.retained = {}  # topic -> msg
+        self.messages = 0  # messages published to the broker
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self) -> "Broker":
+        """ Run the broker on a background thread.  Returns once the broker is listening. """
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self) -> None:
+        """ Stop the broker, dropping all client connections. """
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    async def _shutdown(self) -> None:
+        self._server.close()
+        for session in list(self.sessions.values()):
+            session.will = None
+            session.writer.close()
+        await self._server.wait_closed()
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._client, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def publish(self, topic: bytes, msg: bytes, retain=False) -> None:
+        """ Publish a message from any thread. """
+        self._loop.call_soon_threadsafe(self._publish, topic, msg, retain)
+
+    def _publish(self, topic: bytes, msg: bytes, retain=False) -> None:
+        """ Deliver a message to the matching subscriptions, and retain it if requested. """
+        self.messages += 1
+        if retain:
+            if msg:
+                self.retained[topic] = msg
+            else:
+                self.retained.pop(topic, None)
+        data = publish_packet(topic, msg)
+        for session in list(self.sessions.values()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions):
+                session.writer.write(data)
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> tuple:
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length) if length else b""
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = None
+        try:
+            header, body = await self._read_packet(reader)
+            if header != CONNECT:
+                return
+            session = self._connect(body, writer)
+            while True:
+                header, body = await self._read_packet(reader)
+                if header == DISCONNECT:
+                    session.will = None
+                    break
+                self._handle(session, header, body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, struct.error):
+            pass
+        finally:
+            if session is not None and self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+                if session.will:
+                    self._publish(*session.will)
+            writer.close()
+
+    def _connect(self, body: bytes, writer: asyncio.StreamWriter) -> Session:
+        _, offset = _string(body, 0)  # protocol name
+        flags = body[offset + 1]
+        client_id, offset = _string(body, offset + 4)
+        session = Session(client_id, writer)
+        if flags & 0x04:
+            topic, offset = _string(body, offset)
+            msg, offset = _string(body, offset)
+            session.will = (topic, msg, bool(flags & 0x20))
+        previous = self.sessions.get(client_id)
+        if previous is not None:
+            previous.will = None
+            previous.writer.close()
+        self.sessions[client_id] = session
+        writer.write(packet(CONNACK, b"\x00\x00"))
+        return session
+
+    def _handle(self, session: Session, header: int, body: bytes) -> None:
+        if header & 0xF0 == PUBLISH:
+            qos = header >> 1 & 0x03
+            topic, offset = _string(body, 0)
+            if qos:
+                session.writer.write(packet(PUBACK, body[offset:offset + 2]))
+                offset += 2
+            self._publish(topic, body[offset:], bool(header & 0x01))
+        elif header == SUBSCRIBE:
+            offset = 2
+            granted = bytearray()
+            topic_filters = []
+            while offset < len(body):
+                topic_filter, offset = _string(body, offset)
+                session.subscriptions[topic_filter] = min(body[offset], 1)
+                granted.append(min(body[offset], 1))
+                topic_filters.append(topic_filter)
+                offset += 1
+            session.writer.write(packet(SUBACK, body[:2] + bytes(granted)))
+            for topic, msg in list(self.retained.items()):
+                if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                    session.writer.write(publish_packet(topic, msg, retain=True))
+        elif header == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic_filter, offset = _string(body, offset)
+                session.subscriptions.pop(topic_filter, None)
+            session.writer.write(packet(UNSUBACK, body[:2]))
+        elif header == PINGREQ:
+            session.writer.write(packet(PINGRESP, b""))
@@ -0,0 +1,414 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Fleet simulator for broker and Home Assistant load testing.
+
+Many simulated devices, each a ``rockwren.Device`` with its own ``MqttDevice``, ``unique_id`` and ``device_id``, run
+in one asyncio process.  The devices send their discovery, heartbeat (periodic state) and availability messages
+exactly as they do on a board.  A controller client stands in for Home Assistant: it counts the fleet's traffic,
+sends state commands and times the round trip to the matching state publication.
+
+A reconnect storm is simulated by dropping every device connection at once, as a WiFi outage or broker restart
+does.  The devices reconnect through ``MqttDevice.ensure_connection`` and the time for the fleet to come back online
+is reported.
+
+A Home Assistant restart is simulated by publishing its birth message, after which every device resends its discovery
+messages.  The time for the fleet to be rediscovered and the peak discovery messages per second are reported.
+
+Example:
+    python -m rockwren.sim.fleet -n 1000 -d 120 --command-rate 20 --storm-at 60 --mqtt-server 192.168.1.10
+"""
+import argparse
+import json
+import random
+import struct
+import time
+from collections import Counter
+
+from . import install
+from . import machine
+from . import mqtt
+from .broker import Broker
+from .uasyncio import get_event_loop
+from .uasyncio import sleep
+
+# The stand-ins must be installed before the rockwren modules are imported
+install()
+
+from .. import logsink
+from .. import metrics
+from .. import mqtt_client
+from .. import rockwren
+
+""" First four bytes of the simulated ``unique_id``, followed by the device index """
+UNIQUE_ID_PREFIX = b"\xf1\xee\x70\x00"
+""" Seconds a command waits for the matching state before it is counted as timed out """
+COMMAND_TIMEOUT = 10
+
+
+def percentile(values, fraction):
+    """ :return: the value at the fraction (0 - 1) of the sorted values """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Behaviour:
+    """
+    How simulated devices respond to commands.  A command is dropped, i.e. handled without changing state, with
+    probability ``drop_rate``, fails with an exception with probability ``error_rate``, and is otherwise applied
+    after ``delay_ms`` plus up to ``jitter_ms`` of random delay.
+    """
+
+    def __init__(self, delay_ms=0, jitter_ms=0, drop_rate=0.0, error_rate=0.0, seed=None):
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        """ :return: milliseconds to wait before applying a command """
+        return self.delay_ms + (self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+
+    def outcome(self) -> str:
+        """ :return: one of "drop", "error" or "apply" """
+        r = self.random.random()
+        if r < self.drop_rate:
+            return "drop"
+        if r < self.drop_rate + self.error_rate:
+            return "error"
+        return "apply"
+
+
+class SimulatedDevice(rockwren.Device):
+    """ A switch that handles commands according to the fleet ``Behaviour``. """
+
+    def __init__(self, index: int, behaviour: Behaviour):
+        self.index = index
+        self.behaviour = behaviour
+        super().__init__(name=f"Rockwren Fleet {index:04d}")  # Always call last
+
+    def command_handler(self, topic, message):
+        outcome = self.behaviour.outcome()
+        if outcome == "error":
+            raise RuntimeError("Simulated command failure")
+        state = message.get("state", "") if isinstance(message, dict) else ""
+        if outcome == "apply" and state.upper() in ("ON", "OFF"):
+            delay = self.behaviour.delay()
+            if delay:
+                self.create_task(self._apply_later(state.upper(), delay), "fleet_command")
+            else:
+                self.state = state.upper()
+        super().command_handler(topic, message)  # Always call last
+
+    async def _apply_later(self, state: str, delay_ms: float):
+        await sleep(delay_ms / 1000)
+        self.state = state
+        self.apply_state()
+
+    def discovery_function(self):
+        return [("switch", {"unique_id": f"{self.mqtt_client.device_id}_switch",
+                            "name": self.name,
+                            "platform": "mqtt",
+                            "state_topic": self.mqtt_client.state_topic,
+                            "command_topic": self.mqtt_client.command_topic,
+                            "payload_on": '{"state": "ON"}',
+                            "payload_off": '{"state": "OFF"}',
+                            "availability": {
+                                "topic": self.mqtt_client.availability_topic
+                            },
+                            "device": {
+                                "identifiers": [self.mqtt_client.device_id],
+                                "name": self.name,
+                                "sw_version": "0.1",
+                                "model": "Fleet Simulator",
+                                "manufacturer": "Rockwren",
+                                "configuration_url": f"http://{self.mqtt_client.connection_params['ip_address']}/"
+                            }
+                            })]
+
+
+def create_device(index: int, behaviour: Behaviour, mqtt_server: str, mqtt_port: int,
+                  heartbeat: int) -> mqtt_client.MqttDevice:
+    """ :return: the MQTT client of a new simulated device with a unique id derived from the index """
+    machine.UNIQUE_ID = UNIQUE_ID_PREFIX + struct.pack("!I", index)
+    device = SimulatedDevice(index, behaviour)
+    client = mqtt_client.MqttDevice(device, mqtt_server, {"ip_address": "127.0.0.1"},
+                                    command_handler=device.command_handler, mqtt_port=mqtt_port)
+    client.set_publish_interval(heartbeat)
+    return client
+
+
+class Controller:
+    """
+    Stands in for Home Assistant.  Counts the fleet's discovery, state and availability messages and sends commands,
+    timing the round trip from a command to the state publication that reflects it.
+    """
+
+    def __init__(self, mqtt_server: str, mqtt_port: int):
+        self.client = mqtt.MQTTClient(b"rockwren-fleet-controller", mqtt_server, mqtt_port, keepalive=60)
+        self.received = Counter()  # message kind -> count
+        self.discovered = set()  # discovery topics
+        self.discovery_times = []  # time of each discovery message
+        self.online = {}  # availability topic -> time online
+        self.states = {}  # state topic -> last reported state
+        self.pending = {}  # state topic -> (commanded state, time sent)
+        self.latency = []  # command round trip ms
+        self.timeouts = 0
+
+    def connect(self) -> None:
+        self.client.set_callback(self._message)
+        self.client.connect()
+        if self.client.is_conn_issue():
+            raise OSError(f"Controller could not connect to {self.client.server}:{self.client.port}")
+        self.client.subscribe(b"homeassistant/+/+/config")
+        self.client.subscribe(b"rockwren/+/state")
+        self.client.subscribe(b"rockwren/+/LWT")
+
+    def _message(self, topic, msg, retained, duplicate) -> None:
+        now = time.monotonic()
+        if topic.startswith(b"homeassistant/"):
+            self.received["discovery"] += 1
+            self.discovered.add(topic)
+            self.discovery_times.append(now)
+        elif topic.endswith(b"/LWT"):
+            self.received[msg.decode()] += 1
+            if msg == b"online":
+                self.online[topic] = now
+            else:
+                self.online.pop(topic, None)
+        elif topic.endswith(b"/state"):
+            self.received["state"] += 1
+            state = json.loads(msg).get("state")
+            self.states[topic] = state
+            pending = self.pending.get(topic)
+            if pending and pending[0] == state:
+                del self.pending[topic]
+                self.latency.append((now - pending[1]) * 1000)
+
+    async def receive(self) -> None:
+        """ Handle messages as they arrive. """
+        while True:
+            while self.client.check_msg() is not None:
+                pass
+            if self.client.is_conn_issue():
+                self.client.reconnect()
+                self.client.resubscribe()
+            await sleep(0)
+
+    async def command(self, devices: list, rate: float, rng: random.Random) -> None:
+        """ Send state commands to random devices at ``rate`` commands per second. """
+        while True:
+            await sleep(1 / rate)
+            now = time.monotonic()
+            for topic, (_, sent) in list(self.pending.items()):
+                if now - sent > COMMAND_TIMEOUT:
+                    del self.pending[topic]
+                    self.timeouts += 1
+            device = rng.choice(devices)
+            if device.state_topic in self.pending:
+                continue
+            state = "OFF" if self.states.get(device.state_topic) == "ON" else "ON"
+            self.pending[device.state_topic] = (state, time.monotonic())
+            self.client.publish(device.command_topic, json.dumps({"state": state}))
+            self.received["command"] += 1
+
+
+def rediscovery_report(controller: Controller, restart: float, devices: int) -> dict:
+    """ :return: the rediscovery of the fleet after the Home Assistant birth message published at ``restart`` """
+    times = sorted(t - restart for t in controller.discovery_times if t >= restart)
+    per_second = Counter(int(t) for t in times)
+    return {"discovery_messages": len(times),
+            "rediscovery_s": round(times[-1], 2) if len(times) >= devices else None,
+            "peak_discovery_per_s": max(per_second.values(), default=0)}
+
+
+async def restart_home_assistant(controller: Controller, at: float) -> float:
+    """ Publish the Home Assistant birth message at time ``at``.  :return: the time it was published """
+    await sleep(max(0, at - time.monotonic()))
+    controller.client.publish(mqtt_client.HA_STATUS_TOPIC, b"online")
+    return time.monotonic()
+
+
+def drop_connections(devices: list) -> None:
+    """ Drop every device connection at once without a disconnect, as a WiFi outage does. """
+    for device in devices:
+        device._mqtt_client._close()
+        device._mqtt_client.conn_issue = (OSError("simulated outage"), 9)
+
+
+async def fleet(devices: list, controller: Controller, duration: float, connect_rate: float, command_rate: float,
+                storm_at: float, seed=None, ha_restart_at=None) -> dict:
+    """
+    Connect the fleet, run it for ``duration`` seconds and report.
+    :return: json serialisable report
+    """
+    controller.connect()
+    receiver = get_event_loop().create_task(controller.receive())
+
+    start = time.monotonic()
+    for device in devices:
+        device.run(get_event_loop())
+        device._mqtt_client.DEBUG = False
+        if connect_rate:
+            await sleep(1 / connect_rate)
+        else:
+            await sleep(0)
+    connected = time.monotonic()
+    publishes = metrics.get(metrics.MQTT_PUBLISHES)
+
+    commander = None
+    if command_rate:
+        commander = get_event_loop().create_task(controller.command(devices, command_rate, random.Random(seed)))
+
+    ha_restart = None
+    if ha_restart_at is not None:
+        ha_restart = get_event_loop().create_task(restart_home_assistant(controller, connected + ha_restart_at))
+
+    storm = None
+    if storm_at is not None:
+        await sleep(max(0, connected + storm_at - time.monotonic()))
+        reconnects = metrics.get(metrics.MQTT_RECONNECTS)
+        storm_start = time.monotonic()
+        drop_connections(devices)
+        await sleep(max(0, connected + duration - time.monotonic()))
+        online = sorted(t - storm_start for t in controller.online.values() if t >= storm_start)
+        per_second = Counter(int(t) for t in online)
+        storm = {"dropped": len(devices),
+                 "reconnected": len(online),
+                 "reconnects": metrics.get(metrics.MQTT_RECONNECTS) - reconnects,
+                 "recovery_s": round(online[-1], 2) if len(online) == len(devices) else None,
+                 "reconnect_s": {"p50": round(percentile(online, 0.5), 2),
+                                 "p99": round(percentile(online, 0.99), 2)},
+                 "peak_reconnects_per_s": max(per_second.values(), default=0)}
+    else:
+        await sleep(max(0, connected + duration - time.monotonic()))
+    elapsed = time.monotonic() - connected
+
+    rediscovery = None
+    if ha_restart is not None and ha_restart.done():
+        rediscovery = rediscovery_report(controller, ha_restart.result(), len(devices))
+
+    for task in (receiver, commander, ha_restart):
+        if task is not None:
+            task.cancel()
+    publishes = metrics.get(metrics.MQTT_PUBLISHES) - publishes
+    return {"devices": len(devices),
+            "connect_s": round(connected - start, 2),
+            "online": len(controller.online),
+            "discovered": len(controller.discovered),
+            "publishes": publishes,
+            "publish_rate": round(publishes / elapsed, 1),
+            "received": dict(controller.received),
+            "commands": {"sent": controller.received["command"],
+                         "completed": len(controller.latency),
+                         "timeouts": controller.timeouts,
+                         "rtt_ms": {"p50": round(percentile(controller.latency, 0.5), 1),
+                                    "p90": round(percentile(controller.latency, 0.9), 1),
+                                    "p99": round(percentile(controller.latency, 0.99), 1),
+                                    "max": round(max(controller.latency, default=0), 1)}},
+            "storm": storm,
+            "rediscovery": rediscovery}
+
+
+def _raise_file_limit() -> None:
+    """ Each device holds a socket, so allow as many open files as the system permits. """
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def run(count=10, duration=30.0, mqtt_server=None, mqtt_port=1883, heartbeat=10, connect_rate=0.0,
+        command_rate=1.0, storm_at=None, behaviour=None, log_level="error", seed=None, ha_restart_at=None) -> dict:
+    """
+    Run a simulated fleet.
+    :param count: number of devices
+    :param duration: seconds to run once the fleet has connected
+    :param mqtt_server: MQTT broker host.  If None, a broker stand-in is started on ``mqtt_port``.
+    :param mqtt_port: MQTT broker port
+    :param heartbeat: seconds between each device's periodic state publications
+    :param connect_rate: devices connected per second, 0 to connect as fast as possible
+    :param command_rate: commands sent per second across the fleet, 0 for none
+    :param storm_at: seconds after connection to drop every device connection, None for no reconnect storm
+    :param behaviour: ``Behaviour`` of the devices on receiving commands
+    :param log_level: device log level
+    :param seed: random seed for repeatable runs
+    :param ha_restart_at: seconds after connection to publish the Home Assistant birth message, None for no restart
+    :return: json serialisable report
+    """
+    _raise_file_limit()
+    logsink.LOG_FILE = "fleet-log.txt"
+    logsink.install()
+    logsink.set_level(log_level)
+
+    broker = None
+    if mqtt_server is None:
+        broker = Broker(port=mqtt_port).start()
+        mqtt_server, mqtt_port = "127.0.0.1", broker.port
+    try:
+        behaviour = behaviour if behaviour else Behaviour(seed=seed)
+        devices = [create_device(index, behaviour, mqtt_server, mqtt_port, heartbeat) for index in range(count)]
+        controller = Controller(mqtt_server, mqtt_port)
+        report = get_event_loop().run_until_complete(
+            fleet(devices, controller, duration, connect_rate, command_rate, storm_at, seed, ha_restart_at))
+        if broker is not None:
+            report["broker_messages"] = broker.messages
+        return report
+    finally:
+        logsink.flush()
+        if broker is not None:
+            broker.stop()
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='python -m rockwren.sim.fleet')
+    parser.add_argument('-n', '--devices', type=int, default=100,
+                        help='number of simulated devices')
+    parser.add_argument('-d', '--duration', type=float, default=60,
+                        help='seconds to run once the fleet has connected')
+    parser.add_argument('-m', '--mqtt-server', type=str, default=None,
+                        help='MQTT broker host, a local broker stand-in is started if not set')
+    parser.add_argument('--mqtt-port', type=int, default=1883,
+                        help='MQTT broker port')
+    parser.add_argument('--heartbeat', type=int, default=10,
+                        help='seconds between periodic state publications of each device')
+    parser.add_argument('--connect-rate', type=float, default=0,
+                        help='devices connected per second, 0 for as fast as possible')
+    parser.add_argument('--command-rate', type=float, default=1,
+                        help='commands per second sent across the fleet, 0 for none')
+    parser.add_argument('--command-delay-ms', type=float, default=0,
+                        help='time a device takes to apply a command')
+    parser.add_argument('--command-jitter-ms', type=float, default=0,
+                        help='random additional time to apply a command')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='fraction of commands ignored by the devices')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of commands failing with an exception')
+    parser.add_argument('--storm-at', type=float, default=None,
+                        help='seconds after connection to drop all device connections at once')
+    parser.add_argument('--ha-restart-at', type=float, default=None,
+                        help='seconds after connection to publish the Home Assistant birth message')
+    parser.add_argument('--log-level', type=str, default='error', choices=logsink.LEVELS,
+                        help='device log level')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for repeatable runs')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    behaviour = Behaviour(args.command_delay_ms, args.command_jitter_ms, args.drop_rate, args.error_rate, args.seed)
+    report = run(args.devices, args.duration, args.mqtt_server, args.mqtt_port, args.heartbeat, args.connect_rate,
+                 args.command_rate, args.storm_at, behaviour, args.log_level, args.seed, args.ha_restart_at)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for the MicroPython ``machine`` module.
+
+Pins, ADCs and timers are simulated.  Inputs are driven from the host, e.g. to press a switch on pin 22:
+
+    machine.pins[22].drive(0)
+"""
+import time
+
+from . import uasyncio
+
+""" Unique id returned by ``unique_id()``.  Set before creating a device to simulate a different board. """
+UNIQUE_ID = b"\xe6\x61\x41\x04\x03\x2b\x6b\x2c"
+""" Pins created by the device, by pin id """
+pins = {}
+
+
+class ResetError(SystemExit):
+    """ Raised by ``reset()`` to end the simulation in place of restarting the board. """
+
+
+def unique_id() -> bytes:
+    return UNIQUE_ID
+
+
+def reset() -> None:
+    raise ResetError("machine.reset()")
+
+
+def soft_reset() -> None:
+    reset()
+
+
+def freq(hz=None):
+    return 133000000 if hz is None else None
+
+
+class RTC:
+
+    def datetime(self, datetime=None):
+        """ :return: (year, month, day, weekday, hours, minutes, seconds, subseconds) in UTC """
+        if datetime is not None:
+            return None
+        now = time.gmtime()
+        return now.tm_year, now.tm_mon, now.tm_mday, now.tm_wday, now.tm_hour, now.tm_min, now.tm_sec, 0
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self._value = value
+        self._handler = None
+        self._trigger = 0
+        pins[id] = self
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def on(self) -> None:
+        self.value(1)
+
+    def off(self) -> None:
+        self.value(0)
+
+    def toggle(self) -> None:
+        self.value(not self._value)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._handler = handler
+        self._trigger = trigger
+
+    def drive(self, value) -> None:
+        """ Set the level of an input pin from the host, calling the interrupt handler on a matching edge. """
+        value = 1 if value else 0
+        previous, self._value = self._value, value
+        if self._handler is None or previous == value:
+            return
+        if (value == 0 and self._trigger & Pin.IRQ_FALLING) or (value == 1 and self._trigger & Pin.IRQ_RISING):
+            self._handler(self)
+
+
+class ADC:
+    """ Analog input.  Reads ``value``, which defaults to about 27C on the Pico internal temperature sensor. """
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 14021
+
+    def read_u16(self) -> int:
+        return self.value
+
+
+class Timer:
+    """ Hardware timer run on the simulated event loop. """
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self._handle = None
+        if callback is not None:
+            self.init(mode=mode, period=period, freq=freq, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None) -> None:
+        self.deinit()
+        self._mode = mode
+        self._period = 1 / freq if freq > 0 else period / 1000
+        self._callback = callback
+        self._schedule()
+
+    def _schedule(self) -> None:
+        self._handle = uasyncio.get_event_loop().call_later(self._period, self._fire)
+
+    def _fire(self) -> None:
+        if self._mode == Timer.PERIODIC:
+            self._schedule()
+        else:
+            self._handle = None
+        self._callback(self)
+
+    def deinit(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
@@ -0,0 +1,30 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for the MicroPython ``micropython`` module.
+"""
+
+
+def const(value):
+    return value
+
+
+def native(function):
+    return function
+
+
+viper = native
+
+
+def opt_level(level=None):
+    return 0 if level is None else None
+
+
+def mem_info(verbose=None) -> None:
+    pass
+
+
+def schedule(function, arg) -> None:
+    from . import uasyncio
+    uasyncio.get_event_loop().call_soon_threadsafe(function, arg)
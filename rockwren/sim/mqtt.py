@@ -0,0 +1,282 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for ``umqtt.robust2``.
+
+``MQTTClient`` speaks MQTT 3.1.1 over a blocking TCP socket with the same interface and error handling as
+``umqtt.robust2``: connection errors are recorded in ``conn_issue`` rather than raised, and ``check_msg`` does not
+block.  It connects to any MQTT broker, including the ``rockwren.sim.broker`` stand-in.
+
+TLS connections are made without client certificates or server verification.
+"""
+import select
+import socket
+import ssl as _ssl
+import struct
+import time
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA2
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class MQTTException(Exception):
+    pass
+
+
+def encode_length(length: int) -> bytes:
+    """ :return: the MQTT variable length encoding of a remaining length """
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(header: int, body: bytes) -> bytes:
+    return bytes((header,)) + encode_length(len(body)) + body
+
+
+def publish_packet(topic: bytes, msg: bytes, retain=False, qos=0, pid=0, dup=False) -> bytes:
+    header = PUBLISH | (0x08 if dup else 0) | qos << 1 | (0x01 if retain else 0)
+    return packet(header, encode_string(topic) + (struct.pack("!H", pid) if qos else b"") + msg)
+
+
+class MQTTClient:
+    DEBUG = False
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False,
+                 ssl_params=None, socket_timeout=5, message_timeout=10):
+        self.client_id = client_id
+        self.server = server
+        self.port = port if port else (8883 if ssl else 1883)
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.ssl = ssl
+        self.ssl_params = ssl_params
+        self.socket_timeout = socket_timeout
+        self.sock = None
+        self.poller = None
+        self.cb = None
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_retain = False
+        self.lw_qos = 0
+        self.pid = 0
+        self.subs = {}
+        self.conn_issue = None
+        self.last_cpacket = 0
+        self.last_ping = 0
+
+    def log(self) -> None:
+        if self.DEBUG and self.conn_issue:
+            print(f"MQTT connection issue {self.conn_issue}")
+
+    def set_callback(self, f) -> None:
+        """ :param f: called with (topic, msg, retained, duplicate) for each received message """
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0) -> None:
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_retain = retain
+        self.lw_qos = qos
+
+    def _next_pid(self) -> int:
+        self.pid = self.pid % 65535 + 1
+        return self.pid
+
+    def _send(self, data: bytes) -> None:
+        if self.sock is None:
+            raise OSError("not connected")
+        self.sock.sendall(data)
+
+    def _read(self, length: int) -> bytes:
+        data = b""
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise OSError("connection closed by broker")
+            data += chunk
+        return data
+
+    def _read_packet(self) -> tuple:
+        """ :return: tuple (packet type byte, packet body) """
+        header = self._read(1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self._read(1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        self.last_cpacket = time.monotonic()
+        return header, self._read(length) if length else b""
+
+    def connect(self, clean_session=True) -> bool:
+        """ :return: True if the broker has a session for the client """
+        try:
+            present = self._connect(clean_session)
+            self.conn_issue = None
+            return present
+        except (OSError, MQTTException) as ex:
+            self._close()
+            self.conn_issue = (ex, 1)
+            self.log()
+            return False
+
+    def _connect(self, clean_session) -> bool:
+        self._close()
+        sock = socket.create_connection((self.server, self.port), self.socket_timeout)
+        if self.ssl:
+            context = _ssl.SSLContext(_ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = _ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=self.server)
+        self.sock = sock
+        # poll rather than select, which is limited to file descriptors below FD_SETSIZE
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+        flags = 0x02 if clean_session else 0
+        payload = encode_string(self.client_id)
+        if self.lw_topic:
+            flags |= 0x04 | self.lw_qos << 3 | (0x20 if self.lw_retain else 0)
+            payload += encode_string(self.lw_topic) + encode_string(self.lw_msg)
+        if self.user is not None:
+            flags |= 0x80
+            payload += encode_string(self.user)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+        self._send(packet(CONNECT, encode_string(b"MQTT") + struct.pack("!BBH", 4, flags, self.keepalive) + payload))
+        header, body = self._read_packet()
+        if header != CONNACK or len(body) != 2:
+            raise MQTTException(29)
+        if body[1] != 0:
+            raise MQTTException(body[1])
+        self.last_ping = time.monotonic()
+        return bool(body[0] & 1)
+
+    def _close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def disconnect(self) -> None:
+        try:
+            self._send(packet(DISCONNECT, b""))
+        except OSError as ex:
+            self.conn_issue = (ex, 2)
+        finally:
+            self._close()
+
+    def reconnect(self) -> bool:
+        return self.connect(False)
+
+    def resubscribe(self) -> None:
+        for topic, qos in self.subs.items():
+            self.subscribe(topic, qos, False)
+
+    def publish(self, topic, msg, retain=False, qos=0) -> None:
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        try:
+            self._send(publish_packet(topic, msg, retain, qos, self._next_pid() if qos else 0))
+        except OSError as ex:
+            self.conn_issue = (ex, 4)
+
+    def subscribe(self, topic, qos=0, resubscribe=True) -> None:
+        if resubscribe:
+            self.subs[topic] = qos
+        try:
+            self._send(packet(SUBSCRIBE, struct.pack("!H", self._next_pid()) + encode_string(topic) + bytes((qos,))))
+        except OSError as ex:
+            self.conn_issue = (ex, 5)
+
+    def ping(self) -> None:
+        try:
+            self._send(packet(PINGREQ, b""))
+            self.last_ping = time.monotonic()
+        except OSError as ex:
+            self.conn_issue = (ex, 6)
+
+    def is_keepalive(self) -> bool:
+        """ :return: False, and records a connection issue, if the broker has not been heard from in time """
+        if self.keepalive and self.sock is not None and \
+                time.monotonic() - self.last_cpacket > self.keepalive * 1.5:
+            self._close()
+            self.conn_issue = (MQTTException(7), 7)
+            return False
+        return True
+
+    def is_conn_issue(self) -> bool:
+        self.is_keepalive()
+        if self.conn_issue:
+            self.log()
+        return bool(self.conn_issue)
+
+    def _handle_packet(self, header: int, body: bytes):
+        """ :return: the packet type handled """
+        if header & 0xF0 == PUBLISH:
+            qos = header >> 1 & 0x03
+            topic_length = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_length]
+            offset = 2 + topic_length
+            if qos:
+                pid = body[offset:offset + 2]
+                offset += 2
+                self._send(packet(PUBACK, pid))
+            if self.cb:
+                self.cb(topic, body[offset:], bool(header & 0x01), bool(header & 0x08))
+        return header & 0xF0
+
+    def wait_msg(self):
+        """ Block until a packet is received and handle it. """
+        try:
+            if self.sock is None:
+                raise OSError("not connected")
+            self.sock.settimeout(self.socket_timeout)
+            return self._handle_packet(*self._read_packet())
+        except (OSError, MQTTException) as ex:
+            self._close()
+            self.conn_issue = (ex, 9)
+
+    def check_msg(self):
+        """ Handle a packet if one has been received, otherwise return immediately. """
+        if self.sock is None:
+            return None
+        if self.keepalive and time.monotonic() - self.last_ping >= self.keepalive / 2:
+            self.ping()
+        try:
+            pending = self.ssl and self.sock.pending()
+            if not pending and not self.poller.poll(0):
+                return None
+        except (OSError, ValueError) as ex:
+            self._close()
+            self.conn_issue = (ex, 9)
+            return None
+        return self.wait_msg()
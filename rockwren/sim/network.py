@@ -0,0 +1,73 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for the MicroPython ``network`` module.  The station interface connects immediately to any network
+and reports the host address in ``IFCONFIG``.
+"""
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+""" (ip address, subnet mask, gateway, dns server) reported by connected interfaces """
+IFCONFIG = ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+""" Networks returned by scan: (ssid, bssid, channel, rssi, security, hidden) """
+NETWORKS = [(b"rockwren-sim", b"\x02\x00\x00\x00\x00\x01", 6, -45, 3, 0)]
+
+_hostname = "rockwren"
+
+
+def hostname(name=None):
+    global _hostname
+    if name is None:
+        return _hostname
+    _hostname = name
+
+
+class WLAN:
+
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+        self._config = {"essid": "", "mac": b"\x02\x00\x00\x00\x00\x02"}
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self._active = bool(active)
+        if not self._active:
+            self._connected = False
+
+    def connect(self, ssid=None, password=None, bssid=None) -> None:
+        self._config["essid"] = ssid
+        self._connected = self._active
+
+    def disconnect(self) -> None:
+        self._connected = False
+
+    def isconnected(self) -> bool:
+        return self._connected or (self.interface == AP_IF and self._active)
+
+    def status(self, param=None):
+        if param == "rssi":
+            return NETWORKS[0][3]
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return IFCONFIG
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config.get(args[0])
+        self._config.update(kwargs)
+
+    def scan(self) -> list:
+        return list(NETWORKS)
@@ -0,0 +1,11 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for the MicroPython ``ntptime`` module.  The host clock is already set.
+"""
+host = "pool.ntp.org"
+
+
+def settime() -> None:
+    pass
@@ -0,0 +1,140 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for MicroPython ``uasyncio`` bridged to CPython ``asyncio``.
+
+All rockwren tasks run on a single asyncio event loop.  The differences from ``asyncio`` that rockwren relies on are
+bridged:
+- ``create_task`` works before the loop is running and accepts generator based co-routines such as
+  ``profiler.task`` wrappers.
+- ``sleep_ms`` and ``wait_for_ms`` take milliseconds.
+- Stream writers accept ``str`` as well as ``bytes``.
+- ``ThreadSafeFlag`` may be set from a pin interrupt or timer callback.
+"""
+import asyncio
+from asyncio import CancelledError
+from asyncio import Event
+from asyncio import Lock
+from asyncio import TimeoutError
+from asyncio import gather
+from asyncio import sleep
+from asyncio import wait_for
+
+_loop = None
+
+
+class Loop:
+    """ The uasyncio event loop interface over an asyncio event loop. """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def create_task(self, coro):
+        return asyncio.ensure_future(coro, loop=self.loop)
+
+    def run_forever(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_until_complete(self, awaitable):
+        asyncio.set_event_loop(self.loop)
+        return self.loop.run_until_complete(self.create_task(awaitable))
+
+    def __getattr__(self, name):
+        # set_exception_handler, call_exception_handler, call_soon_threadsafe, stop, close etc.
+        return getattr(self.loop, name)
+
+
+def get_event_loop() -> Loop:
+    global _loop
+    if _loop is None:
+        new_event_loop()
+    return _loop
+
+
+def new_event_loop() -> Loop:
+    """ Replace the event loop.  Tasks of the previous loop are discarded. """
+    global _loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _loop = Loop(loop)
+    return _loop
+
+
+def create_task(coro):
+    return get_event_loop().create_task(coro)
+
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(awaitable, timeout_ms):
+    return await asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+
+class ThreadSafeFlag:
+    """ Flag set from interrupt handlers, or any thread, and awaited by a single task. """
+
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self) -> None:
+        get_event_loop().call_soon_threadsafe(self._event.set)
+
+    def clear(self) -> None:
+        self._event.clear()
+
+    async def wait(self) -> None:
+        await self._event.wait()
+        self._event.clear()
+
+
+class StreamWriter:
+    """ asyncio stream writer accepting ``str`` like the MicroPython stream writer. """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, data) -> None:
+        self._writer.write(data.encode() if isinstance(data, str) else data)
+
+    async def awrite(self, data) -> None:
+        self.write(data)
+        await self._writer.drain()
+
+    async def drain(self) -> None:
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            # MicroPython does not raise for a client that has gone away
+            pass
+
+    def close(self) -> None:
+        self._writer.close()
+
+    async def wait_closed(self) -> None:
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def get_extra_info(self, name):
+        return self._writer.get_extra_info(name)
+
+
+async def start_server(callback, host, port, backlog=5, ssl=None):
+    """ Start a TCP server calling ``callback(reader, writer)`` for each client connection. """
+    async def client_connected(reader, writer):
+        await callback(reader, StreamWriter(writer))
+    return await asyncio.start_server(client_connected, host, port, backlog=backlog, ssl=ssl)
+
+
+async def open_connection(host, port, ssl=None):
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+    return reader, StreamWriter(writer)
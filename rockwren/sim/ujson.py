@@ -0,0 +1,23 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Host stand-in for the MicroPython ``ujson`` module.  Like MicroPython, bytes are serialised as strings.
+"""
+import json
+from json import load
+from json import loads
+
+
+def _default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj, separators=None) -> str:
+    return json.dumps(obj, separators=separators, default=_default)
+
+
+def dump(obj, stream, separators=None) -> None:
+    json.dump(obj, stream, separators=separators, default=_default)
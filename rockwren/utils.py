@@ -39,7 +39,7 @@ def pem_to_der(pem):
     :return:
     """
     # remove -----BEGIN PUB KEY... lines and concatenate
-    pem = ''.join(pem.split('\n')[1:-2])
+    pem = ''.join(line.strip() for line in pem.split('\n') if line.strip() and not line.startswith('-----'))
     der = ubinascii.a2b_base64(pem)
     return der
 
@@ -7,13 +7,20 @@ Device web interface for initial setup via access point and for configuration.
 import gc
 import io
 import sys
+import time
 
 import machine
 import uasyncio
+import ujson
 from micropython import const
 
+from . import credentials
 from . import env
+from . import heaptrack
+from . import logsink
+from . import metrics
 from . import networking
+from . import profiler
 from . import rockwren
 from . import utils
 from phew import logging
@@ -25,20 +32,200 @@ STATUS_CODE_200 = const(200)
 STATUS_CODE_302 = const(302)
 STATUS_CODE_400 = const(400)
 STATUS_CODE_404 = const(404)
+STATUS_CODE_503 = const(503)
+QUEUE_POLL_MS = const(20)
+QUEUE_TIMEOUT_MS = const(2000)
+""" Bounds on reading the request of a rejected client before responding """
+REJECT_DRAIN_LINES = const(32)
+REJECT_DRAIN_MS = const(500)
+""" Default minimum free heap in bytes required to serve a route.  Extended by ``env.WEB_MIN_FREE``. """
+ROUTE_MIN_FREE = {"/log": 8 * 1024}
+""" Number of rendered pages kept in the response cache.  Disabled on the esp8266 to save heap. """
+CACHE_ENTRIES = 0 if sys.platform == "esp8266" else 2
 
 # Web application for controlling the device
 webapp = server.Phew()
 
 # device represents the functions of the device
-device: rockwren.Device = None
+device: "rockwren.Device" = None
 
 
-def run(loop) -> None:
-    """ Run the web app as a task in the asyncio loop """
-    webapp.run_as_task(loop)
+_in_flight = 0  # clients being served
+_queued = 0  # clients waiting to be served
+_cache = {}  # route path -> rendered page
+_cache_order = []  # cached route paths, least recently used first
+
 
+async def _drain_headers(reader) -> None:
+    """ Read the request line and headers, up to ``REJECT_DRAIN_LINES`` lines. """
+    for _ in range(REJECT_DRAIN_LINES):
+        line = await reader.readline()
+        if line in (b"", b"\r\n", b"\n"):
+            return
 
-@webapp.route("/", methods=["GET"])
+
+async def _reject(reader, writer) -> None:
+    """ Reject a client with 503 Service Unavailable.  The request line and headers are read first, for at most
+        ``REJECT_DRAIN_MS``, as closing the connection with unread data can reset it before the client reads the
+        response.  The request body is not read. """
+    metrics.inc(metrics.WEB_REJECTED)
+    try:
+        try:
+            await uasyncio.wait_for_ms(_drain_headers(reader), REJECT_DRAIN_MS)
+        except Exception:
+            # Respond anyway, the client may not read it
+            pass
+        writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def _serve_client(reader, writer):
+    """ Serve a web client.  At most ``env.WEB_MAX_CLIENTS`` clients are served at once and up to
+        ``env.WEB_QUEUE_LENGTH`` more wait for up to ``QUEUE_TIMEOUT_MS``.  Other clients are rejected with 503.
+        Requests are timed by the profiler when profiling is enabled. """
+    global _in_flight, _queued
+    if _in_flight >= env.WEB_MAX_CLIENTS:
+        if _queued >= env.WEB_QUEUE_LENGTH:
+            await _reject(reader, writer)
+            return
+        _queued += 1
+        try:
+            waited = 0
+            while _in_flight >= env.WEB_MAX_CLIENTS and waited < QUEUE_TIMEOUT_MS:
+                await uasyncio.sleep_ms(QUEUE_POLL_MS)
+                waited += QUEUE_POLL_MS
+        finally:
+            _queued -= 1
+        if _in_flight >= env.WEB_MAX_CLIENTS:
+            await _reject(reader, writer)
+            return
+    _in_flight += 1
+    try:
+        await profiler.task("web_request", webapp._handle_request(reader, writer))
+    finally:
+        _in_flight -= 1
+
+
+def run(loop, host="0.0.0.0", port=80) -> None:
+    """ Run the web app as a task in the asyncio loop """
+    loop.create_task(uasyncio.start_server(_serve_client, host, port))
+
+
+def _status(response) -> int:
+    """ :return: the HTTP status code of a phew handler response """
+    if isinstance(response, tuple):
+        return response[1] if len(response) >= 2 else STATUS_CODE_200
+    return getattr(response, "status", STATUS_CODE_200)
+
+
+def _record(path, status, start, heap_start) -> None:
+    """ Record a completed request in ``metrics`` and ``heaptrack``. """
+    metrics.web_request(path, status, time.ticks_diff(time.ticks_ms(), start))
+    heaptrack.end(path, heap_start)
+
+
+def _timed_body(path, status, start, heap_start, body):
+    """ Wrap a generator response body so the request is recorded once the body has been written. """
+    for chunk in body:
+        yield chunk
+    _record(path, status, start, heap_start)
+
+
+def _instrumented(path, handler):
+    """ Wrap a route handler to enforce the route's minimum free heap, and to record request counts, status codes
+        and latency in ``metrics`` and heap usage in ``heaptrack``. """
+    metrics.register_route(path)
+
+    def instrumented_handler(request, **kwargs):
+        min_free = env.WEB_MIN_FREE.get(path, ROUTE_MIN_FREE.get(path))
+        if min_free and gc.mem_free() < min_free:
+            gc.collect()
+            if gc.mem_free() < min_free:
+                logging.warn(f"Insufficient memory to serve {path}")
+                metrics.web_request(path, STATUS_CODE_503, 0)
+                return server.Response('{"error": "Insufficient memory"}', STATUS_CODE_503,
+                                       {"Content-Type": "application/json", "Retry-After": "5"})
+        heap_start = heaptrack.begin()
+        start = time.ticks_ms()
+        response = handler(request, **kwargs)
+        if type(response).__name__ == "generator":
+            return _timed_body(path, STATUS_CODE_200, start, heap_start, response)
+        if isinstance(response, tuple) and type(response[0]).__name__ == "generator":
+            return (_timed_body(path, _status(response), start, heap_start, response[0]),) + response[1:]
+        _record(path, _status(response), start, heap_start)
+        return response
+    return instrumented_handler
+
+
+def route(path, methods=["GET"]):
+    """ Register an instrumented route handler with the web app. Used in place of ``webapp.route``. """
+    def decorator(handler):
+        webapp.add_route(path, _instrumented(path, handler), methods=methods)
+        return handler
+    return decorator
+
+
+def catchall():
+    """ Register an instrumented catchall handler with the web app. Used in place of ``webapp.catchall``. """
+    def decorator(handler):
+        webapp.set_callback(_instrumented("*", handler))
+        return handler
+    return decorator
+
+
+def invalidate(path=None) -> None:
+    """
+    Discard cached pages.
+    :param path: route path of the page to discard, all pages are discarded if None
+    """
+    if path is None:
+        _cache.clear()
+        del _cache_order[:]
+    elif path in _cache:
+        del _cache[path]
+        _cache_order.remove(path)
+
+
+def _config_saved(keys) -> None:
+    """ Configuration listener.  Cached pages show configuration values so are discarded when it is saved. """
+    invalidate()
+
+
+networking.add_config_listener(_config_saved)
+
+
+def _cached_page(path, render):
+    """
+    Serve a page from the response cache.  On a miss the page is rendered and cached, discarding the least recently
+    used page if the cache is full.
+    :param path: route path the page is cached under
+    :param render: function returning the page template generator
+    :return: phew handler response
+    """
+    if not CACHE_ENTRIES:
+        return render()
+    page = _cache.get(path)
+    if page is not None:
+        metrics.inc(metrics.WEB_CACHE_HITS)
+        _cache_order.remove(path)
+        _cache_order.append(path)
+        return page, STATUS_CODE_200, "text/html"
+    metrics.inc(metrics.WEB_CACHE_MISSES)
+    buffer = io.BytesIO()
+    for chunk in render():
+        buffer.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+    page = buffer.getvalue()
+    if len(_cache_order) >= CACHE_ENTRIES:
+        del _cache[_cache_order.pop(0)]
+    _cache[path] = page
+    _cache_order.append(path)
+    return page, STATUS_CODE_200, "text/html"
+
+
+@route("/", methods=["GET"])
 def index(request):
     """ Home page """
     return template.render_template(DIR_PATH + "/index.html",
@@ -46,7 +233,7 @@ def index(request):
                                     device=device)
 
 
-@webapp.route("/device", methods=["GET"])
+@route("/device", methods=["GET"])
 def device_control(request):
     """ Return json formatted information about the device """
     if device:
@@ -54,7 +241,7 @@ def device_control(request):
     return "Device not found", STATUS_CODE_400
 
 
-@webapp.route("/device/control", methods=["POST"])
+@route("/device/control", methods=["POST"])
 def device_control(request):
     """ Handle device control messages """
 
@@ -75,7 +262,29 @@ def device_control(request):
     return server.Response('{"error": "Device not found"}', STATUS_CODE_400, {"Content-Type": "application/json"})
 
 
-@webapp.route("/device/state", methods=["GET"])
+@route("/device/control/batch", methods=["POST"])
+def device_control_batch(request):
+    """ Handle a json list of device control messages as one state change """
+
+    commands = request.data.get("commands") if isinstance(request.data, dict) else request.data
+    if not commands or not isinstance(commands, list):
+        return server.Response('{"error": "Bad request"}', STATUS_CODE_400, {"Content-Type": "application/json"})
+    if device:
+        try:
+            resp, status = device.web_batch_handler(commands)
+            return server.Response(resp, status, {"Content-Type": "application/json"})
+        except Exception as ex:
+            try:
+                trace = io.StringIO()
+                sys.print_exception(ex, trace)
+                utils.logstream(trace)
+            finally:
+                return server.Response('{"error": "Error handling device control request"}', STATUS_CODE_400,
+                                       {"Content-Type": "application/json"})
+    return server.Response('{"error": "Device not found"}', STATUS_CODE_400, {"Content-Type": "application/json"})
+
+
+@route("/device/state", methods=["GET"])
 def device_state(request):
     """ Get device state """
 
@@ -87,19 +296,18 @@ def device_state(request):
 async def delayed_restart(delay_secs):
     """ Restart the device after delay_secs seconds. """
     await uasyncio.sleep(delay_secs)
+    logsink.flush()
     machine.reset()
 
 
-@webapp.route("/restart")
+@route("/restart")
 def restart(request):
     """ Restart the device after a delay. """
     uasyncio.create_task(delayed_restart(5))
     return template.render_template(DIR_PATH + "/restart.html", web_path=DIR_PATH)
 
 
-@webapp.route("/mqtt_config", methods=["GET"])
-def mqtt_config(request):
-    """ MQTT configuration """
+def _render_mqtt_config():
     return template.render_template(DIR_PATH + "/mqtt_config.html",
                                     web_path=DIR_PATH,
                                     device=device,
@@ -109,76 +317,172 @@ def mqtt_config(request):
                                     dns_server=env.CONNECTION_PARAMS["dns_server"],
                                     mqtt_server=env.MQTT_SERVER,
                                     mqtt_port=str(env.MQTT_PORT),
-                                    mqtt_client_cert=env.MQTT_CLIENT_CERT,
-                                    mqtt_client_key_stored=env.MQTT_CLIENT_KEY is not None)
+                                    mqtt_client_cert_stored=credentials.stored("mqtt_client_cert"),
+                                    mqtt_client_key_stored=credentials.stored("mqtt_client_key"),
+                                    groups=", ".join(env.GROUPS))
 
 
-@webapp.route("/favicon.svg", methods=["GET"])
+@route("/mqtt_config", methods=["GET"])
+def mqtt_config(request):
+    """ MQTT configuration.  Cached until the configuration is saved. """
+    return _cached_page("/mqtt_config", _render_mqtt_config)
+
+
+@route("/favicon.svg", methods=["GET"])
 def favicon(request):
-    """" Serve favicon """
-    return server.serve_file(DIR_PATH + "/favicon.svg")
+    """" Serve favicon.  Cached by the browser so pages load without requesting it again. """
+    return server.FileResponse(DIR_PATH + "/favicon.svg", headers={"Cache-Control": "max-age=86400"})
 
 
-@webapp.route("/log", methods=["GET"])
+@route("/log", methods=["GET"])
 def favicon(request):
     """" Serve log file """
+    logsink.flush()
     if sys.platform == "esp8266":
         """ Do a gc before serving file to ensure sufficient memory """
         gc.collect()
-    return server.serve_file("/log.txt")
+    return server.serve_file(logsink.LOG_FILE)
+
+
+def _metrics_body():
+    yield from metrics.render()
+    yield from profiler.render()
 
 
-@webapp.route("/mqtt_config", methods=["POST"])
+@route("/metrics", methods=["GET"])
+def metrics_view(request):
+    """ Runtime metrics in the Prometheus text exposition format """
+    return server.Response(_metrics_body(), STATUS_CODE_200, {"Content-Type": "text/plain; version=0.0.4"})
+
+
+@route("/log_level", methods=["POST"])
+def log_level_save(request):
+    """ Handle log level form post. The level is applied immediately and persisted for the next boot. """
+    level = request.form.get("log_level", None) if request.form else None
+    if level and logsink.set_level(level):
+        networking.save_network_config_key("log_level", level)
+        env.LOG_LEVEL = level
+    return server.redirect("/viewlogs", status=STATUS_CODE_302)
+
+
+@route("/mqtt_config", methods=["POST"])
 def mqtt_config_save(request):
     """ Handle MQTT configuration form post """
     if not request.form:
         return server.redirect("/mqtt_config", status=STATUS_CODE_302)
 
-    mqtt_config_updated = False
+    document = {}
 
     mqtt_server = request.form.get("mqtt_server", None)
     if mqtt_server:
-        numbers = mqtt_server.split(".")
-        if len(numbers) == 4 and all(number.isdigit() for number in numbers):
-            networking.save_network_config_key("mqtt_server", mqtt_server)
-            mqtt_config_updated = True
-        elif utils.is_fqdn(mqtt_server):
-            networking.save_network_config_key("mqtt_server", mqtt_server)
-            mqtt_config_updated = True
+        if networking.valid_mqtt_server(mqtt_server):
+            document["mqtt_server"] = mqtt_server
     else:
-        networking.save_network_config_key("mqtt_server", "")
+        document["mqtt_server"] = ""
     mqtt_port = request.form.get("mqtt_port", None)
     if mqtt_port:
-        networking.save_network_config_key("mqtt_port", int(mqtt_port))
-        mqtt_config_updated = True
+        document["mqtt_port"] = int(mqtt_port)
 
     mqtt_client_cert = request.form.get("mqtt_client_cert", None)
     if mqtt_client_cert:
-        networking.save_network_config_key("mqtt_client_cert", mqtt_client_cert)
-        mqtt_config_updated = True
+        document["mqtt_client_cert"] = mqtt_client_cert
 
     mqtt_client_key = request.form.get("mqtt_client_key", None)
     if mqtt_client_key:
-        networking.save_network_config_key("mqtt_client_key", mqtt_client_key)
-        mqtt_config_updated = True
+        document["mqtt_client_key"] = mqtt_client_key
+
+    groups = request.form.get("groups", None)
+    if groups is not None:
+        document["groups"] = [group.strip() for group in groups.split(",") if group.strip()]
+
+    changed, errors = networking.apply_config(document)
+    if errors:
+        logging.error(f"mqtt_config: invalid configuration {errors}")
 
-    if mqtt_config_updated:
+    if changed and _apply_live_config(changed) == "restart":
         return server.redirect("/restart", status=STATUS_CODE_302)
     else:
         return server.redirect("/mqtt_config", status=STATUS_CODE_302)
 
 
-@webapp.route("/viewlogs", methods=["GET"])
+def _apply_live_config(changed: dict) -> str:
+    """
+    Apply changed configuration to the running device where possible.
+    :param changed: changed configuration keys as returned by ``networking.apply_config``
+    :return: the action required: "none", "reconnect" or "restart"
+    """
+    if networking.restart_required(changed):
+        return "restart"
+    if "log_level" in changed:
+        logsink.set_level(env.LOG_LEVEL)
+    if "heap_tracking" in changed:
+        heaptrack.enabled = env.HEAP_TRACKING
+    client = device.mqtt_client if device else None
+    if "publish_interval" in changed and client:
+        client.set_publish_interval(env.PUBLISH_INTERVAL)
+    if "groups" in changed and client:
+        client.set_groups(env.GROUPS)
+    if client and ("discovery_mode" in changed or "discovery_retain" in changed):
+        # Clear the retained discovery messages sent with the previous settings before resending
+        client.remove_discovery_msgs(changed.get("discovery_mode", [env.DISCOVERY_MODE])[0] or "entity")
+        client.send_discovery_msgs()
+    if any(key in changed for key in networking.RECONNECT_KEYS):
+        if not client or not env.MQTT_SERVER:
+            # Starting or stopping the MQTT client requires a restart
+            return "restart"
+        client.reconfigure(env.MQTT_SERVER, int(env.MQTT_PORT))
+        return "reconnect"
+    return "none"
+
+
+@route("/config", methods=["GET"])
+def config_view(request):
+    """ Return the device configuration as json.  Secrets are not returned. """
+    config = {}
+    for key, (_, attribute) in networking.CONFIG_KEYS.items():
+        if key in networking.SECRET_KEYS or key in credentials.FILES:
+            continue
+        config[key] = getattr(env, attribute)
+    for key in credentials.FILES:
+        config[key + "_stored"] = credentials.stored(key)
+    return server.Response(ujson.dumps(config), STATUS_CODE_200, {"Content-Type": "application/json"})
+
+
+@route("/config", methods=["PUT"])
+def config_update(request):
+    """ Validate and apply a json configuration document in a single write.  Responds with the changed keys and
+        the action taken: none, reconnect or restart. """
+    if not request.data or not isinstance(request.data, dict):
+        return server.Response('{"error": "Bad request"}', STATUS_CODE_400, {"Content-Type": "application/json"})
+    changed, errors = networking.apply_config(request.data)
+    if errors:
+        return server.Response(ujson.dumps({"errors": errors}), STATUS_CODE_400,
+                               {"Content-Type": "application/json"})
+    action = _apply_live_config(changed)
+    if action == "restart":
+        uasyncio.create_task(delayed_restart(5))
+    return server.Response(ujson.dumps({"changed": changed, "action": action}), STATUS_CODE_200,
+                           {"Content-Type": "application/json"})
+
+
+def _log_level_options() -> list:
+    """ :return: the log level select options, the current level selected.  Built here as markup in a template
+        expression is rewritten by the html minifier, and joined by the template as a bare name is html escaped. """
+    level = logsink.get_level()
+    return [f'<option value="{name}"{" selected" if name == level else ""}>{name}</option>'
+            for name in logsink.LEVELS]
+
+
+@route("/viewlogs", methods=["GET"])
 def view_logs(request):
     """ View device logs """
     return template.render_template(DIR_PATH + "/viewlogs.html",
                                     web_path=DIR_PATH,
-                                    device=device)
+                                    device=device,
+                                    log_level_options=_log_level_options())
 
 
-@webapp.route("/information", methods=["GET"])
-def view_information(request):
-    """ View device information """
+def _render_information():
     return template.render_template(DIR_PATH + "/information.html",
                                     web_path=DIR_PATH,
                                     device=device,
@@ -187,10 +491,19 @@ def view_information(request):
                                     gateway=env.CONNECTION_PARAMS["gateway"],
                                     dns_server=env.CONNECTION_PARAMS["dns_server"],
                                     mqtt_server=env.MQTT_SERVER,
-                                    mqtt_port=env.MQTT_PORT)
+                                    mqtt_port=env.MQTT_PORT,
+                                    heap_usage=heaptrack.top() if heaptrack.enabled else None)
+
+
+@route("/information", methods=["GET"])
+def view_information(request):
+    """ View device information.  Cached until the configuration is saved, unless heap usage is being shown. """
+    if heaptrack.enabled:
+        return _render_information()
+    return _cached_page("/information", _render_information)
 
 
-@webapp.route("/wifi_config", methods=["GET", "POST"])
+@route("/wifi_config", methods=["GET", "POST"])
 def wifi_config(request: server.Request):
 
     message = None
@@ -213,23 +526,25 @@ def wifi_config(request: server.Request):
     network_list = []
     try:
         if sys.platform != 'esp8266':
-            network_list = networking.scan_networks(env.CONNECTION_PARAMS["wlan"])
+            network_list = networking.cached_networks(env.CONNECTION_PARAMS["wlan"], "refresh" in request.query)
     except:
         pass
 
     return template.render_template(DIR_PATH + "/wifi_config.html",
                                     web_path=DIR_PATH,
                                     networks=network_list,
+                                    scanning=networking.scan_in_progress(),
                                     error=message)
 
 
 async def delayed_restart(delay_secs):
     """ Co-routine for delayed restart """
     await uasyncio.sleep(delay_secs)
+    logsink.flush()
     machine.reset()
 
 
-@webapp.route("/restart")
+@route("/restart")
 def restart(request):
     """ Restart device. """
     if networking.first_boot_present():
@@ -237,7 +552,7 @@ def restart(request):
     return template.render_template(DIR_PATH + "/restart.html", web_path=DIR_PATH)
 
 
-@webapp.catchall()
+@catchall()
 def page_not_found(request):
     """ 404 page not found """
     return template.render_template(DIR_PATH + "/page_not_found.html", web_path=DIR_PATH), STATUS_CODE_404
@@ -1,67 +1,296 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+import ast
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.parse
 from pathlib import Path
 
-import minify_html
-import python_minifier
 from setuptools import setup
 from setuptools.command.sdist import sdist
 
+try:
+    import mpy_cross
+except ImportError:
+    mpy_cross = None
 
-def minify_py_dir(directory):
-    """ Minify all the python files in directory. """
 
-    files = [directory + '/' + f for f in os.listdir(directory)
-             if os.path.isfile(directory + '/' + f) and f.endswith('py')]
+""" Set ROCKWREN_INLINE_ASSETS=1 to build pages that load with a single request """
+INLINE_ASSETS = os.environ.get("ROCKWREN_INLINE_ASSETS", "0") not in ("", "0")
+""" Stylesheet included by the template engine on every request e.g. {{render_template(web_path + "/style.css")}} """
+TEMPLATE_INCLUDE = re.compile(r'{{\s*render_template\(web_path \+ "/([\w.-]+)"\)\s*}}')
+""" Asset references.  Attribute quotes are optional as they are removed by minify_html. """
+ICON_LINK = re.compile(r'<link\b[^>]*\brel="?icon\b[^>]*>')
+SCRIPT_SRC = re.compile(r'<script\b[^>]*\bsrc="?/([\w.-]+)"?[^>]*></script>')
+HREF = re.compile(r'\bhref="?/([\w.-]+)')
+""" Subresources fetched by the browser with a separate request """
+SUBRESOURCE = re.compile(r'<(?:link|script|img)\b[^>]*?\b(?:href|src)="?/([\w./-]+)')
+XML_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+WHITESPACE = re.compile(r'\s+')
 
-    total_size = 0
-    total_minified_size = 0
 
-    for filename in files:
-        size = os.stat(filename).st_size
-        minified_size = 0
-        minified = None
-        with open(filename) as f:
-            minified = python_minifier.minify(f.read())
-            minified_size = len(minified)
-            total_size += size
-        with open(filename, 'w') as f:
-            f.write(minified)
-        total_minified_size += minified_size
-        print(f"{filename}: Size: {total_size}, minified size: {total_minified_size}, "
-              f"%{total_minified_size / total_size * 100:.0f}")
+def read_asset(directory, name):
+    with open(directory + '/' + name) as f:
+        return f.read()
 
 
-def minify_html_css_js_file(filename):
-    """ Minify a file.  Must be a html, css or js. """
+def svg_data_uri(svg):
+    """ :return: the svg as a compact data URI.  Braces are escaped so they are not read as template expressions. """
+    svg = WHITESPACE.sub(' ', XML_COMMENT.sub('', svg)).replace('> <', '><').replace('"', "'").strip()
+    return 'data:image/svg+xml,' + urllib.parse.quote(svg, safe=" /:=;,'()")
 
-    with open(filename, 'r') as f:
-        minified = minify_html.minify(f.read(), minify_js=True, remove_processing_instructions=True)
-        minified_size = len(minified)
+
+def inline_assets_file(filename, directory):
+    """ Inline the stylesheet, favicon (as a data URI) and scripts referenced by a html page. """
+
+    with open(filename) as f:
+        page = f.read()
+    page = TEMPLATE_INCLUDE.sub(lambda m: WHITESPACE.sub(' ', CSS_COMMENT.sub('', read_asset(directory, m.group(1))))
+                                .strip(), page)
+    page = ICON_LINK.sub(lambda m: '<link rel="icon" type="image/svg+xml" href="'
+                         + svg_data_uri(read_asset(directory, HREF.search(m.group(0))[1])) + '">', page)
+    page = SCRIPT_SRC.sub(lambda m: '<script>' + read_asset(directory, m.group(1)) + '</script>', page)
     with open(filename, 'w') as f:
-        f.seek(0)
-        f.write(minified)
-    return minified_size
+        f.write(page)
+
+
+def inline_assets_dir(directory):
+    """ Inline the assets referenced by all html pages in the directory so each page loads with one request. """
+
+    for f in os.listdir(directory):
+        if f.endswith('html'):
+            inline_assets_file(directory + '/' + f, directory)
+
+
+def report_page_requests(directory):
+    """ Print the number of HTTP requests and bytes needed to load each html page in the directory. """
+
+    for f in sorted(os.listdir(directory)):
+        if not f.endswith('html'):
+            continue
+        page = read_asset(directory, f)
+        if '<title' not in page:
+            # Fragment included in another page
+            continue
+        size = len(page.encode())
+        for name in TEMPLATE_INCLUDE.findall(page):
+            size += os.stat(directory + '/' + name).st_size
+        requests = 1
+        for name in SUBRESOURCE.findall(page):
+            if os.path.isfile(directory + '/' + name):
+                requests += 1
+                size += os.stat(directory + '/' + name).st_size
+        print(f"{directory}/{f}: Requests: {requests}, bytes: {size}")
+
+
+""" Committed footprint baseline.  Set ROCKWREN_FOOTPRINT_UPDATE=1 to record the footprint of this build as the
+    baseline and ROCKWREN_FOOTPRINT_GROWTH to override the allowed growth e.g. 0.1 for 10%. """
+FOOTPRINT_BASELINE = Path(__file__).parent.resolve() / 'footprint.json'
+FOOTPRINT_UPDATE = os.environ.get("ROCKWREN_FOOTPRINT_UPDATE", "0") not in ("", "0")
+FOOTPRINT_GROWTH = os.environ.get("ROCKWREN_FOOTPRINT_GROWTH")
+FOOTPRINT_METRICS = ("source", "minified", "mpy", "import_heap")
+""" MicroPython unix port used to measure the heap allocated by importing each module """
+MICROPYTHON = os.environ.get("MICROPYTHON") or shutil.which("micropython")
+""" Run on the MicroPython unix port with the tests/heap stand-ins.  Prints the heap allocated by each import. """
+IMPORT_HEAP_SCRIPT = """
+import gc
+import sys
+import standins
+standins.install()
+from phew import logging, server, template
+import rockwren
+for name in {modules!r}:
+    if "rockwren." + name in sys.modules:
+        continue
+    gc.collect()
+    start = gc.mem_alloc()
+    __import__("rockwren." + name)
+    gc.collect()
+    print("IMPORT", name, gc.mem_alloc() - start)
+"""
+
 
+def file_sizes(directory):
+    """ :return: dict of file name to size for the files in the directory """
 
-def minify_html_css_js_dir(directory):
-    """ Minify all html, css, and javascript files in the directory. """
+    return {f: os.stat(directory + '/' + f).st_size for f in sorted(os.listdir(directory))
+            if os.path.isfile(directory + '/' + f)}
 
-    files = [directory + '/' + f for f in os.listdir(directory) if os.path.isfile(directory + '/' + f)
-             and (f.endswith('html') or f.endswith('css') or f.endswith('js'))]
 
-    total_size = 0
-    total_minified_size = 0
+def mpy_size(filename):
+    """ :return: size of the file compiled by mpy-cross or None if mpy-cross is not installed """
 
-    for filename in files:
-        size = os.stat(filename).st_size
-        minified_size = minify_html_css_js_file(filename)
-        total_size += size
-        total_minified_size += minified_size
-        print(f"{filename}: Size: {total_size}, minified size: {total_minified_size}, "
-              f"%{total_minified_size / total_size * 100:.0f}")
+    if mpy_cross is None:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        output = tmp + '/' + Path(filename).stem + '.mpy'
+        if mpy_cross.run(filename, '-o', output).wait() != 0:
+            raise SystemExit(f"mpy-cross failed to compile {filename}")
+        return os.stat(output).st_size
+
+
+def import_order(directory):
+    """ :return: module names ordered so each module's package relative imports come before it """
+
+    imports = {}
+    for f in os.listdir(directory):
+        if f.endswith('.py') and f != '__init__.py':
+            with open(directory + '/' + f) as source:
+                tree = ast.parse(source.read())
+            imports[f[:-3]] = {alias.name for node in ast.walk(tree)
+                               if isinstance(node, ast.ImportFrom) and node.level == 1 for alias in node.names}
+    order = []
+
+    def visit(name, visiting):
+        if name in order or name in visiting or name not in imports:
+            return
+        visiting.add(name)
+        for dependency in sorted(imports[name]):
+            visit(dependency, visiting)
+        order.append(name)
+
+    for name in sorted(imports):
+        visit(name, set())
+    return order
+
+
+def import_heap_costs(directory):
+    """ :return: dict of module name to heap bytes allocated by importing it on the MicroPython unix port.  Empty if
+        micropython is not installed.  A module already imported by an earlier module in an import cycle is not
+        measured separately.
+    """
+
+    here = Path(__file__).parent.resolve()
+    stand_ins = here / 'tests' / 'heap'
+    if not MICROPYTHON or not stand_ins.is_dir():
+        return {}
+    path = [".frozen", str(stand_ins), str(here / 'phew'), os.path.expanduser("~/.micropython/lib"),
+            os.path.abspath(directory + '/..')]
+    completed = subprocess.run([MICROPYTHON, "-c", IMPORT_HEAP_SCRIPT.format(modules=import_order(directory))],
+                               cwd=tempfile.gettempdir(), env=dict(os.environ, MICROPYPATH=":".join(path)),
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120)
+    output = completed.stdout.decode(errors="replace")
+    if completed.returncode != 0:
+        raise SystemExit(f"Measuring import heap cost failed\n{output}")
+    return {m.group(1): int(m.group(2)) for m in re.finditer(r'^IMPORT (\w+) (\d+)$', output, re.MULTILINE)}
+
+
+def footprint(directory, source_sizes):
+    """ :return: dict of file to source, minified, mpy and import heap bytes for each minified file in the directory.
+        Sizes that cannot be measured in this build environment are None.
+    """
+
+    package = os.path.basename(directory)
+    heap = import_heap_costs(directory)
+    report = {}
+    for f, size in file_sizes(directory).items():
+        if f not in source_sizes:
+            continue
+        py = f.endswith('.py')
+        report[package + '/' + f] = {"source": source_sizes[f],
+                                     "minified": size,
+                                     "mpy": mpy_size(directory + '/' + f) if py else None,
+                                     "import_heap": heap.get(f[:-3]) if py else None}
+    return report
+
+
+def footprint_totals(report):
+    """ :return: dict of metric to total over the files that have the metric or None if no file has it """
+
+    totals = {}
+    for metric in FOOTPRINT_METRICS:
+        sizes = [sizes[metric] for sizes in report.values() if sizes[metric] is not None]
+        totals[metric] = sum(sizes) if sizes else None
+    return totals
+
+
+def print_footprint(report, baseline):
+    """ Print the size of each file with the change from the baseline. """
+
+    def cell(sizes, base, metric):
+        value = sizes[metric]
+        if value is None:
+            return '-'
+        if base is None or base.get(metric) is None:
+            return str(value)
+        return f"{value} ({value - base[metric]:+})"
+
+    print(f"{'Footprint':<32} {'source':>16} {'minified':>16} {'mpy':>16} {'import heap':>16}")
+    for f, sizes in report.items():
+        base = baseline.get(f)
+        print(f"{f:<32} " + " ".join(f"{cell(sizes, base, metric):>16}" for metric in FOOTPRINT_METRICS))
+    totals = footprint_totals(report)
+    base_totals = footprint_totals(baseline) if baseline else None
+    print(f"{'Total':<32} " + " ".join(f"{cell(totals, base_totals, metric):>16}" for metric in FOOTPRINT_METRICS))
+
+
+def check_footprint(report, baseline, budget):
+    """ :return: list of the files and totals that have grown by more than the budget since the baseline.
+        A file or total is over budget when it grows by more than both the growth fraction and min_growth_bytes.
+        Sizes not measured in either build are not compared.
+    """
+
+    def over(name, sizes, base):
+        for metric in ("minified", "mpy", "import_heap"):
+            if sizes.get(metric) is None or base.get(metric) is None:
+                continue
+            growth = sizes[metric] - base[metric]
+            if growth > budget["min_growth_bytes"] and growth > base[metric] * budget["growth"]:
+                failures.append(f"{name} {metric}: {base[metric]} -> {sizes[metric]} bytes ({growth:+})")
+
+    failures = []
+    for f, sizes in report.items():
+        if f in baseline:
+            over(f, sizes, baseline[f])
+    measured = {f: sizes for f, sizes in baseline.items() if f in report}
+    totals = footprint_totals(report)
+    base_totals = footprint_totals(measured)
+    # New files count towards the totals.  Compare totals only over metrics measured in both builds.
+    for metric in FOOTPRINT_METRICS:
+        if any(sizes[metric] is None for sizes in measured.values()) or \
+                any(report[f][metric] is None for f in measured):
+            totals[metric] = base_totals[metric] = None
+    over("Total", totals, base_totals)
+    return failures
+
+
+def report_footprint(directory, source_sizes):
+    """ Print the per file footprint of the build and compare it with the committed baseline for this build variant.
+        Exits with an error when the footprint has grown beyond the budget.
+    """
+
+    variant = "inline" if INLINE_ASSETS else "default"
+    baselines = {"budget": {"growth": 0.05, "min_growth_bytes": 256}}
+    if FOOTPRINT_BASELINE.is_file():
+        with open(FOOTPRINT_BASELINE) as f:
+            baselines = json.load(f)
+    budget = dict(baselines["budget"])
+    if FOOTPRINT_GROWTH:
+        budget["growth"] = float(FOOTPRINT_GROWTH)
+    baseline = baselines.get(variant, {})
+
+    report = footprint(directory, source_sizes)
+    print_footprint(report, baseline)
+
+    if FOOTPRINT_UPDATE:
+        baselines[variant] = report
+        with open(FOOTPRINT_BASELINE, 'w') as f:
+            json.dump(baselines, f, indent=2)
+            f.write('\n')
+        print(f"Footprint baseline for the {variant} build recorded in {FOOTPRINT_BASELINE}")
+        return
+    failures = check_footprint(report, baseline, budget)
+    if failures:
+        raise SystemExit(f"Footprint exceeds the budget of {budget['growth']:.0%} growth over {FOOTPRINT_BASELINE}:\n"
+                         + "\n".join(failures)
+                         + "\nReduce the footprint or record a new baseline with ROCKWREN_FOOTPRINT_UPDATE=1")
 
 
 class SdistAndMinify(sdist):
@@ -73,11 +302,25 @@ class SdistAndMinify(sdist):
         """ make_release_tree creates the directory tree for the source distribution archive.
             Extended by this class to minify the python, html and css files before packaging into a sdist tar or
             wheel.  Minification is done after the super().make_release_tree so the files are copied to base_dir but
-            not yet packaged.
+            not yet packaged.  Files are minified in parallel by minifier.py, which caches the output so unchanged
+            files are not minified again.
+            When ROCKWREN_INLINE_ASSETS is set, the minified stylesheet, favicon and scripts are inlined into each
+            page so a page loads with one request instead of fetching the assets separately.
+            The per file footprint is then reported and checked against the budget in footprint.json.
         """
+        # minifier.py is in the source tree, it is not part of the sdist as it is not needed to build the wheel
+        sys.path.insert(0, str(here))
+        from minifier import minify_html_css_js_dir
+        from minifier import minify_py_dir
+
         super().make_release_tree(base_dir, files)
+        source_sizes = file_sizes(base_dir + '/rockwren')
         minify_html_css_js_dir(base_dir + '/rockwren')
+        if INLINE_ASSETS:
+            inline_assets_dir(base_dir + '/rockwren')
+        report_page_requests(base_dir + '/rockwren')
         minify_py_dir(base_dir + '/rockwren')
+        report_footprint(base_dir + '/rockwren', source_sizes)
 
 
 here = Path(__file__).parent.resolve()
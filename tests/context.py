@@ -1,9 +1,27 @@
 # SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+import contextlib
 import os
 import sys
+import unittest
+from unittest.mock import patch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import rockwren
+
+
+def patch_modules(modules: dict):
+    """ Install stand-ins for the MicroPython modules until the calling test module is torn down.  Call from
+        setUpModule then import the rockwren modules under test.  They are imported afresh against the stand-ins and
+        the modules and package attributes in place before are restored afterwards, so each test module passes alone
+        and in any order.  The patches are entered as context managers so they are not stopped by patch.stopall().
+    """
+    stack = contextlib.ExitStack()
+    stack.enter_context(patch.dict(sys.modules, modules))
+    stack.enter_context(patch.dict(rockwren.__dict__))
+    unittest.addModuleCleanup(stack.close)
+    for name in [name for name in sys.modules if name.startswith("rockwren.")]:
+        del sys.modules[name]
+        rockwren.__dict__.pop(name.split(".")[1], None)
@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import base64
+import binascii
+import os
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from .context import patch_modules
+
+DER = bytes(range(256)) * 4
+
+
+def pem(der, label="CERTIFICATE"):
+    encoded = base64.b64encode(der).decode()
+    lines = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+    # No trailing newline, as pasted into the configuration form
+    return "\n".join([f"-----BEGIN {label}-----"] + lines + [f"-----END {label}-----"])
+
+
+def setUpModule():
+    global credentials
+    patch_modules({"ubinascii": binascii, "phew": mock.MagicMock()})
+    from rockwren import credentials
+
+
+class Database(dict):
+    """ Configuration counting saves """
+    saves = 0
+
+    def save(self):
+        self.saves += 1
+
+
+class TestCredentials(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        cert_file = os.path.join(self.directory.name, "cert.der")
+        key_file = os.path.join(self.directory.name, "key.der")
+        for patcher in (patch.object(credentials, "CERT_FILE", cert_file),
+                        patch.object(credentials, "KEY_FILE", key_file),
+                        patch.dict(credentials.FILES, {"mqtt_client_cert": cert_file, "mqtt_client_key": key_file}),
+                        patch.object(credentials.utils, "ubinascii", binascii)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_save_der(self):
+        self.assertIsNone(credentials.ssl_params())
+        self.assertTrue(credentials.save("mqtt_client_cert", pem(DER)))
+        self.assertTrue(credentials.stored("mqtt_client_cert"))
+        self.assertIsNone(credentials.ssl_params())
+        credentials.save("mqtt_client_key", pem(DER[:100], "RSA PRIVATE KEY") + "\r\n")
+        self.assertEqual({"key": DER[:100], "cert": DER, "server_side": False}, credentials.ssl_params())
+        # Unchanged when the same certificate is saved again
+        self.assertFalse(credentials.save("mqtt_client_cert", pem(DER)))
+
+    def test_remove(self):
+        credentials.save("mqtt_client_key", pem(DER))
+        self.assertTrue(credentials.save("mqtt_client_key", ""))
+        self.assertFalse(credentials.stored("mqtt_client_key"))
+        self.assertFalse(credentials.save("mqtt_client_key", ""))
+
+    def test_migrate(self):
+        database = Database({"mqtt_client_cert": pem(DER), "mqtt_client_key": None, "mqtt_port": 1883})
+        credentials.migrate(database)
+        self.assertTrue(credentials.stored("mqtt_client_cert"))
+        self.assertFalse(credentials.stored("mqtt_client_key"))
+        # Only the DER is kept
+        self.assertEqual({"mqtt_port": 1883}, database)
+        self.assertEqual(1, database.saves)
+        credentials.migrate(database)
+        self.assertEqual(1, database.saves)
+        # Not converted again once stored, the PEM is removed
+        database["mqtt_client_cert"] = pem(DER)
+        with patch.object(credentials, "save") as save:
+            credentials.migrate(database)
+            save.assert_not_called()
+        self.assertEqual({"mqtt_port": 1883}, database)
+
+    def test_migrate_invalid_pem_kept(self):
+        database = Database({"mqtt_client_cert": "-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----"})
+        with self.assertRaises(ValueError):
+            credentials.migrate(database)
+        self.assertIn("mqtt_client_cert", database)
+        self.assertEqual(0, database.saves)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from .context import rockwren
+
+import deploy
+
+
+class TestDeploy(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.source = os.path.join(tmp.name, "lib")
+        self.device = os.path.join(tmp.name, "device")
+        self.target = deploy.DirectoryTarget(self.device)
+        self.write("rockwren/web.py", "web = 1\n")
+        self.write("rockwren/index.html", "<html></html>\n")
+        self.write("rockwren/__pycache__/web.cpython-311.pyc", "compiled")
+        self.write("phew/server.py", "server = 1\n")
+
+    def write(self, path, content):
+        filename = os.path.join(self.source, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write(content)
+
+    def device_file(self, path):
+        return os.path.join(self.device, "lib", path)
+
+    def test_first_deploy_copies_everything(self):
+        report = deploy.deploy(self.source, "lib", self.target)
+        self.assertEqual(3, report["copied"])
+        self.assertEqual(0, report["skipped"])
+        self.assertEqual(8 + 14 + 11, report["copied_bytes"])
+        self.assertTrue(os.path.isfile(self.device_file("rockwren/web.py")))
+        self.assertFalse(os.path.exists(self.device_file("rockwren/__pycache__")))
+        with open(self.device_file(deploy.MANIFEST)) as f:
+            self.assertEqual(["phew/server.py", "rockwren/index.html", "rockwren/web.py"], sorted(json.load(f)))
+
+    def test_only_changed_files_are_copied(self):
+        deploy.deploy(self.source, "lib", self.target)
+        self.write("rockwren/web.py", "web = 2\n")
+        report = deploy.deploy(self.source, "lib", self.target)
+        self.assertEqual(["rockwren/web.py"], report["files"])
+        self.assertEqual(2, report["skipped"])
+        self.assertEqual(14 + 11, report["skipped_bytes"])
+        with open(self.device_file("rockwren/web.py")) as f:
+            self.assertEqual("web = 2\n", f.read())
+
+        report = deploy.deploy(self.source, "lib", self.target)
+        self.assertEqual(0, report["copied"])
+        self.assertEqual(3, report["skipped"])
+
+    def test_removed_files_are_deleted(self):
+        deploy.deploy(self.source, "lib", self.target)
+        os.remove(os.path.join(self.source, "phew/server.py"))
+        report = deploy.deploy(self.source, "lib", self.target)
+        self.assertEqual(["phew/server.py"], report["removed_files"])
+        self.assertFalse(os.path.exists(self.device_file("phew/server.py")))
+        self.assertNotIn("phew/server.py", self.target.read_manifest("lib"))
+
+    def test_patterns(self):
+        deploy.deploy(self.source, "lib", self.target)
+        os.remove(os.path.join(self.source, "phew/server.py"))
+        self.write("rockwren/index.html", "<html>changed</html>\n")
+        report = deploy.deploy(self.source, "lib", self.target, ["rockwren/*.html"])
+        self.assertEqual(["rockwren/index.html"], report["files"])
+        # Files not matching the patterns are neither removed nor dropped from the manifest
+        self.assertEqual([], report["removed_files"])
+        self.assertTrue(os.path.exists(self.device_file("phew/server.py")))
+        self.assertIn("rockwren/web.py", self.target.read_manifest("lib"))
+
+    def test_force_and_dry_run(self):
+        deploy.deploy(self.source, "lib", self.target)
+        self.assertEqual(3, deploy.deploy(self.source, "lib", self.target, force=True)["copied"])
+        self.write("rockwren/web.py", "web = 3\n")
+        report = deploy.deploy(self.source, "lib", self.target, dry_run=True)
+        self.assertEqual(["rockwren/web.py"], report["files"])
+        with open(self.device_file("rockwren/web.py")) as f:
+            self.assertEqual("web = 1\n", f.read())
+
+
+class TestMpremoteTarget(unittest.TestCase):
+
+    def test_session(self):
+        target = deploy.MpremoteTarget(device="/dev/ttyUSB0")
+        copy = [f"rockwren/m{i}.py" for i in range(deploy.BATCH_FILES + 1)] + ["phew/server.py"]
+        args = target.session("build/lib", "lib", copy, ["rockwren/old.py"], "manifest.json")
+        commands = " ".join(target.command(*args)).split(" + ")
+        self.assertTrue(commands[0].startswith("mpremote connect /dev/ttyUSB0 exec "))
+        self.assertIn("['lib', 'lib/phew', 'lib/rockwren']", commands[0])
+        self.assertIn("['lib/rockwren/old.py']", commands[0])
+        self.assertEqual(f"cp {' '.join(os.path.join('build/lib', p) for p in copy[:deploy.BATCH_FILES])} "
+                         f":lib/rockwren/", commands[1])
+        self.assertEqual(f"cp {os.path.join('build/lib', copy[deploy.BATCH_FILES])} :lib/rockwren/", commands[2])
+        self.assertEqual(f"cp {os.path.join('build/lib', 'phew/server.py')} :lib/phew/", commands[3])
+        self.assertEqual("cp manifest.json :lib/.deploy-manifest.json", commands[4])
+
+    def test_read_manifest(self):
+        target = deploy.MpremoteTarget()
+        completed = subprocess.CompletedProcess([], 0, b'{"rockwren/web.py": "0123456789abcdef"}\r\n', b"")
+        with mock.patch.object(deploy.subprocess, "run", return_value=completed) as run:
+            self.assertEqual({"rockwren/web.py": "0123456789abcdef"}, target.read_manifest("lib"))
+        self.assertEqual(["mpremote", "exec"], run.call_args[0][0][:2])
+        completed = subprocess.CompletedProcess([], 1, b"", b"no device found")
+        with mock.patch.object(deploy.subprocess, "run", return_value=completed):
+            with self.assertRaises(SystemExit):
+                target.read_manifest("lib")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from .context import patch_modules
+
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global rockwren_device, CountingDevice
+    patch_modules({"micropython": micropython_mock, "machine": mock.MagicMock(), "network": mock.MagicMock(),
+                   "ntptime": mock.MagicMock(), "uasyncio": mock.MagicMock(), "ubinascii": mock.MagicMock(),
+                   "usocket": mock.MagicMock(), "umqtt": mock.MagicMock(), "umqtt.robust2": mock.MagicMock(),
+                   "phew": mock.MagicMock(), "ujson": json})
+    from rockwren import rockwren as rockwren_device
+    CountingDevice = type("CountingDevice", (Counting, rockwren_device.Device), {})
+
+
+class Counting:
+    """ Device mixin counting the number of times state is applied """
+
+    def __init__(self):
+        self.applied = 0
+        self.brightness = 0
+        super().__init__(name="CountingDevice")
+
+    def web_post_handler(self, form):
+        if form.get("brightness") is not None:
+            self.brightness = form["brightness"]
+            self.apply_state()
+            return self.device_state(), 200
+        return super().web_post_handler(form)
+
+    def apply_state(self):
+        if not self.apply_deferred:
+            self.applied += 1
+        super().apply_state()
+
+
+class TestDeviceBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.device = CountingDevice()
+        self.device.applied = 0
+
+    def test_batch_applies_state_once(self):
+        state, status = self.device.web_batch_handler([{"state": "ON"}, {"brightness": 50}, {"toggle": "true"},
+                                                        {"toggle": "true"}])
+        self.assertEqual(200, status)
+        self.assertEqual({"state": "ON"}, rockwren_device.ujson.loads(state))
+        self.assertEqual(50, self.device.brightness)
+        self.assertEqual(1, self.device.applied)
+
+    def test_batch_stops_at_failed_command(self):
+        resp, status = self.device.web_batch_handler([{"state": "ON"}, {}, {"state": "OFF"}])
+        self.assertEqual(400, status)
+        self.assertEqual(1, rockwren_device.ujson.loads(resp)["index"])
+        self.assertTrue(self.device.is_on())
+        self.assertEqual(1, self.device.applied)
+        self.device.off()
+        self.assertEqual(2, self.device.applied)
+
+    def test_listeners_notified_once(self):
+        with patch.object(self.device, "notify_listeners") as notify_listeners:
+            self.device.web_batch_handler([{"state": "ON"}, {"toggle": "true"}])
+        notify_listeners.assert_called_once_with()
+
+    def test_nested_batch(self):
+        web_post_handler = self.device.web_post_handler
+
+        def nested(form):
+            if form.get("batch"):
+                return self.device.web_batch_handler(form["batch"])
+            return web_post_handler(form)
+
+        self.device.web_post_handler = nested
+        state, status = self.device.web_batch_handler([{"batch": [{"state": "ON"}, {"brightness": 20}]},
+                                                        {"brightness": 70}])
+        self.assertEqual(200, status)
+        self.assertEqual(70, self.device.brightness)
+        self.assertEqual(1, self.device.applied)
+        self.assertEqual(0, self.device.apply_deferred)
+
+    def test_empty_batch(self):
+        resp, status = self.device.web_batch_handler([])
+        self.assertEqual(400, status)
+        self.assertEqual(0, self.device.applied)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import asyncio
+import importlib
+import unittest
+
+from .context import rockwren
+
+fleet_config = importlib.import_module("fleet-config")
+
+
+class TestFleetConfig(unittest.TestCase):
+
+    def configure(self, response: bytes):
+        """ :return: configure_device result for a device responding with response """
+
+        async def respond(reader, writer):
+            await reader.read(1024)
+            writer.write(response)
+            await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(respond, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                return await fleet_config.configure_device(asyncio.Semaphore(1), "127.0.0.1", port,
+                                                           {"publish_interval": 30}, 5, 2)
+
+        return asyncio.run(run())
+
+    def test_configured(self):
+        host, status, result, _ = self.configure(
+            b'HTTP/1.1 200 OK\r\n\r\n{"changed": {"publish_interval": [60, 30]}, "action": "none"}')
+        self.assertEqual(("127.0.0.1", 200, "none"), (host, status, result["action"]))
+
+    def test_invalid_response_reported(self):
+        for response in (b"", b"garbage", b"HTTP/1.1 OK\r\n\r\n"):
+            host, status, result, _ = self.configure(response)
+            self.assertIsNone(status)
+            self.assertIn("invalid response", result)
+
+
+if __name__ == '__main__':
+    unittest.main()
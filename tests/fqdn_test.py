@@ -3,9 +3,8 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import unittest
 from unittest import mock
-from unittest.mock import patch
 
-from .context import rockwren
+from .context import patch_modules
 
 spi_mock = mock.Mock()
 
@@ -13,15 +12,14 @@ machine_mock = mock.MagicMock()
 machine_mock.Pin = mock.MagicMock()
 machine_mock.SPI = mock.MagicMock(return_value=spi_mock)
 gc_mock = mock.MagicMock()
-patch.dict("sys.modules", machine=machine_mock).start()
-patch.dict("sys.modules", gc=gc_mock).start()
-patch.dict("sys.modules", uasyncio=mock.MagicMock()).start()
-patch.dict("sys.modules", usocket=mock.MagicMock()).start()
-patch.dict("sys.modules", ntptime=mock.MagicMock()).start()
-patch.dict("sys.modules", ubinascii=mock.MagicMock()).start()
-patch.dict("sys.modules", ujson=mock.MagicMock()).start()
-
-from rockwren import utils
+
+
+def setUpModule():
+    global utils
+    patch_modules({"machine": machine_mock, "gc": gc_mock, "uasyncio": mock.MagicMock(), "usocket": mock.MagicMock(),
+                   "ntptime": mock.MagicMock(), "ubinascii": mock.MagicMock(), "ujson": mock.MagicMock()})
+    from rockwren import utils
+
 
 class TestFQDNUtil(unittest.TestCase):
 
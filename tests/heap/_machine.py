@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+``machine`` stand-in for the MicroPython unix port.  Installed in ``sys.modules`` by scenarios.py.
+"""
+import sys
+import time
+
+UNIQUE_ID = b"\xe6\x61\x41\x04\x03\x2b\x6b\x2c"
+
+
+def unique_id():
+    return UNIQUE_ID
+
+
+def reset():
+    # fly() resets after an unhandled exception, which fails the scenario
+    print("RESET")
+    sys.exit(2)
+
+
+def soft_reset():
+    reset()
+
+
+def freq(hz=None):
+    return 80000000 if hz is None else None
+
+
+class RTC:
+
+    def datetime(self, datetime=None):
+        if datetime is not None:
+            return None
+        t = time.localtime()
+        return t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = value if value is not None else 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        pass
+
+
+class ADC:
+
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        return 14021
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        pass
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        pass
+
+    def deinit(self):
+        pass
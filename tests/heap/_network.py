@@ -0,0 +1,60 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+``network`` stand-in for the MicroPython unix port.  The station interface connects immediately.
+"""
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+_hostname = "rockwren"
+
+
+def hostname(name=None):
+    global _hostname
+    if name is None:
+        return _hostname
+    _hostname = name
+
+
+class WLAN:
+
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self._active = bool(active)
+
+    def connect(self, ssid=None, password=None, bssid=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def isconnected(self):
+        return self._active
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -45
+        return STAT_GOT_IP if self._active else STAT_IDLE
+
+    def ifconfig(self, config=None):
+        return "127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1"
+
+    def config(self, *args, **kwargs):
+        if args:
+            return b"\x02\x00\x00\x00\x00\x02" if args[0] == "mac" else ""
+
+    def scan(self):
+        return [(b"heap-test", b"\x02\x00\x00\x00\x00\x01", 6, -45, 3, 0)]
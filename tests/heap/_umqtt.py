@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+``umqtt.robust2`` and ``ntptime`` stand-in for the MicroPython unix port.  No connection is made: publications are
+counted and received messages are queued with ``deliver()``.
+"""
+clients = []
+
+
+def settime():
+    pass
+
+
+class MQTTClient:
+    DEBUG = False
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False,
+                 ssl_params=None, socket_timeout=5, message_timeout=10):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.cb = None
+        self.conn_issue = None
+        self.inbox = []
+        self.publishes = 0
+        self.published_bytes = 0
+        clients.append(self)
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    def connect(self, clean_session=True):
+        return False
+
+    def disconnect(self):
+        pass
+
+    def reconnect(self):
+        return False
+
+    def resubscribe(self):
+        pass
+
+    def subscribe(self, topic, qos=0, resubscribe=True):
+        pass
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self.publishes += 1
+        self.published_bytes += len(msg)
+
+    def ping(self):
+        pass
+
+    def is_conn_issue(self):
+        return False
+
+    def deliver(self, topic, msg):
+        """ Queue a message as if received from the broker. """
+        self.inbox.append((topic, msg))
+
+    def check_msg(self):
+        if self.inbox and self.cb:
+            topic, msg = self.inbox.pop(0)
+            self.cb(topic, msg, False, False)
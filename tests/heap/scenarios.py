@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Constrained heap scenarios run on the MicroPython unix port by tests/heap_test.py:
+
+    micropython -X heapsize=256k tests/heap/scenarios.py <scenario> <rockwren dir> <http port> <free heap>
+
+The device boots through ``rockwren.fly()``.  For scenarios other than ``boot``, a ballast allocation then leaves
+``free heap`` bytes free, as on an ESP8266, before the scenario runs.  The live heap is sampled after a garbage
+collection at each step and the peak above the starting allocation is printed as ``HEAP <scenario> <bytes>``.
+
+A ``MemoryError``, or any other exception, is handled by ``fly()`` which resets the device.  The ``machine`` stand-in
+then exits with status 2.
+"""
+import gc
+import sys
+
+SCENARIO = sys.argv[1]
+ROCKWREN_DIR = sys.argv[2]
+HTTP_PORT = int(sys.argv[3])
+FREE_HEAP = int(sys.argv[4])
+
+import standins
+
+standins.install()
+
+import _umqtt
+import uasyncio
+
+with open("env.json", "w") as f:
+    f.write('{"ssid": "heap-test", "password": "heap-test", "first_boot": false, "mqtt_server": "127.0.0.1", '
+            '"mqtt_port": 1883, "log_level": "info"}')
+
+gc.collect()
+_start = gc.mem_alloc()
+_peak = 0
+
+from phew import logging
+from rockwren import logsink
+from rockwren import mqtt_client
+from rockwren import rockwren
+from rockwren import web
+
+logsink.LOG_FILE = "log.txt"
+web.DIR_PATH = ROCKWREN_DIR
+
+_web_run = web.run
+
+
+def _run_web(loop, host="127.0.0.1", port=80):
+    _web_run(loop, "127.0.0.1", HTTP_PORT)
+
+
+web.run = _run_web
+
+
+class HeapTestDevice(rockwren.Device):
+
+    def __init__(self):
+        super().__init__(name="HeapTestDevice")
+        self.template = ROCKWREN_DIR + "/controls.html"
+
+    def command_handler(self, topic, message):
+        if message.get("state") == "ON":
+            self.state = "ON"
+        elif message.get("state") == "OFF":
+            self.state = "OFF"
+        super().command_handler(topic, message)
+
+    def discovery_function(self):
+        return mqtt_client.default_discovery(self.mqtt_client)
+
+
+device = HeapTestDevice()
+
+
+def sample():
+    """ Record the live heap after a garbage collection. """
+    global _peak
+    gc.collect()
+    used = gc.mem_alloc() - _start
+    if used > _peak:
+        _peak = used
+
+
+async def request(path, method="GET", body=""):
+    """ :return: the HTTP status code of a request to the device web server """
+    reader, writer = await uasyncio.open_connection("127.0.0.1", HTTP_PORT)
+    headers = f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n" if body else ""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n{headers}\r\n{body}".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while await reader.read(256):
+        sample()
+    writer.close()
+    await writer.wait_closed()
+    sample()
+    if status != 200:
+        raise AssertionError(f"{method} {path} returned {status}")
+    return status
+
+
+async def boot():
+    await uasyncio.sleep_ms(500)
+    sample()
+
+
+async def discovery():
+    for _ in range(5):
+        device.mqtt_client.send_discovery_msgs()
+        sample()
+        await uasyncio.sleep_ms(0)
+
+
+async def web_routes():
+    for path in ("/", "/device", "/device/state", "/information", "/mqtt_config", "/config", "/metrics",
+                 "/favicon.svg"):
+        await request(path)
+    for state in ("ON", "OFF", "ON"):
+        await request("/device/control", "POST", "state=" + state)
+
+
+async def commands():
+    client = _umqtt.clients[0]
+    for burst in range(5):
+        for i in range(10):
+            client.deliver(device.mqtt_client.command_topic, b'{"state": "ON"}' if i % 2 else b'{"state": "OFF"}')
+        while client.inbox or device.mqtt_client._commands:
+            await uasyncio.sleep_ms(10)
+            sample()
+
+
+async def logs():
+    for i in range(200):
+        logging.info(f"Heap test log line {i} padded to the length of a typical rockwren log message")
+    logsink.flush()
+    sample()
+    await request("/viewlogs")
+    await request("/log")
+
+
+SCENARIOS = {"boot": boot, "discovery": discovery, "web": web_routes, "commands": commands, "logs": logs}
+
+
+async def run_scenario():
+    global _start, _peak
+    await uasyncio.sleep_ms(100)  # let the web server and mqtt handler start
+    ballast = None
+    if SCENARIO == "boot":
+        await boot()
+    else:
+        gc.collect()
+        ballast = bytearray(max(0, gc.mem_free() - FREE_HEAP))
+        gc.collect()
+        _start = gc.mem_alloc()
+        _peak = 0
+        await SCENARIOS[SCENARIO]()
+    print("HEAP", SCENARIO, _peak)
+    raise KeyboardInterrupt  # ends fly()
+
+
+uasyncio.create_task(run_scenario())
+rockwren.fly(device)
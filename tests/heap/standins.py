@@ -0,0 +1,25 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Install the ``machine``, ``network``, ``ntptime`` and ``umqtt.robust2`` stand-ins so rockwren can be imported and run
+on the MicroPython unix port.
+"""
+import sys
+
+import _machine
+import _network
+import _umqtt
+
+
+def install():
+    sys.modules["machine"] = _machine
+    sys.modules["network"] = _network
+    sys.modules["ntptime"] = _umqtt
+    sys.modules["umqtt"] = _umqtt
+    sys.modules["umqtt.robust2"] = _umqtt
+    try:
+        import uasyncio
+    except ImportError:
+        import asyncio
+        sys.modules["uasyncio"] = asyncio
@@ -0,0 +1,112 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Constrained heap regression tests.  The scenarios in tests/heap/scenarios.py are run on the MicroPython unix port with
+the heap size and free heap set in tests/heap/budgets.json.  A scenario fails on a ``MemoryError``, or any other
+error, or when its peak heap use exceeds its budget.
+
+Skipped unless ``micropython`` is on the path or the ``MICROPYTHON`` environment variable names the binary.  phew is
+found in the phew submodule or ``~/.micropython/lib``.  Budgets are recorded, with headroom, by:
+
+    python -m tests.heap_test --record
+"""
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HEAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "heap")
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGETS_FILE = os.path.join(HEAP_DIR, "budgets.json")
+MICROPYTHON = os.environ.get("MICROPYTHON") or shutil.which("micropython")
+RESULT = re.compile(r"^HEAP (\w+) (\d+)$", re.MULTILINE)
+
+
+def load_budgets() -> dict:
+    with open(BUDGETS_FILE) as f:
+        return json.load(f)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_scenario(scenario: str, heapsize: str, free_heap: int) -> tuple:
+    """
+    Run a scenario on the MicroPython unix port.
+    :return: tuple (peak heap bytes or None if the scenario failed, output)
+    """
+    path = [".frozen", HEAP_DIR, os.path.join(PACKAGE_DIR, "phew"), os.path.expanduser("~/.micropython/lib"),
+            PACKAGE_DIR]
+    with tempfile.TemporaryDirectory() as root:
+        try:
+            completed = subprocess.run([MICROPYTHON, "-X", f"heapsize={heapsize}",
+                                        os.path.join(HEAP_DIR, "scenarios.py"), scenario,
+                                        os.path.join(PACKAGE_DIR, "rockwren"), str(free_port()), str(free_heap)],
+                                       cwd=root, env=dict(os.environ, MICROPYPATH=":".join(path)),
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120)
+        except subprocess.TimeoutExpired as ex:
+            return None, (ex.stdout or b"").decode(errors="replace") + "\nTimed out"
+    output = completed.stdout.decode(errors="replace")
+    result = RESULT.search(output)
+    if completed.returncode != 0 or result is None or "MemoryError" in output:
+        return None, output
+    return int(result.group(2)), output
+
+
+def record() -> None:
+    """ Run every scenario and record its peak heap use plus headroom as its budget. """
+    budgets = load_budgets()
+    for scenario in budgets["scenarios"]:
+        peak, output = run_scenario(scenario, budgets["heapsize"], budgets["free_heap"])
+        if peak is None:
+            print(output)
+            sys.exit(f"{scenario} failed, budgets not recorded")
+        budget = int(peak * (1 + budgets["headroom"]) + 255) // 256 * 256
+        print(f"{scenario}: peak {peak} bytes, budget {budget} bytes")
+        budgets["scenarios"][scenario] = budget
+    with open(BUDGETS_FILE, "w") as f:
+        json.dump(budgets, f, indent=2)
+        f.write("\n")
+
+
+@unittest.skipUnless(MICROPYTHON, "micropython unix port not found, set MICROPYTHON")
+class TestConstrainedHeap(unittest.TestCase):
+
+    def check(self, scenario):
+        budgets = load_budgets()
+        peak, output = run_scenario(scenario, budgets["heapsize"], budgets["free_heap"])
+        self.assertIsNotNone(peak, f"{scenario} failed\n{output}")
+        budget = budgets["scenarios"][scenario]
+        if budget is not None:
+            self.assertLessEqual(peak, budget, f"{scenario} peak heap use {peak} bytes exceeds budget {budget} bytes")
+
+    def test_boot(self):
+        self.check("boot")
+
+    def test_discovery(self):
+        self.check("discovery")
+
+    def test_web(self):
+        self.check("web")
+
+    def test_commands(self):
+        self.check("commands")
+
+    def test_logs(self):
+        self.check("logs")
+
+
+if __name__ == '__main__':
+    if "--record" in sys.argv:
+        record()
+    else:
+        unittest.main()
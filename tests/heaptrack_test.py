@@ -0,0 +1,48 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import unittest
+from unittest import mock
+
+from .context import patch_modules
+
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+gc_mock = mock.MagicMock()
+
+
+def setUpModule():
+    global heaptrack
+    patch_modules({"gc": mock.MagicMock(), "micropython": micropython_mock})
+    from rockwren import heaptrack
+    heaptrack.gc = gc_mock
+
+
+class TestHeapTrack(unittest.TestCase):
+
+    def tearDown(self):
+        heaptrack.enabled = False
+        heaptrack._endpoints.clear()
+
+    def handle(self, name, before, after):
+        gc_mock.mem_alloc.return_value = before
+        start = heaptrack.begin()
+        gc_mock.mem_alloc.return_value = after
+        heaptrack.end(name, start)
+
+    def test_disabled(self):
+        self.handle("/", 1000, 5000)
+        self.assertEqual([], heaptrack.top())
+
+    def test_net_allocation_and_gc_count(self):
+        heaptrack.enabled = True
+        self.handle("/", 1000, 3000)
+        self.handle("/", 1000, 2000)
+        self.handle("/", 5000, 1000)
+        self.handle(b"rockwren/1234/command", 1000, 9000)
+        self.handle("/device/state", 1000, 1100)
+        self.assertEqual([("rockwren/1234/command", 1, 8000, 0), ("/", 3, 2000, 1)], heaptrack.top(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
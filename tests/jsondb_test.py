@@ -2,18 +2,16 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 import json
-import sys
 import unittest
 
-from .context import rockwren
+from .context import patch_modules
 
-try:
-    del sys.modules['ujson']
-except:
-    pass
-sys.modules['ujson'] = __import__('json')
 
-from rockwren import jsondb
+def setUpModule():
+    global jsondb
+    patch_modules({"ujson": json})
+    from rockwren import jsondb
+
 
 class TestJsonDbMethods(unittest.TestCase):
 
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from .context import patch_modules
+
+machine_mock = mock.MagicMock()
+machine_mock.RTC.return_value.datetime.return_value = (2023, 10, 4, 2, 12, 30, 15, 0)
+gc_mock = mock.MagicMock()
+gc_mock.mem_free.return_value = 20 * 1024
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global logsink
+    patch_modules({"machine": machine_mock, "gc": gc_mock, "micropython": micropython_mock, "uasyncio": mock.MagicMock(),
+                   "phew": mock.MagicMock()})
+    from rockwren import logsink
+
+
+class TestLogSink(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        logsink.LOG_FILE = os.path.join(self.directory.name, "log.txt")
+        logsink.set_level("debug")
+        logsink.flush()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_log(self, suffix=""):
+        with open(logsink.LOG_FILE + suffix) as f:
+            return f.read().splitlines()
+
+    def test_buffered_until_flush(self):
+        logsink.log("info", "first")
+        logsink.log("error", "second")
+        self.assertFalse(os.path.exists(logsink.LOG_FILE))
+        logsink.flush()
+        lines = self.read_log()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].endswith("first"))
+        self.assertTrue(lines[1].endswith("second"))
+
+    def test_flush_when_buffer_full(self):
+        for i in range(logsink.BUFFER_LINES):
+            logsink.log("info", str(i))
+        self.assertEqual(logsink.BUFFER_LINES, len(self.read_log()))
+
+    def test_flush_failure_drops_oldest(self):
+        logsink.LOG_FILE = os.path.join(self.directory.name, "missing", "log.txt")
+        for i in range(logsink.BUFFER_LINES + 5):
+            logsink.log("info", str(i))
+        self.assertEqual(logsink.BUFFER_LINES - 1, logsink._count)
+        logsink.LOG_FILE = os.path.join(self.directory.name, "log.txt")
+        logsink.flush()
+        lines = self.read_log()
+        self.assertTrue(lines[0].endswith(" 6"))
+        self.assertTrue(lines[-1].endswith(str(logsink.BUFFER_LINES + 4)))
+
+    def test_level_filter(self):
+        self.assertFalse(logsink.set_level("verbose"))
+        self.assertTrue(logsink.set_level("error"))
+        logsink.log("debug", "dropped")
+        logsink.log("info", "dropped")
+        logsink.log("error", "kept")
+        logsink.flush()
+        lines = self.read_log()
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].endswith("kept"))
+
+    def test_rotation(self):
+        line = "x" * 100
+        for _ in range(logsink.FILE_COUNT + 1):
+            for _ in range(logsink.MAX_FILE_SIZE // 100 + 1):
+                logsink.log("info", line)
+            logsink.flush()
+        self.assertTrue(os.path.exists(logsink.LOG_FILE))
+        for index in range(1, logsink.FILE_COUNT):
+            self.assertTrue(os.path.exists(f"{logsink.LOG_FILE}.{index}"))
+        self.assertFalse(os.path.exists(f"{logsink.LOG_FILE}.{logsink.FILE_COUNT}"))
+
+
+if __name__ == '__main__':
+    unittest.main()
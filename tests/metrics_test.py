@@ -0,0 +1,53 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import unittest
+from unittest import mock
+
+from .context import patch_modules
+
+gc_mock = mock.MagicMock()
+gc_mock.mem_free.return_value = 20000
+gc_mock.mem_alloc.return_value = 10000
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global metrics
+    patch_modules({"gc": gc_mock, "micropython": micropython_mock, "uasyncio": mock.MagicMock()})
+    from rockwren import metrics
+    metrics.gc = gc_mock
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters(self):
+        before = metrics.get(metrics.MQTT_PUBLISHES)
+        metrics.inc(metrics.MQTT_PUBLISHES)
+        metrics.inc(metrics.MQTT_PUBLISHES, 2)
+        self.assertEqual(before + 3, metrics.get(metrics.MQTT_PUBLISHES))
+
+    def test_web_requests(self):
+        metrics.register_route("/test")
+        metrics.web_request("/test", 200, 10)
+        metrics.web_request("/test", 200, 30)
+        metrics.web_request("/test", 404, 5)
+        metrics.web_request("/unregistered", 200, 5)
+        text = "".join(metrics.render())
+        self.assertIn('rockwren_web_requests_total{route="/test",status="200"} 2\n', text)
+        self.assertIn('rockwren_web_requests_total{route="/test",status="404"} 1\n', text)
+        self.assertIn('rockwren_web_latency_ms_sum{route="/test"} 45\n', text)
+        self.assertIn('rockwren_web_latency_ms_count{route="/test"} 3\n', text)
+        self.assertIn('rockwren_web_latency_ms_max{route="/test"} 30\n', text)
+        self.assertNotIn("/unregistered", text)
+
+    def test_render_gauges(self):
+        text = "".join(metrics.render())
+        self.assertIn("rockwren_mem_free_bytes 20000\n", text)
+        self.assertIn("rockwren_mem_alloc_bytes 10000\n", text)
+        self.assertIn("# TYPE rockwren_mqtt_publishes_total counter\n", text)
+
+
+if __name__ == '__main__':
+    unittest.main()
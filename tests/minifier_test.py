@@ -0,0 +1,117 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import contextlib
+import glob
+import io
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from .context import rockwren
+
+import minifier
+
+SOURCE = '''
+def add(first_number, second_number):
+    """ Add two numbers. """
+    return first_number + second_number
+'''
+""" Template expressions evaluated by phew e.g. {{device.name}} """
+TEMPLATE_EXPRESSION = re.compile(r"{{(.*?)}}", re.DOTALL)
+PAGE = '<html>\n  <head>\n    <title>Test</title>\n  </head>\n  <body>\n    <p>Test page</p>\n  </body>\n</html>\n'
+
+
+class TestMinifier(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.module = os.path.join(self.tmp.name, "module")
+        self.cache = os.path.join(self.tmp.name, "cache")
+        os.mkdir(self.module)
+        for i in range(3):
+            self.write(f"m{i}.py", SOURCE.replace("add", f"add{i}"))
+        self.write("index.html", PAGE)
+        self.write("notes.txt", "not minified")
+
+    def write(self, name, content):
+        with open(os.path.join(self.module, name), "w") as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.module, name)) as f:
+            return f.read()
+
+    def minify_py(self, workers=None):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            sizes = minifier.minify_py_dir(self.module, self.cache, workers)
+        return sizes, output.getvalue()
+
+    def test_minify_py_dir(self):
+        sizes, output = self.minify_py()
+        self.assertEqual(3, len(sizes))
+        minified = self.read("m0.py")
+        self.assertNotIn("\n    ", minified)
+        self.assertEqual(len(minified), sizes[self.module + "/m0.py"])
+        self.assertIn("0 of 3 cached", output)
+        self.assertRegex(output, r"m0\.py: Size: \d+, minified size: \d+, %\d+, \d+ ms")
+
+    def test_minify_html_css_js_dir(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            sizes = minifier.minify_html_css_js_dir(self.module, self.cache)
+        self.assertEqual([self.module + "/index.html"], list(sizes))
+        self.assertNotIn("\n", self.read("index.html"))
+        self.assertEqual("not minified", self.read("notes.txt"))
+
+    def test_minified_pages_template_expressions_compile(self):
+        # minify_html must not rewrite the python evaluated by the template engine
+        pages = os.path.join(os.path.dirname(rockwren.__file__), "*.*")
+        for path in glob.glob(pages):
+            if path.endswith((".html", ".css", ".js")):
+                shutil.copy(path, self.module)
+        with contextlib.redirect_stdout(io.StringIO()):
+            sizes = minifier.minify_html_css_js_dir(self.module, None)
+        self.assertIn(self.module + "/viewlogs.html", sizes)
+        for path in sizes:
+            with open(path) as f:
+                for expression in TEMPLATE_EXPRESSION.findall(f.read()):
+                    with self.subTest(page=os.path.basename(path), expression=expression):
+                        compile(expression, path, "eval")
+
+    def test_unchanged_files_are_cached(self):
+        self.minify_py()
+        minified = self.read("m1.py")
+        # Unchanged sources, as they were before being minified in place, and a changed source
+        self.write("m0.py", SOURCE.replace("add", "add0"))
+        self.write("m1.py", SOURCE.replace("add", "add1"))
+        self.write("m2.py", SOURCE.replace("add", "changed"))
+        with mock.patch.object(minifier, "minify_source", side_effect=minifier.minify_source) as minify_source:
+            _, output = self.minify_py(workers=1)
+        self.assertEqual(1, minify_source.call_count)
+        self.assertEqual(minified, self.read("m1.py"))
+        self.assertIn("changed", self.read("m2.py"))
+        self.assertIn("m1.py: Size: ", output)
+        self.assertIn("2 of 3 cached", output)
+
+    def test_cache_key_includes_tool_version(self):
+        key = minifier.cache_key("py", SOURCE)
+        self.assertEqual(key, minifier.cache_key("py", SOURCE))
+        self.assertNotEqual(key, minifier.cache_key("html", SOURCE))
+        with mock.patch.object(minifier.metadata, "version", return_value="0.0.0"):
+            self.assertNotEqual(key, minifier.cache_key("py", SOURCE))
+
+    def test_no_cache(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            minifier.minify_py_dir(self.module, None)
+        self.assertFalse(os.path.exists(self.cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,415 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import binascii
+import json
+import struct
+import types
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from .context import patch_modules
+
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global env, mqtt_client, rockwren_device, GarageDoor
+    patch_modules({"micropython": micropython_mock, "machine": mock.MagicMock(), "network": mock.MagicMock(),
+                   "ntptime": mock.MagicMock(), "uasyncio": mock.MagicMock(), "ubinascii": mock.MagicMock(),
+                   "usocket": mock.MagicMock(), "umqtt": mock.MagicMock(), "umqtt.robust2": mock.MagicMock(),
+                   "phew": mock.MagicMock(), "ujson": json})
+    from rockwren import env
+    from rockwren import mqtt_client
+    from rockwren import rockwren as rockwren_device
+    GarageDoor = type("GarageDoor", (GarageDoorDiscovery, rockwren_device.Device), {})
+
+
+class GarageDoorDiscovery:
+    """ Device mixin with a button and a position sensor """
+
+    def discovery_function(self):
+        device = {"identifiers": [self.mqtt_client.device_id.decode()],
+                  "name": "Garage Door Controller",
+                  "manufacturer": "Rockwren"}
+        return [("button", {"unique_id": "garage_button",
+                            "name": "Garage Door Button",
+                            "platform": "mqtt",
+                            "command_topic": self.mqtt_client.command_topic.decode(),
+                            "availability": {"topic": self.mqtt_client.availability_topic.decode()},
+                            "device": device}),
+                (b"binary_sensor", {"unique_id": "garage_position",
+                                    "name": "Garage Door Position",
+                                    "state_topic": self.mqtt_client.state_topic.decode(),
+                                    "availability": {"topic": self.mqtt_client.availability_topic.decode()},
+                                    "device": device})]
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        patch.object(env, "DISCOVERY_MODE", "device").start()
+        patch.object(env, "DISCOVERY_RETAIN", True).start()
+        self.addCleanup(patch.stopall)
+        self.client = mqtt_client.MqttDevice(GarageDoor(name="GarageDoor"), "127.0.0.1", {"ip_address": "127.0.0.1"})
+        self.client._mqtt_client = mock.MagicMock()
+
+    def published(self):
+        return [(call.args[0], call.args[1], call.kwargs["retain"])
+                for call in self.client._mqtt_client.publish.call_args_list]
+
+    def test_device_discovery(self):
+        self.client.send_discovery_msgs()
+        published = self.published()
+        self.assertEqual(1, len(published))
+        topic, payload, retain = published[0]
+        self.assertEqual(b"homeassistant/device/rockwren_0102/config", topic)
+        self.assertTrue(retain)
+        discovery = json.loads(payload)
+        self.assertEqual({"identifiers": ["rockwren_0102"], "name": "Garage Door Controller",
+                          "manufacturer": "Rockwren"}, discovery["dev"])
+        self.assertEqual("rockwren", discovery["o"]["name"])
+        # Availability is shared by both components
+        self.assertEqual({"topic": "rockwren/0102/LWT"}, discovery["availability"])
+        self.assertEqual({"garage_button": {"unique_id": "garage_button", "name": "Garage Door Button",
+                                            "command_topic": "rockwren/0102/command", "p": "button"},
+                          "garage_position": {"unique_id": "garage_position", "name": "Garage Door Position",
+                                              "state_topic": "rockwren/0102/state", "p": "binary_sensor"}},
+                         discovery["cmps"])
+
+    def test_device_discovery_is_smaller(self):
+        entity_bytes = sum(len(json.dumps(discovery)) for _, discovery in self.client._discovery_functions)
+        self.assertLess(len(json.dumps(self.client.device_discovery())), entity_bytes)
+
+    def test_entity_discovery(self):
+        env.DISCOVERY_MODE = "entity"
+        env.DISCOVERY_RETAIN = False
+        self.client.send_discovery_msgs()
+        published = self.published()
+        self.assertEqual([b"homeassistant/button/rockwren_0102/config",
+                          b"homeassistant/binary_sensor/rockwren_0102/config"], [topic for topic, _, _ in published])
+        self.assertEqual("Garage Door Controller", json.loads(published[0][1])["device"]["name"])
+        self.assertFalse(any(retain for _, _, retain in published))
+
+    def test_no_entities(self):
+        with patch.object(mqtt_client, "logging") as logging:
+            self.client.device.discovery_function = lambda: []
+            self.client.refresh_discovery()
+            self.client.send_discovery_msgs()
+        self.assertEqual([], self.published())
+        logging.error.assert_not_called()
+        self.assertEqual({}, self.client.device_discovery()["cmps"])
+
+    def test_remove_discovery(self):
+        self.client.remove_discovery_msgs("entity")
+        self.assertEqual([(b"homeassistant/button/rockwren_0102/config", b"", True),
+                          (b"homeassistant/binary_sensor/rockwren_0102/config", b"", True)], self.published())
+
+
+class TestDiscoveryResend(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        patch.object(env, "DISCOVERY_MODE", "device").start()
+        patch.object(env, "DISCOVERY_JITTER", 10).start()
+        self.ticks = 0
+        clock = mock.MagicMock()
+        clock.ticks_ms = lambda: self.ticks
+        clock.ticks_add = lambda ticks, delta: ticks + delta
+        clock.ticks_diff = lambda end, start: end - start
+        patch.object(mqtt_client, "time", clock).start()
+        self.dumps = patch.object(mqtt_client.ujson, "dumps", wraps=json.dumps).start()
+        self.addCleanup(patch.stopall)
+        self.client = mqtt_client.MqttDevice(GarageDoor(name="GarageDoor"), "127.0.0.1", {"ip_address": "127.0.0.1"})
+        self.client._mqtt_client = mock.MagicMock()
+
+    def published(self):
+        return [call.args[0] for call in self.client._mqtt_client.publish.call_args_list]
+
+    def test_serialized_once(self):
+        self.client.send_discovery_msgs()
+        self.client.send_discovery_msgs()
+        self.assertEqual(2, len(self.published()))
+        self.assertEqual(1, self.dumps.call_count)
+
+    def test_serialized_on_change(self):
+        self.client.send_discovery_msgs()
+        env.DISCOVERY_MODE = "entity"
+        self.client.send_discovery_msgs()
+        self.assertEqual(3, self.dumps.call_count)
+        self.client.refresh_discovery()
+        self.client.send_discovery_msgs()
+        self.assertEqual(5, self.dumps.call_count)
+
+    def test_resend_on_birth_message(self):
+        self.assertEqual(4508, self.client.jitter_ms(10000))
+        self.client.subscription_callback(mqtt_client.HA_STATUS_TOPIC, b"online", False, False)
+        self.client._send_due_discovery()
+        self.assertEqual([], self.published())
+        self.ticks = 4508
+        self.client._send_due_discovery()
+        self.client._send_due_discovery()
+        self.assertEqual([b"homeassistant/device/rockwren_0102/config"], self.published())
+        self.assertEqual([], self.client._commands)
+
+    def test_ignore_retained_and_offline_birth_messages(self):
+        self.client.subscription_callback(mqtt_client.HA_STATUS_TOPIC, b"online", True, False)
+        self.client.subscription_callback(mqtt_client.HA_STATUS_TOPIC, b"offline", False, False)
+        self.ticks = 10000
+        self.client._send_due_discovery()
+        self.assertEqual([], self.published())
+
+
+def handler_a(topic, message):
+    pass
+
+
+def handler_b(topic, message):
+    pass
+
+
+class TestTopicTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = mqtt_client.TopicTrie()
+
+    def test_exact(self):
+        self.trie.add(b"rockwren/0102/command", handler_a)
+        self.assertEqual([handler_a], self.trie.match(b"rockwren/0102/command"))
+        self.assertEqual([], self.trie.match(b"rockwren/0102/state"))
+        self.assertEqual([], self.trie.match(b"rockwren/0102"))
+
+    def test_single_level_wildcard(self):
+        self.trie.add(b"rockwren/group/+/command", handler_a)
+        self.assertEqual([handler_a], self.trie.match(b"rockwren/group/kitchen/command"))
+        self.assertEqual([], self.trie.match(b"rockwren/group/kitchen/state"))
+        self.assertEqual([], self.trie.match(b"rockwren/group/kitchen/a/command"))
+        self.assertEqual([], self.trie.match(b"rockwren/group/command"))
+
+    def test_multi_level_wildcard(self):
+        self.trie.add(b"rockwren/0102/#", handler_a)
+        self.assertEqual([handler_a], self.trie.match(b"rockwren/0102/sensor/1/set"))
+        self.assertEqual([handler_a], self.trie.match(b"rockwren/0102"))
+        self.assertEqual([], self.trie.match(b"rockwren/0103/command"))
+        self.trie.add(b"#", handler_b)
+        self.assertEqual([handler_b], self.trie.match(b"other"))
+        # Wildcards in the first level do not match $ topics
+        self.assertEqual([], self.trie.match(b"$SYS/broker/uptime"))
+
+    def test_multiple_handlers(self):
+        self.trie.add(b"rockwren/0102/command", handler_a)
+        self.trie.add(b"rockwren/+/command", handler_b)
+        self.trie.add(b"rockwren/#", handler_b)
+        self.assertEqual([handler_a, handler_b, handler_b], self.trie.match(b"rockwren/0102/command"))
+
+    def test_remove(self):
+        self.trie.add(b"rockwren/+/command", handler_a, qos=1)
+        self.trie.add(b"rockwren/+/command", handler_b)
+        self.trie.add(b"rockwren/0102/command", handler_a)
+        self.assertEqual({b"rockwren/+/command": 1, b"rockwren/0102/command": 0}, self.trie.filters())
+        self.trie.remove(b"rockwren/+/command", handler_a)
+        self.assertEqual([handler_a, handler_b], self.trie.match(b"rockwren/0102/command"))
+        self.trie.remove(b"rockwren/+/command")
+        self.trie.remove(b"rockwren/0102/command", handler_a)
+        self.trie.remove(b"rockwren/unknown/#")
+        self.assertEqual([], self.trie.match(b"rockwren/0102/command"))
+        self.assertEqual({}, self.trie.filters())
+        # Empty nodes are pruned
+        self.assertEqual({}, self.trie._root[0])
+
+
+class TestTopicHandlers(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        self.addCleanup(patch.stopall)
+        self.client = mqtt_client.MqttDevice(GarageDoor(name="GarageDoor"), "127.0.0.1", {"ip_address": "127.0.0.1"})
+
+    def test_subscriptions(self):
+        self.client.register_topic_handler(b"/sensor/+/set", handler_a, qos=1)
+        self.client.subscribe(b"rockwren/group/+/command", handler_b)
+        self.assertEqual({b"rockwren/0102/#": 1, b"rockwren/group/+/command": 0}, self.client.subscriptions())
+        self.assertRaises(ValueError, self.client.subscribe, b"rockwren/group/all", handler_b, 2)
+
+    def test_subscribe_when_connected(self):
+        self.client._mqtt_client = mock.MagicMock()
+        self.client.subscribe(b"rockwren/group/+/command", handler_b, qos=1)
+        self.client._mqtt_client.subscribe.assert_called_once_with(b"rockwren/group/+/command", 1)
+
+    def test_callback_queues_matching_topics(self):
+        self.client.subscribe(b"rockwren/group/+/command", handler_b)
+        self.client.subscription_callback(b"rockwren/group/kitchen/command", b'{"state": "ON"}', False, False)
+        self.client.subscription_callback(b"rockwren/group/kitchen/state", b'{"state": "ON"}', False, False)
+        self.client.subscription_callback(b"rockwren/0102/command", b"OFF", False, False)
+        self.assertEqual((b"rockwren/group/kitchen/command", {"state": "ON"}), self.client.pop_message())
+        self.assertEqual((b"rockwren/0102/command", "OFF"), self.client.pop_message())
+        self.assertEqual((None, None), self.client.pop_message())
+        self.client.unsubscribe(b"rockwren/group/+/command")
+        self.client.subscription_callback(b"rockwren/group/kitchen/command", b'{"state": "ON"}', False, False)
+        self.assertEqual((None, None), self.client.pop_message())
+
+
+class TestGroups(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        patch.object(env, "GROUPS", ["kitchen"]).start()
+        patch.object(env, "GROUP_JITTER_MS", 2000).start()
+        self.ticks = 0
+        clock = mock.MagicMock()
+        clock.ticks_ms = lambda: self.ticks
+        clock.ticks_add = lambda ticks, delta: ticks + delta
+        clock.ticks_diff = lambda end, start: end - start
+        patch.object(mqtt_client, "time", clock).start()
+        self.addCleanup(patch.stopall)
+        self.commands = []
+        self.client = mqtt_client.MqttDevice(GarageDoor(name="GarageDoor"), "127.0.0.1", {"ip_address": "127.0.0.1"},
+                                             command_handler=lambda topic, message: self.commands.append(message))
+        self.client._mqtt_client = mock.MagicMock()
+
+    def published(self):
+        return [call.args[0] for call in self.client._mqtt_client.publish.call_args_list]
+
+    def test_group_subscriptions(self):
+        self.assertEqual({b"rockwren/0102/#": 0, b"rockwren/group/kitchen/command": 0}, self.client.subscriptions())
+        self.client.set_groups(["downstairs"])
+        self.assertEqual({b"rockwren/0102/#": 0, b"rockwren/group/downstairs/command": 0},
+                         self.client.subscriptions())
+        self.client._mqtt_client.subscribe.assert_called_once_with(b"rockwren/group/downstairs/command", 0)
+
+    def test_group_command_state_delayed(self):
+        self.assertEqual(901, self.client.jitter_ms(2000))
+        topic = b"rockwren/group/kitchen/command"
+        for handler in self.client._topic_handlers.match(topic):
+            handler(topic, {"state": "ON"})
+        self.assertEqual([{"state": "ON"}], self.commands)
+        # The state is not published until the device's delay has passed
+        self.client.mqtt_publish_state()
+        self.client._send_due_state()
+        self.assertEqual([], self.published())
+        self.ticks = 901
+        self.client._send_due_state()
+        self.client._send_due_state()
+        self.assertEqual([b"rockwren/0102/state"], self.published())
+
+
+class TestStateSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = mqtt_client.StateSchema((("temperature", "h", 100), ("humidity", "B"), ("motion", "?")))
+
+    def test_encode_decode(self):
+        self.assertEqual("<hB?", self.schema.format)
+        self.assertEqual(4, self.schema.size)
+        payload = self.schema.encode({"temperature": -3.456, "humidity": 48, "motion": True})
+        self.assertEqual(struct.pack("<hB?", -346, 48, True), payload)
+        self.assertEqual({"temperature": -3.46, "humidity": 48, "motion": True}, self.schema.decode(payload))
+
+    def test_value_template(self):
+        self.assertEqual("{{ (value | unpack('<h', offset=0)) / 100 }}", self.schema.value_template("temperature"))
+        self.assertEqual({"encoding": "", "value_template": "{{ value | unpack('<B', offset=2) }}"},
+                         self.schema.discovery_options("humidity"))
+        self.assertRaises(KeyError, self.schema.value_template, "pressure")
+
+    def test_state_published_with_schema(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        self.addCleanup(patch.stopall)
+        device = GarageDoor(name="GarageDoor")
+        client = mqtt_client.MqttDevice(device, "127.0.0.1", {"ip_address": "127.0.0.1"})
+        client._mqtt_client = mock.MagicMock()
+        client.mqtt_publish_state()
+        self.assertEqual(b'{"state": "OFF"}', client._mqtt_client.publish.call_args.args[1].encode())
+        device.state_schema = mqtt_client.StateSchema((("position", "B"),))
+        device.state_values = lambda: {"position": 70}
+        with patch.object(mqtt_client, "logging") as logging:
+            client.mqtt_publish_state()
+        self.assertEqual(b"\x46", bytes(client._mqtt_client.publish.call_args.args[1]))
+        logging.info.assert_called_once_with("mqtt: b'rockwren/0102/state' 46")
+
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(mqtt_client, "ubinascii", binascii).start()
+        patch.object(mqtt_client.machine, "unique_id", return_value=b"\x01\x02").start()
+        clock = mock.MagicMock()
+        ticks = iter([0, 850, 1000, 1120] + list(range(2000, 3000, 100)))
+        clock.ticks_ms = lambda: next(ticks)
+        clock.ticks_diff = lambda end, start: end - start
+        patch.object(mqtt_client, "time", clock).start()
+        self.params = {"key": b"key", "cert": b"cert", "server_side": False}
+        patch.object(mqtt_client.credentials, "ssl_params", side_effect=lambda: dict(self.params)).start()
+        self.addCleanup(patch.stopall)
+        self.client = mqtt_client.MqttDevice(GarageDoor(name="GarageDoor"), "127.0.0.1", {"ip_address": "127.0.0.1"})
+        self.mqtt = self.client._mqtt_client = mock.MagicMock()
+        self.mqtt.ssl = True
+        self.mqtt.is_conn_issue.return_value = False
+        self.mqtt.sock.session = "session-1"
+        self.mqtt.sock.session_reused = False
+        self.handshakes = []
+        self.mqtt.connect.side_effect = self.mqtt.reconnect.side_effect = \
+            lambda *args: self.handshakes.append(dict(self.mqtt.ssl_params))
+
+    def test_session_resumed(self):
+        resumed = mqtt_client.metrics.get(mqtt_client.metrics.MQTT_TLS_RESUMED)
+        self.client._connect()
+        self.assertEqual([self.params], self.handshakes)
+        # The credentials are only held during the handshake
+        self.assertEqual({}, self.mqtt.ssl_params)
+        self.assertEqual(850, mqtt_client.metrics._mqtt_connect[0])
+        self.mqtt.sock.session_reused = True
+        self.client._connect(reconnect=True)
+        self.assertEqual(dict(self.params, session="session-1"), self.handshakes[1])
+        self.assertEqual(120, mqtt_client.metrics._mqtt_connect[0])
+        self.assertEqual(resumed + 1, mqtt_client.metrics.get(mqtt_client.metrics.MQTT_TLS_RESUMED))
+
+    def test_full_handshake_after_failure(self):
+        self.client._connect()
+        self.mqtt.is_conn_issue.return_value = True
+        self.client._connect(reconnect=True)
+        self.mqtt.is_conn_issue.return_value = False
+        self.client._connect(reconnect=True)
+        self.assertEqual([self.params, dict(self.params, session="session-1"), self.params], self.handshakes)
+
+    def test_session_not_supported(self):
+        self.client._connect()
+        self.mqtt.reconnect.side_effect = TypeError("unexpected keyword argument 'session'")
+        self.assertRaises(TypeError, self.client._connect, True)
+        self.mqtt.reconnect.side_effect = lambda *args: self.handshakes.append(dict(self.mqtt.ssl_params))
+        self.client._connect(reconnect=True)
+        self.client._connect(reconnect=True)
+        self.assertEqual([self.params, self.params, self.params], self.handshakes)
+
+    def test_reconfigure_reconnects(self):
+        patch.object(mqtt_client.uasyncio, "sleep", types.coroutine(lambda seconds: (yield))).start()
+        self.client.reconfigure("10.0.0.9", 1884)
+        self.assertEqual(("10.0.0.9", 1884), (self.mqtt.server, self.mqtt.port))
+        self.mqtt.disconnect.assert_called_once_with()
+        task = self.client.ensure_connection()
+        task.send(None)  # waiting to reconnect
+        task.send(None)  # reconnected
+        self.assertEqual(1, self.mqtt.reconnect.call_count)
+        self.mqtt.resubscribe.assert_called_once_with()
+        task.send(None)
+        self.assertEqual(1, self.mqtt.reconnect.call_count)
+        task.close()
+
+    def test_broker_host_name_resolved_through_dns_cache(self):
+        self.client.mqtt_server = "broker.example.com"
+        with patch.object(mqtt_client.networking, "resolve", return_value="10.0.0.5") as resolve:
+            self.client._connect()
+        resolve.assert_called_once_with("broker.example.com", self.mqtt.port)
+        self.assertEqual("10.0.0.5", self.mqtt.server)
+        self.assertEqual(dict(self.params, server_hostname="broker.example.com"), self.handshakes[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
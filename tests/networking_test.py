@@ -0,0 +1,341 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import binascii
+import json
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from .context import patch_modules
+
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+time_mock = mock.MagicMock()
+time_mock.ticks_diff = lambda end, start: end - start
+uasyncio_mock = mock.MagicMock()
+uasyncio_mock.sleep_ms = mock.AsyncMock()
+
+
+def setUpModule():
+    global networking
+    patch_modules({"micropython": micropython_mock, "machine": mock.MagicMock(), "network": mock.MagicMock(),
+                   "uasyncio": uasyncio_mock, "ubinascii": mock.MagicMock(), "phew": mock.MagicMock(),
+                   "ujson": json})
+    from rockwren import networking
+    # The module is discarded with the stand-ins when the test module is torn down
+    networking.time = time_mock
+
+
+class TestWifiScanCache(unittest.TestCase):
+
+    def setUp(self):
+        networking._scan_results = []
+        networking._scan_time = None
+        networking._scan_pending = False
+        uasyncio_mock.reset_mock()
+        self.wlan = mock.MagicMock()
+        self.wlan.scan.return_value = [(b"weak", b"", 1, -80, 3, 0), (b"strong", b"", 6, -40, 3, 0)]
+
+    def complete_scan(self):
+        """ Run the scan co-routine scheduled with uasyncio.create_task """
+        coro = uasyncio_mock.create_task.call_args[0][0]
+        with self.assertRaises(StopIteration):
+            coro.send(None)
+
+    def test_first_request_starts_scan(self):
+        time_mock.ticks_ms.return_value = 0
+        self.assertEqual([], networking.cached_networks(self.wlan))
+        self.assertTrue(networking.scan_in_progress())
+        networking.cached_networks(self.wlan)
+        self.assertEqual(1, uasyncio_mock.create_task.call_count)
+        self.complete_scan()
+        self.assertFalse(networking.scan_in_progress())
+        self.assertEqual([("strong", -40), ("weak", -80)], networking.cached_networks(self.wlan))
+
+    def test_cached_until_ttl_or_refresh(self):
+        time_mock.ticks_ms.return_value = 0
+        networking.cached_networks(self.wlan)
+        self.complete_scan()
+        time_mock.ticks_ms.return_value = networking.SCAN_TTL_MS
+        networking.cached_networks(self.wlan)
+        self.assertEqual(1, uasyncio_mock.create_task.call_count)
+        networking.cached_networks(self.wlan, refresh=True)
+        self.assertEqual(2, uasyncio_mock.create_task.call_count)
+        self.complete_scan()
+        time_mock.ticks_ms.return_value = networking.SCAN_TTL_MS * 3
+        networking.cached_networks(self.wlan)
+        self.assertEqual(3, uasyncio_mock.create_task.call_count)
+
+
+class TestApplyConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        networking.ENV_FILE = os.path.join(self.directory.name, "env.json")
+        with open(networking.ENV_FILE, "w") as f:
+            json.dump({"first_boot": False, "ssid": "home", "password": "secret", "mqtt_server": "10.0.0.1",
+                       "mqtt_port": 1883}, f)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self):
+        with open(networking.ENV_FILE) as f:
+            return json.load(f)
+
+    def test_invalid_document_not_applied(self):
+        changed, errors = networking.apply_config({"mqtt_server": "not a host!", "mqtt_port": "1883",
+                                                   "colour": "red", "log_level": "verbose", "profile": 1})
+        self.assertEqual({}, changed)
+        self.assertEqual({"mqtt_server", "mqtt_port", "colour", "log_level", "profile"}, set(errors.keys()))
+        self.assertEqual("10.0.0.1", self.load()["mqtt_server"])
+
+    def test_diff_and_single_save(self):
+        changed, errors = networking.apply_config({"mqtt_server": "broker.example.com", "mqtt_port": 1883,
+                                                   "publish_interval": 30})
+        self.assertEqual({}, errors)
+        self.assertEqual({"mqtt_server": ["10.0.0.1", "broker.example.com"], "publish_interval": [None, 30]}, changed)
+        self.assertEqual("broker.example.com", networking.env.MQTT_SERVER)
+        self.assertEqual(30, networking.env.PUBLISH_INTERVAL)
+        self.assertFalse(networking.restart_required(changed))
+        db = self.load()
+        self.assertEqual("broker.example.com", db["mqtt_server"])
+        self.assertFalse(db["first_boot"])
+
+    def test_wifi_change_requires_restart(self):
+        changed, errors = networking.apply_config({"ssid": "office", "password": "new-secret"})
+        self.assertEqual({"ssid": ["home", "office"], "password": ["***", "***"]}, changed)
+        self.assertTrue(networking.restart_required(changed))
+        self.assertTrue(self.load()["first_boot"])
+
+    def test_web_limits(self):
+        changed, errors = networking.apply_config({"web_max_clients": 0, "web_min_free": {"/log": "8k"}})
+        self.assertEqual({"web_max_clients", "web_min_free"}, set(errors.keys()))
+        changed, errors = networking.apply_config({"web_max_clients": 3, "web_min_free": {"/log": 4096}})
+        self.assertEqual({}, errors)
+        self.assertEqual(3, networking.env.WEB_MAX_CLIENTS)
+        self.assertEqual({"/log": 4096}, networking.env.WEB_MIN_FREE)
+        self.assertFalse(networking.restart_required(changed))
+
+    def test_groups(self):
+        changed, errors = networking.apply_config({"groups": ["kitchen", "lights/all"]})
+        self.assertEqual({"groups"}, set(errors.keys()))
+        changed, errors = networking.apply_config({"groups": [f"zone{i}" for i in range(networking.MAX_GROUPS + 1)]})
+        self.assertEqual({"groups"}, set(errors.keys()))
+        changed, errors = networking.apply_config({"groups": ["kitchen", "downstairs"]})
+        self.assertEqual({}, errors)
+        self.assertEqual(["kitchen", "downstairs"], networking.env.GROUPS)
+        self.assertEqual(["kitchen", "downstairs"], self.load()["groups"])
+        self.assertFalse(networking.restart_required(changed))
+
+    def test_client_credentials_saved_as_der(self):
+        cert = "-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n"
+        changed, errors = networking.apply_config({"mqtt_client_cert": "MIIB", "mqtt_client_key": cert})
+        self.assertEqual({"mqtt_client_cert"}, set(errors.keys()))
+        with patch.object(networking.credentials, "save", return_value=True) as save:
+            changed, errors = networking.apply_config({"mqtt_client_cert": cert})
+        self.assertEqual({}, errors)
+        save.assert_called_once_with("mqtt_client_cert", cert)
+        self.assertEqual({"mqtt_client_cert": ["***", "***"]}, changed)
+        self.assertFalse(hasattr(networking.env, "MQTT_CLIENT_CERT"))
+        self.assertTrue(networking.restart_required(changed))
+        # Only the DER is kept
+        self.assertNotIn("mqtt_client_cert", self.load())
+        with patch.object(networking.credentials, "save", return_value=False):
+            changed, errors = networking.apply_config({"mqtt_client_cert": cert})
+        self.assertEqual({}, changed)
+
+    def test_invalid_pem_not_applied(self):
+        patcher = patch.object(networking.utils, "ubinascii", binascii)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        interval = networking.env.PUBLISH_INTERVAL
+        for cert, error in (("-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----", "invalid PEM base64"),
+                            ("-----BEGIN CERTIFICATE-----\n-----END CERTIFICATE-----", "empty PEM")):
+            with patch.object(networking.credentials, "save") as save:
+                changed, errors = networking.apply_config({"publish_interval": interval + 1, "mqtt_client_cert": cert})
+            self.assertEqual({}, changed)
+            self.assertEqual({"mqtt_client_cert": error}, errors)
+            save.assert_not_called()
+            self.assertEqual(interval, networking.env.PUBLISH_INTERVAL)
+
+    def test_bad_stored_credential_does_not_stop_loading(self):
+        patcher = patch.object(networking.utils, "ubinascii", binascii)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict(networking.credentials.FILES,
+                             {key: os.path.join(self.directory.name, key) for key in networking.credentials.FILES})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        document = self.load()
+        document.update({"mqtt_client_cert": "-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----",
+                         "log_level": "error", "groups": ["kitchen"]})
+        with open(networking.ENV_FILE, "w") as f:
+            json.dump(document, f)
+        with patch.object(networking.env, "LOG_LEVEL", "info"), patch.object(networking.env, "GROUPS", []):
+            networking.load_network_config()
+            self.assertEqual("error", networking.env.LOG_LEVEL)
+            self.assertEqual(["kitchen"], networking.env.GROUPS)
+        self.assertEqual([], [name for name in os.listdir(self.directory.name) if name.startswith("mqtt_client")])
+
+    def test_stored_credential_migrated_to_der(self):
+        patcher = patch.object(networking.utils, "ubinascii", binascii)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict(networking.credentials.FILES,
+                             {key: os.path.join(self.directory.name, key) for key in networking.credentials.FILES})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        document = self.load()
+        document["mqtt_client_cert"] = "-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----"
+        with open(networking.ENV_FILE, "w") as f:
+            json.dump(document, f)
+        networking.load_network_config()
+        self.assertTrue(networking.credentials.stored("mqtt_client_cert"))
+        self.assertNotIn("mqtt_client_cert", self.load())
+
+    def test_config_listeners(self):
+        saved = []
+        networking.add_config_listener(saved.append)
+        try:
+            networking.apply_config({"mqtt_port": 1883})
+            networking.apply_config({"mqtt_port": 8883, "publish_interval": 30})
+            networking.save_network_config_key("log_level", "info")
+        finally:
+            networking._config_listeners.remove(saved.append)
+        self.assertEqual([["mqtt_port", "publish_interval"], ["log_level"]], saved)
+
+    def test_unchanged(self):
+        changed, errors = networking.apply_config({"ssid": "home", "mqtt_port": 1883})
+        self.assertEqual({}, changed)
+        self.assertEqual({}, errors)
+
+
+class TestDnsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        networking.DNS_CACHE_FILE = os.path.join(self.directory.name, "dns.json")
+        networking._dns_cache = None
+        networking._dns_refreshing = False
+        uasyncio_mock.reset_mock()
+        time_mock.time.return_value = 1000
+        patcher = patch.object(networking, "getaddrinfo",
+                               return_value=[(2, 1, 0, "", ("10.0.0.5", 1883))])
+        self.getaddrinfo = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def counters(self):
+        stats = networking.dns_stats()
+        return stats["hits"], stats["misses"], stats["fallbacks"]
+
+    def test_ip_address_not_resolved(self):
+        self.assertEqual("10.0.0.1", networking.resolve("10.0.0.1", 1883))
+        self.getaddrinfo.assert_not_called()
+
+    def test_refresh_started_by_first_host_name(self):
+        networking.resolve("10.0.0.1", 1883)
+        uasyncio_mock.create_task.assert_not_called()
+        networking.resolve("broker.example.com", 1883)
+        networking.resolve("other.example.com", 1883)
+        uasyncio_mock.create_task.assert_called_once()
+        uasyncio_mock.create_task.call_args.args[0].close()
+
+    def refresh_task(self):
+        """ :return: dns_refresh_task started and waiting for its first refresh interval """
+        patcher = patch.object(uasyncio_mock, "sleep", types.coroutine(lambda seconds: (yield)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        task = networking.dns_refresh_task()
+        self.addCleanup(task.close)
+        task.send(None)
+        return task
+
+    def test_cached_until_ttl(self):
+        hits, misses, fallbacks = self.counters()
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        time_mock.time.return_value = 1000 + networking.env.DNS_TTL - 1
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        self.assertEqual(1, self.getaddrinfo.call_count)
+        # Expired, the last good address is used without waiting for DNS
+        time_mock.time.return_value = 1000 + networking.env.DNS_TTL
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        self.assertEqual(1, self.getaddrinfo.call_count)
+        self.assertEqual((hits + 1, misses + 1, fallbacks + 1), self.counters())
+
+    def test_miss_then_refresh(self):
+        task = self.refresh_task()
+        hits, misses, fallbacks = self.counters()
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        self.assertEqual((hits, misses + 1, fallbacks), self.counters())
+        self.getaddrinfo.return_value = [(2, 1, 0, "", ("10.0.0.6", 1883))]
+        time_mock.time.return_value = 1000 + networking.env.DNS_TTL
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        self.assertEqual(1, self.getaddrinfo.call_count)
+        task.send(None)
+        self.assertEqual(2, self.getaddrinfo.call_count)
+        self.assertEqual("10.0.0.6", networking.resolve("broker.example.com", 1883))
+        self.assertEqual((hits + 1, misses + 1, fallbacks + 1), self.counters())
+
+    def test_clock_set_backwards_is_stale(self):
+        task = self.refresh_task()
+        networking.resolve("broker.example.com", 1883)
+        time_mock.time.return_value = 10
+        hits, misses, fallbacks = self.counters()
+        networking.resolve("broker.example.com", 1883)
+        self.assertEqual((hits, misses, fallbacks + 1), self.counters())
+        task.send(None)
+        self.assertEqual(2, self.getaddrinfo.call_count)
+
+    def test_last_good_address_persisted_and_used_when_dns_fails(self):
+        networking.resolve("broker.example.com", 1883)
+        # Restart with DNS unavailable
+        networking._dns_cache = None
+        time_mock.time.return_value = 5000
+        self.getaddrinfo.side_effect = OSError(-2)
+        hits, misses, fallbacks = self.counters()
+        self.assertEqual("10.0.0.5", networking.resolve("broker.example.com", 1883))
+        self.assertEqual((hits, misses, fallbacks + 1), self.counters())
+        self.assertRaises(OSError, networking.resolve, "other.example.com", 1883)
+
+    def test_saved_only_when_address_changes(self):
+        task = self.refresh_task()
+        networking.resolve("broker.example.com", 1883)
+        modified = os.stat(networking.DNS_CACHE_FILE).st_mtime_ns
+        os.utime(networking.DNS_CACHE_FILE, ns=(0, 0))
+        time_mock.time.return_value = 5000
+        task.send(None)
+        self.assertEqual(2, self.getaddrinfo.call_count)
+        self.assertEqual(0, os.stat(networking.DNS_CACHE_FILE).st_mtime_ns)
+        self.getaddrinfo.return_value = [(2, 1, 0, "", ("10.0.0.6", 1883))]
+        time_mock.time.return_value = 10000
+        task.send(None)
+        self.assertEqual("10.0.0.6", networking.resolve("broker.example.com", 1883))
+        self.assertNotEqual(0, os.stat(networking.DNS_CACHE_FILE).st_mtime_ns)
+        self.assertTrue(modified)
+        self.assertEqual({"broker.example.com": "10.0.0.6"}, networking.dns_stats()["cache"])
+
+    def test_refresh_before_expiry(self):
+        networking.resolve("broker.example.com", 1883)
+        task = self.refresh_task()
+        task.send(None)  # first refresh interval, entry is fresh
+        self.assertEqual(1, self.getaddrinfo.call_count)
+        time_mock.time.return_value = 1000 + networking.env.DNS_TTL - networking.DNS_REFRESH_INTERVAL
+        task.send(None)
+        self.assertEqual(2, self.getaddrinfo.call_count)
+        # A failed refresh keeps the cached address
+        self.getaddrinfo.side_effect = OSError(-2)
+        time_mock.time.return_value = 5000
+        failures = networking.dns_stats()["failures"]
+        task.send(None)
+        self.assertEqual(failures + 1, networking.dns_stats()["failures"])
+        self.assertEqual({"broker.example.com": "10.0.0.5"}, networking.dns_stats()["cache"])
+
+
+if __name__ == '__main__':
+    unittest.main()
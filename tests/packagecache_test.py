@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from .context import rockwren
+
+import packagecache
+
+
+def make_sdist(filename, root, files):
+    """ Write a sdist tar with the files, a dict of path to content, under the root directory. """
+    with tarfile.open(filename, "w:gz") as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(f"{root}/{path}")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+class TestPackageCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.cache = os.path.join(self.tmp, "cache")
+        self.index = os.path.join(self.tmp, "index")
+        self.outdir = os.path.join(self.tmp, "build", "lib")
+        os.mkdir(self.index)
+        self.lock = {}
+        self.add_package("simple", {"umqtt/__init__.py": b"", "umqtt/simple.py": b"simple = 1\n", "PKG-INFO": b"x"})
+        self.add_package("robust", {"umqtt/__init__.py": b"", "umqtt/robust.py": b"robust = 1\n"})
+
+    def add_package(self, name, files):
+        filename = f"{name}-1.0.tar.gz"
+        make_sdist(os.path.join(self.index, filename), f"{name}-1.0", files)
+        self.lock[name] = {"version": "1.0", "filename": filename, "url": f"http://localhost:1/{filename}",
+                           "sha256": packagecache.sha256_file(os.path.join(self.index, filename))}
+
+    def stage(self, names, index=True):
+        return packagecache.stage_packages(names, self.outdir, self.lock, self.cache, self.index if index else None,
+                                           offline=True)
+
+    def test_stage_from_index_then_cache(self):
+        report = self.stage(["simple", "robust"])
+        self.assertEqual(["simple 1.0: index, extracted 3 files", "robust 1.0: index, extracted 2 files"],
+                         [line.rsplit(",", 1)[0] for line in report])
+        with open(os.path.join(self.outdir, "umqtt", "simple.py")) as f:
+            self.assertEqual("simple = 1\n", f.read())
+        self.assertTrue(os.path.isfile(os.path.join(self.outdir, "umqtt", "robust.py")))
+        self.assertTrue(os.path.isfile(packagecache.cache_path(self.cache, self.lock["simple"]["sha256"])))
+
+        report = self.stage(["simple", "robust"], index=False)
+        self.assertTrue(all(": cache, up to date" in line for line in report))
+
+    def test_restaged_when_files_removed(self):
+        self.stage(["simple"])
+        os.remove(os.path.join(self.outdir, "umqtt", "simple.py"))
+        self.assertIn("cache, extracted 3 files", self.stage(["simple"])[0])
+
+    def test_offline_not_found(self):
+        with self.assertRaises(packagecache.PackageError):
+            self.stage(["simple"], index=False)
+        with self.assertRaises(packagecache.PackageError):
+            self.stage(["unlocked"])
+
+    def test_hash_mismatch(self):
+        self.lock["simple"]["sha256"] = "0" * 64
+        with self.assertRaises(packagecache.PackageError):
+            self.stage(["simple"])
+        self.assertFalse(os.path.exists(packagecache.cache_path(self.cache, "0" * 64)))
+
+    def test_stage_with_prefix(self):
+        archive = os.path.join(self.index, self.lock["simple"]["filename"])
+        self.assertEqual(2, packagecache.stage("simple", archive, self.outdir, prefix="umqtt/"))
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, "PKG-INFO")))
+        self.assertEqual(0, packagecache.stage("simple", archive, self.outdir, prefix="umqtt/"))
+
+    def test_lock_file(self):
+        lock_file = os.path.join(self.tmp, "libs.lock.json")
+        self.assertEqual({}, packagecache.load_lock(lock_file))
+        packagecache.save_lock(self.lock, lock_file)
+        self.assertEqual(self.lock, packagecache.load_lock(lock_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import unittest
+from unittest import mock
+
+from .context import patch_modules
+
+time_mock = mock.MagicMock()
+time_mock.ticks_us.side_effect = iter(range(0, 1000000, 10))
+time_mock.ticks_diff = lambda end, start: end - start
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global profiler
+    patch_modules({"gc": mock.MagicMock(), "micropython": micropython_mock, "uasyncio": mock.MagicMock()})
+    from rockwren import profiler
+    profiler.time = time_mock
+
+
+def worker(steps):
+    for _ in range(steps):
+        yield None
+    return "done"
+
+
+def drive(coro):
+    """ Run a generator based co-routine to completion as the event loop would. """
+    try:
+        while True:
+            coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+
+class TestProfiler(unittest.TestCase):
+
+    def tearDown(self):
+        profiler.enabled = False
+        profiler._tasks.clear()
+
+    def test_disabled_delegates(self):
+        profiler.enabled = False
+        self.assertEqual("done", drive(profiler.task("worker", worker(3))))
+        self.assertNotIn("worker", profiler.report()["tasks"])
+
+    def test_enabled_records_runs(self):
+        profiler.enabled = True
+        self.assertEqual("done", drive(profiler.task("worker", worker(3))))
+        stats = profiler.report()["tasks"]["worker"]
+        self.assertEqual(4, stats["runs"])
+        self.assertEqual(10, stats["max_us"])
+        self.assertEqual(10, stats["avg_us"])
+
+    def test_exception_thrown_into_task(self):
+        profiler.enabled = True
+        coro = profiler.task("worker", worker(3))
+        coro.send(None)
+        with self.assertRaises(KeyError):
+            coro.throw(KeyError())
+
+    def test_render(self):
+        profiler.enabled = True
+        drive(profiler.task("worker", worker(1)))
+        text = "".join(profiler.render())
+        self.assertIn('rockwren_task_runs_total{task="worker"} 2\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
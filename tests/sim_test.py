@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import importlib.machinery
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from .context import rockwren
+
+from rockwren.sim import machine
+from rockwren.sim.broker import Broker
+from rockwren.sim.broker import topic_matches
+from rockwren.sim.mqtt import MQTTClient
+
+
+class TestTopicMatches(unittest.TestCase):
+
+    def test_wildcards(self):
+        self.assertTrue(topic_matches(b"rockwren/abc/state", b"rockwren/abc/state"))
+        self.assertTrue(topic_matches(b"rockwren/+/state", b"rockwren/abc/state"))
+        self.assertTrue(topic_matches(b"rockwren/#", b"rockwren/abc/state"))
+        self.assertTrue(topic_matches(b"rockwren/#", b"rockwren"))
+        self.assertFalse(topic_matches(b"rockwren/+", b"rockwren/abc/state"))
+        self.assertFalse(topic_matches(b"rockwren/+/state", b"rockwren/abc/command"))
+
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker(port=0).start()
+        self.received = []
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def client(self, client_id):
+        client = MQTTClient(client_id, "127.0.0.1", self.broker.port, keepalive=60)
+        client.set_callback(lambda topic, msg, retained, duplicate: self.received.append((topic, msg, retained)))
+        client.connect()
+        self.assertFalse(client.is_conn_issue())
+        return client
+
+    def receive(self, client, count):
+        deadline = time.monotonic() + 2
+        while len(self.received) < count and time.monotonic() < deadline:
+            client.check_msg()
+            time.sleep(0.01)
+
+    def test_publish_subscribe_and_retain(self):
+        device = self.client(b"device")
+        device.publish(b"rockwren/abc/LWT", b"online", retain=True)
+        controller = self.client(b"controller")
+        controller.subscribe(b"rockwren/+/LWT")
+        controller.subscribe(b"rockwren/abc/state")
+        self.receive(controller, 1)
+        device.publish(b"rockwren/abc/state", b'{"state": "ON"}')
+        self.receive(controller, 2)
+        self.assertEqual([(b"rockwren/abc/LWT", b"online", True),
+                          (b"rockwren/abc/state", b'{"state": "ON"}', False)], self.received)
+
+    def test_last_will(self):
+        controller = self.client(b"controller")
+        controller.subscribe(b"rockwren/abc/LWT")
+        device = MQTTClient(b"device", "127.0.0.1", self.broker.port)
+        device.set_last_will(b"rockwren/abc/LWT", b"offline", retain=True)
+        device.connect()
+        device.sock.close()  # connection lost without a disconnect
+        self.receive(controller, 1)
+        self.assertEqual([(b"rockwren/abc/LWT", b"offline", False)], self.received)
+
+    def test_connection_issue_recorded(self):
+        client = MQTTClient(b"device", "127.0.0.1", self.broker.port)
+        client.connect()
+        self.broker.stop()
+        self.broker = Broker(port=0).start()
+        client.port = self.broker.port
+        deadline = time.monotonic() + 2
+        while not client.is_conn_issue() and time.monotonic() < deadline:
+            client.check_msg()
+        self.assertTrue(client.is_conn_issue())
+        client.reconnect()
+        self.assertFalse(client.is_conn_issue())
+
+
+class TestMachine(unittest.TestCase):
+
+    def test_pin_interrupt(self):
+        edges = []
+        pin = machine.Pin(22, machine.Pin.IN, machine.Pin.PULL_UP)
+        pin.irq(trigger=machine.Pin.IRQ_FALLING, handler=edges.append)
+        self.assertIs(pin, machine.pins[22])
+        machine.pins[22].drive(0)
+        machine.pins[22].drive(1)
+        self.assertEqual([pin], edges)
+        self.assertEqual(1, pin.value())
+
+
+@unittest.skipUnless(importlib.machinery.PathFinder.find_spec("phew"), "phew is not installed")
+class TestFleet(unittest.TestCase):
+
+    def test_fleet(self):
+        # Run in a separate process as the fleet installs the stand-ins into sys.modules
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as root:
+            output = subprocess.run([sys.executable, "-m", "rockwren.sim.fleet", "-n", "3", "-d", "3",
+                                     "--command-rate", "5", "--storm-at", "1", "--ha-restart-at", "0", "--seed", "1"],
+                                    cwd=root, env=dict(os.environ, PYTHONPATH=package_dir), capture_output=True,
+                                    check=True, timeout=60).stdout
+        report = json.loads(output[output.index(b"{"):])
+        self.assertEqual(3, report["devices"])
+        self.assertEqual(3, report["discovered"])
+        self.assertEqual(3, report["storm"]["dropped"])
+        self.assertGreater(report["rediscovery"]["discovery_messages"], 0)
+        self.assertGreater(report["publishes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
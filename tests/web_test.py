@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: 2023 Charles Crighton <code@crighton.net.nz>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+import asyncio
+import json
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from .context import patch_modules
+
+from rockwren.sim import uasyncio
+
+micropython_mock = mock.MagicMock()
+micropython_mock.const = lambda value: value
+
+
+def setUpModule():
+    global env, metrics, web
+    patch_modules({"micropython": micropython_mock, "machine": mock.MagicMock(), "network": mock.MagicMock(),
+                   "ntptime": mock.MagicMock(), "uasyncio": mock.MagicMock(), "ubinascii": mock.MagicMock(),
+                   "usocket": mock.MagicMock(), "umqtt": mock.MagicMock(), "umqtt.robust2": mock.MagicMock(),
+                   "phew": mock.MagicMock(), "ujson": json})
+    from rockwren import env
+    from rockwren import metrics
+    from rockwren import web
+
+
+class Reader:
+    """ Stream reader of a request """
+
+    def __init__(self, request: bytes):
+        self.lines = request.splitlines(keepends=True)
+
+    async def readline(self):
+        return self.lines.pop(0) if self.lines else b""
+
+
+class Writer:
+    """ Stream writer recording the response """
+
+    def __init__(self):
+        self.written = b""
+        self.closed = False
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+REQUEST = b"GET /device/state HTTP/1.1\r\nHost: device\r\nAccept: */*\r\n\r\n"
+
+
+class TestServeClient(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (patch.object(web, "uasyncio", uasyncio),
+                        patch.object(web.profiler, "task", side_effect=lambda name, coro: coro),
+                        patch.object(env, "WEB_MAX_CLIENTS", 1),
+                        patch.object(env, "WEB_QUEUE_LENGTH", 1),
+                        patch.object(web, "_in_flight", 0),
+                        patch.object(web, "_queued", 0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.handled = []
+        patcher = patch.object(web.webapp, "_handle_request", side_effect=self.handle)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def handle(self, reader, writer):
+        self.handled.append((web._in_flight, web._queued))
+        writer.write(b"HTTP/1.1 200 OK\r\n\r\n")
+
+    def test_admitted(self):
+        writer = Writer()
+        asyncio.run(web._serve_client(Reader(REQUEST), writer))
+        self.assertEqual([(1, 0)], self.handled)
+        self.assertEqual(0, web._in_flight)
+
+    def test_queued_until_client_served(self):
+        web._in_flight = 1
+
+        async def serve():
+            task = asyncio.create_task(web._serve_client(Reader(REQUEST), Writer()))
+            await asyncio.sleep(0.05)
+            self.assertEqual(1, web._queued)
+            self.assertEqual([], self.handled)
+            web._in_flight = 0  # the client being served completes
+            await task
+
+        asyncio.run(serve())
+        self.assertEqual([(1, 0)], self.handled)
+        self.assertEqual(0, web._queued)
+
+    def test_rejected_when_queue_full(self):
+        web._in_flight = 1
+        web._queued = 1
+        rejected = metrics.get(metrics.WEB_REJECTED)
+        reader = Reader(REQUEST + b"body")
+        writer = Writer()
+        asyncio.run(web._serve_client(reader, writer))
+        self.assertTrue(writer.written.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+        self.assertTrue(writer.closed)
+        self.assertEqual([], self.handled)
+        self.assertEqual(rejected + 1, metrics.get(metrics.WEB_REJECTED))
+        # The request line and headers were read, not the body
+        self.assertEqual([b"body"], reader.lines)
+
+    def test_rejected_client_not_read_forever(self):
+        web._in_flight = 1
+        web._queued = 1
+        reader = Reader(b"X-Header: value\r\n" * (web.REJECT_DRAIN_LINES + 10))
+        writer = Writer()
+        asyncio.run(web._serve_client(reader, writer))
+        self.assertTrue(writer.written.startswith(b"HTTP/1.1 503"))
+        self.assertEqual(10, len(reader.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,33 +2,18 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 """
-Unpack a module from a sdist package tar file.
+Unpack a module from a sdist package tar file.  The tar is read in a single pass and the module is not unpacked again
+if the same sdist was already unpacked into the directory.
 """
 import argparse
-import os
-import tarfile
 
-
-def strip_directory(t, directory):
-    length = len(directory)
-    members = []
-    for member in t.getmembers():
-        if not member.path.startswith(directory):
-            raise Exception()
-        member.path = member.path[length:]
-        members.append(member)
-    return members
+import packagecache
 
 
 def unpack(file, directory, module):
-    with tarfile.open(file) as tar:
-        rootpath = os.path.commonpath(tar.getnames())
-        rootpathmember = tar.getmember(rootpath)
-        members = tar.getmembers()
-        members.remove(rootpathmember)
-        members = strip_directory(tar, rootpath)
-        members = [member for member in members if member.path.startswith(f"/{module}/")]
-        tar.extractall(directory, members=members, filter='data')
+    """ :return: number of files unpacked, 0 if already unpacked """
+
+    return packagecache.stage(module, file, directory, prefix=f"{module}/")
 
 
 def parse_args():
@@ -49,4 +34,5 @@ if __name__ == '__main__':
 
     args = parse_args()
 
-    unpack(args.file, args.directory, args.module)
+    count = unpack(args.file, args.directory, args.module)
+    print(f"{args.file}: {f'unpacked {count} files' if count else 'up to date'}")